@@ -0,0 +1,3 @@
+from .generator import generate_history, reset_schema, make_plate
+
+__all__ = ['generate_history', 'reset_schema', 'make_plate']
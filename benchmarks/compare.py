@@ -0,0 +1,44 @@
+import sys
+import json
+
+REGRESSION_RATIO = 1.2
+
+
+def compare(baseline, current, ratio=REGRESSION_RATIO):
+    """Median ratios of functions measured in both reports.
+
+    :return: List of (size, name, baseline ms, current ms, ratio)
+    """
+    rows = []
+    for size, functions in current['sizes'].items():
+        base_functions = baseline['sizes'].get(size, {})
+        for name, result in functions.items():
+            if name not in base_functions:
+                continue
+            base = base_functions[name]['median_ms']
+            rows.append((size, name, base, result['median_ms'],
+                         result['median_ms'] / base if base else 0.0))
+    return rows
+
+
+def main(baseline_path, current_path):
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = json.load(file)
+    with open(current_path, encoding='utf-8') as file:
+        current = json.load(file)
+
+    regressions = 0
+    for size, name, base, value, ratio in compare(baseline, current):
+        mark = ''
+        if ratio > REGRESSION_RATIO:
+            mark = '  <-- медленнее'
+            regressions += 1
+        print(f'{size:>10} {name:<32} {base:10.2f} {value:10.2f} '
+              f'{ratio:6.2f}x{mark}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('python -m benchmarks.compare baseline.json current.json')
+    sys.exit(main(sys.argv[1], sys.argv[2]))
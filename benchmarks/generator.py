@@ -0,0 +1,138 @@
+import random
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from db.db import init_engine, Base
+from db.migrations import stamp
+from db.partitions import create_month_partitions
+from db import rebuild_parking_stats, rebuild_daily_stats
+
+PLATE_LETTERS = 'ABEKMHOPCTYX'
+# Moscow and the Moscow region dominate, the rest is spread evenly
+HOT_REGIONS = ['77', '97', '99', '177', '197', '199', '777', '799', '977',
+               '50', '90', '150', '190', '750']
+HOT_REGION_SHARE = 0.8
+# fixations per hour of the day, peaks at shift change
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 8, 10, 7, 5, 4,
+                4, 4, 4, 5, 6, 8, 10, 8, 5, 3, 2, 1]
+HOUR_CUM_WEIGHTS = [sum(HOUR_WEIGHTS[:hour + 1]) for hour in range(24)]
+COPY_CHUNK = 100000
+
+
+def make_plate(rng: random.Random) -> str:
+    if rng.random() < HOT_REGION_SHARE:
+        region = rng.choice(HOT_REGIONS)
+    else:
+        region = f'{rng.randint(1, 99):02d}'
+    return f'{rng.choice(PLATE_LETTERS)}{rng.randint(1, 999):03d}' \
+           f'{rng.choice(PLATE_LETTERS)}{rng.choice(PLATE_LETTERS)}{region}'
+
+
+def make_plates(rng: random.Random, count: int) -> list:
+    plates = set()
+    while len(plates) < count:
+        plates.add(make_plate(rng))
+    return sorted(plates)
+
+
+def visit_weights(count: int, skew: float) -> list:
+    """Cumulative Zipf weights: a few cars park daily, most once."""
+    total = 0.0
+    weights = []
+    for rank in range(1, count + 1):
+        total += 1 / rank ** skew
+        weights.append(total)
+    return weights
+
+
+def random_moment(rng: random.Random, start: datetime, days: int) -> datetime:
+    day = start + timedelta(days=rng.randrange(days))
+    hour = rng.choices(range(24), cum_weights=HOUR_CUM_WEIGHTS)[0]
+    # microseconds keep (car_number_id, record_date) unique for regulars
+    return day.replace(hour=hour, minute=rng.randrange(60),
+                       second=rng.randrange(60),
+                       microsecond=rng.randrange(1000000))
+
+
+async def reset_schema():
+    """Drop everything and create the latest schema in an empty database."""
+    engine, _ = init_engine()
+    async with engine.begin() as connection:
+        await connection.execute(text('DROP SCHEMA public CASCADE'))
+        await connection.execute(text('CREATE SCHEMA public'))
+        await connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        await connection.run_sync(Base.metadata.create_all)
+    await stamp()
+
+
+async def generate_history(size, years=3, plates=None, users=500,
+                           own_share=0.2, skew=1.1, seed=1):
+    """Fill an empty schema with size synthetic fixations.
+
+    :param size: Number of log_history rows
+    :param plates: Number of distinct plates, size // 20 by default
+    :param users: Number of distinct senders
+    :param own_share: Share of plates in the own list
+    :param skew: Zipf exponent of repeat visits
+    :return: dict with the generated own and foreign plates and user ids
+    """
+    rng = random.Random(seed)
+    plates = plates or max(size // 20, 100)
+    numbers = make_plates(rng, plates)
+    rng.shuffle(numbers)
+    own_count = int(plates * own_share)
+    user_ids = [rng.randint(10 ** 8, 10 ** 10) for _ in range(users)]
+
+    end = datetime.now().replace(minute=0, second=0, microsecond=0)
+    start = (end - timedelta(days=365 * years)).replace(hour=0)
+    days = (end - start).days
+
+    engine, _ = init_engine()
+    async with engine.begin() as connection:
+        await create_month_partitions(connection, start.date(), end.date())
+        raw = await connection.get_raw_connection()
+        driver = raw.driver_connection
+
+        now = datetime.now()
+        await driver.copy_records_to_table(
+            'car_numbers',
+            records=[(number, index < own_count, False, 0, now, 0)
+                     for index, number in enumerate(numbers)],
+            columns=['number', 'is_own', 'is_archive', 'count_out_archive',
+                     'timestamp', 'parking_count'])
+        ids = dict((await connection.execute(
+            text('SELECT number, id FROM car_numbers'))).fetchall())
+        car_ids = [ids[number] for number in numbers]
+        own_ids = set(car_ids[:own_count])
+
+        # own and foreign plates are shuffled together before ranking,
+        # both have regulars and one-off visitors
+        ranked = car_ids[:]
+        rng.shuffle(ranked)
+        weights = visit_weights(len(ranked), skew)
+        user_weights = visit_weights(len(user_ids), 1.0)
+
+        written = 0
+        while written < size:
+            chunk = min(COPY_CHUNK, size - written)
+            cars = rng.choices(ranked, cum_weights=weights, k=chunk)
+            senders = rng.choices(user_ids, cum_weights=user_weights, k=chunk)
+            await driver.copy_records_to_table(
+                'log_history',
+                records=[(sender, car, random_moment(rng, start, days),
+                          car in own_ids)
+                         for sender, car in zip(senders, cars)],
+                columns=['tg_user_id', 'car_number_id', 'record_date',
+                         'is_own'])
+            written += chunk
+            logging.info('Сгенерировано фиксаций: %s из %s', written, size)
+
+    await rebuild_parking_stats()
+    await rebuild_daily_stats()
+    async with engine.begin() as connection:
+        await connection.execute(text('ANALYZE'))
+
+    return {'own': numbers[:own_count], 'foreign': numbers[own_count:],
+            'users': user_ids}
@@ -0,0 +1,71 @@
+import sys
+import asyncio
+import argparse
+from time import perf_counter
+
+from sqlalchemy import select, text
+
+from db.db import init_engine, dispose_engine, CarNumber, fetch_plate_row
+
+
+async def orm_lookup(session, number):
+    plate = (await session.execute(
+        select(CarNumber).where(CarNumber.number == number))) \
+        .scalar_one_or_none()
+    return plate.id, plate.is_own, plate.is_archive
+
+
+async def row_lookup(session, number):
+    plate = await fetch_plate_row(session, number)
+    return plate.id, plate.is_own, plate.is_archive
+
+
+LOOKUPS = {'orm_entity': orm_lookup, 'column_row': row_lookup}
+
+
+async def time_lookup(session_factory, lookup, numbers, calls):
+    """Per-call time of lookup, one session per call like the db functions.
+
+    :return: Microseconds per call
+    """
+    start = perf_counter()
+    for index in range(calls):
+        async with session_factory() as session:
+            await lookup(session, numbers[index % len(numbers)])
+    return (perf_counter() - start) / calls * 1000000
+
+
+async def main(args):
+    engine, session_factory = init_engine()
+    async with engine.connect() as connection:
+        numbers = (await connection.execute(
+            text('SELECT number FROM car_numbers LIMIT :limit'),
+            {'limit': args.plates})).scalars().all()
+    if not numbers:
+        sys.exit('car_numbers пуста, сначала выполните python -m '
+                 'benchmarks.run или заполните базу')
+
+    for name, lookup in LOOKUPS.items():
+        await time_lookup(session_factory, lookup, numbers, args.calls // 10)
+    results = {name: await time_lookup(session_factory, lookup, numbers,
+                                       args.calls)
+               for name, lookup in LOOKUPS.items()}
+    await dispose_engine()
+
+    for name, micros in results.items():
+        print(f'{name:<12} {micros:10.1f} мкс на вызов')
+    saving = results['orm_entity'] - results['column_row']
+    print(f'Экономия: {saving:.1f} мкс на вызов '
+          f'({saving / results["orm_entity"] * 100:.0f}%)')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Поиск номера: ORM-сущность против строки колонок')
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--plates', type=int, default=1000)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args(sys.argv[1:])))
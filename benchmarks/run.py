@@ -0,0 +1,181 @@
+import sys
+import json
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import statistics
+from time import time, perf_counter
+from datetime import datetime
+
+from sqlalchemy import text
+
+import db
+from db.db import DB_NAME
+from .generator import reset_schema, generate_history, make_plate
+
+DEFAULT_SIZES = [100000, 1000000, 10000000]
+
+# Lifecycle and maintenance entry points and query builders of
+# db/__init__.py, they do not run per request and are not timed.
+SKIPPED = {'init_engine', 'dispose_engine', 'get_pool_stats',
+           'instrumentation', 'upgrade', 'check_indexes',
+           'get_pending_migrations', 'ensure_partitions',
+           'compact_log_history', 'maintain_log_history',
+           'stream_partitions', 'parking_export_query',
+           'number_history_query', 'fixations_export_query'}
+
+
+class Context:
+    """Sample plates and users for the benchmark cases."""
+
+    def __init__(self, data, seed):
+        self.rng = random.Random(seed)
+        self.own = data['own']
+        self.foreign = data['foreign']
+        self.users = data['users']
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def own_plate(self):
+        return self.rng.choice(self.own)
+
+    def foreign_plate(self):
+        return self.rng.choice(self.foreign)
+
+    def new_plate(self):
+        return make_plate(self.rng)
+
+    def own_list(self):
+        """The own list with a few plates swapped, like a real upload."""
+        changed = max(len(self.own) // 100, 1)
+        kept = self.rng.sample(self.own, len(self.own) - changed)
+        return kept + [self.new_plate() for _ in range(changed)]
+
+
+CASES = {
+    'add_auto_number': lambda c: db.add_auto_number(c.new_plate(), False),
+    'add_log_history': lambda c: db.add_log_history(c.user(),
+                                                    c.foreign_plate()),
+    'register_fixation': lambda c: db.register_fixation(c.user(),
+                                                        c.foreign_plate()),
+    'register_fixations_batch': lambda c: db.register_fixations_batch(
+        [(c.user(), c.foreign_plate(), time()) for _ in range(100)]),
+    'get_auto_number_id': lambda c: db.get_auto_number_id(c.foreign_plate()),
+    'get_repeatable_parking': lambda c: db.get_repeatable_parking(False,
+                                                                  False),
+    'get_repeatable_parking_page': lambda c: db.get_repeatable_parking_page(
+        False, False, 10),
+    'get_stat_numbers': lambda c: db.get_stat_numbers(),
+    'get_stat_numbers_dates_count': lambda c: db.get_stat_numbers_dates_count(),
+    'get_general_activity': lambda c: db.get_general_activity(),
+    'get_end_day_stats': lambda c: db.get_end_day_stats(),
+    'get_number_detail': lambda c: db.get_number_detail(c.foreign_plate()),
+    'get_number_detail_info_change': lambda c:
+        db.get_number_detail_info_change(c.own_plate()),
+    'is_exists_number_info_change': lambda c:
+        db.is_exists_number_info_change(c.own_plate()),
+    'get_log_numbers_upload': lambda c: db.get_log_numbers_upload(),
+    'get_numbers_upload_count': lambda c: db.get_numbers_upload_count(),
+    'get_excel_log_items': lambda c: db.get_excel_log_items(1, 'ADD'),
+    'get_recent_fixations': lambda c: db.get_recent_fixations(),
+    'find_similar_plates': lambda c: db.find_similar_plates(c.own_plate()),
+    'get_plate_index_numbers': lambda c: db.get_plate_index_numbers(),
+    'is_in_archive_number': lambda c: db.is_in_archive_number(
+        c.foreign_plate()),
+    'set_archive_db': lambda c: db.set_archive_db(c.user(),
+                                                  c.foreign_plate()),
+    'update_plate_numbers_list': lambda c: db.update_plate_numbers_list(
+        c.user(), c.own_list()),
+    'rebuild_parking_stats': lambda c: db.rebuild_parking_stats(),
+    'rebuild_daily_stats': lambda c: db.rebuild_daily_stats(),
+}
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {'runs': len(timings),
+            'min_ms': timings[0] * 1000,
+            'median_ms': statistics.median(timings) * 1000,
+            'p95_ms': timings[min(int(len(timings) * 0.95),
+                                  len(timings) - 1)] * 1000,
+            'max_ms': timings[-1] * 1000}
+
+
+async def time_case(factory, context, repeat):
+    await factory(context)  # warm up caches and prepared statements
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        await factory(context)
+        timings.append(perf_counter() - start)
+    return summarize(timings)
+
+
+async def run_size(size, repeat, only, seed):
+    logging.info('Размер %s: генерация данных', size)
+    await reset_schema()
+    data = await generate_history(size, seed=seed)
+    # one upload so that the excel log cases have data
+    context = Context(data, seed)
+    await db.update_plate_numbers_list(context.user(), context.own_list())
+
+    results = {}
+    for name, factory in CASES.items():
+        if only and name not in only:
+            continue
+        results[name] = await time_case(factory, context, repeat)
+        logging.info('%s: %s, медиана %.2f мс', size, name,
+                     results[name]['median_ms'])
+    return results
+
+
+async def server_version():
+    engine, _ = db.init_engine()
+    async with engine.connect() as connection:
+        return await connection.scalar(text('SHOW server_version'))
+
+
+async def main(args):
+    missing = set(db.__all__) - SKIPPED - set(CASES)
+    if missing:
+        logging.warning('Нет замеров для функций: %s', ', '.join(missing))
+
+    report = {'started_at': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'postgres': await server_version(),
+              'repeat': args.repeat, 'seed': args.seed, 'sizes': {}}
+    for size in args.sizes:
+        report['sizes'][str(size)] = await run_size(size, args.repeat,
+                                                    args.only, args.seed)
+    await db.dispose_engine()
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f'Результаты записаны в {args.output}')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Замеры функций db на синтетической истории фиксаций')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Число строк log_history')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='Имена функций')
+    parser.add_argument('--output', default=datetime.now().strftime(
+        'benchmark_%Y%m%d_%H%M%S.json'))
+    parser.add_argument('--force', action='store_true',
+                        help='Разрешить базу без "bench" в имени')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arguments = parse_args(sys.argv[1:])
+    if 'bench' not in DB_NAME and not arguments.force:
+        sys.exit(f'База {DB_NAME} будет очищена. Укажите в config.ini базу '
+                 f'с "bench" в имени или запустите с --force')
+    asyncio.run(main(arguments))
@@ -1,51 +1,66 @@
 import os
 import re
-import time
+import html
+import signal
 import asyncio
+import secrets
 import logging
-import aiohttp
+import tempfile
 import configparser
 from typing import Any, Union
 from datetime import datetime, timezone, timedelta
 from collections.abc import Callable, Awaitable
 
-from aiogram.filters import Command, BaseFilter
-from db import add_auto_number, add_log_history, get_auto_number_id, \
-    get_repeatable_parking, get_stat_numbers, get_general_activity, \
-    get_active_users, get_end_day_stats, get_number_detail, \
-    is_in_archive_number, set_archive_db, get_number_detail_info_change, \
-    get_log_numbers_upload
-from aiogram import F, Dispatcher, Bot, types, exceptions
+from aiogram.filters import Command, CommandObject, BaseFilter
+from db import register_fixation, get_repeatable_parking_page, \
+    get_stat_numbers, get_general_activity, \
+    get_end_day_stats, get_number_detail, is_in_archive_number, \
+    set_archive_db, get_number_detail_info_change, get_log_numbers_upload, \
+    init_engine, dispose_engine, check_indexes, get_pending_migrations, \
+    ensure_partitions, maintain_log_history, get_excel_log_items, \
+    find_similar_plates, instrumentation, get_pool_stats, stream_partitions, \
+    parking_export_query, number_history_query, fixations_export_query
+from aiohttp import web
+from aiogram import F, Dispatcher, Bot, Router, types, exceptions
 from aiogram.types import BotCommand, BotCommandScopeChat, \
     BotCommandScopeDefault, Message
-from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.context import FSMContext
 import aioschedule
 
-from main import get_number_auto
+from main import recognize_plate, init_worker
 from consts import T_RANGE_H
+from consts.consts import LIMIT_PLATE_NUMBERS, LIMIT_EXCEL_LOG_PREVIEW, \
+    LIMIT_ACTIVE_USERS, PHOTO_MAX_BYTES, PHOTO_DOWNLOAD_TIMEOUT
 from keyboards import get_add_plate_keyboard, refresh_keyboard, \
     get_active_user_keyboard, get_keyboard_add_archive, \
     get_keyboard_yes_or_no_archive, get_keyboard_stat_numbers, \
-    refresh_keyboard_and_text, get_keyboard_upload_excel
-from utils import compare_count, read_excel
+    refresh_keyboard_and_text, get_keyboard_upload_excel, \
+    get_keyboard_excel_log_items, get_keyboard_plate_candidates
+from utils import compare_count, read_excel, decode_cursor, levenshtein, \
+    export_rows, EXPORT_EXTENSIONS, PhotoDownloader, OcrPool, PoolBusy
+from cache import plate_index, claim_fixation, release_fixation, \
+    shorten_fixation, warm_fixation_window, FixationQueue, record_activity, \
+    get_activity_page, reconcile_activity, ensure_activity_board, ChatCache, \
+    RateLimiter
 
 config = configparser.ConfigParser()
 
-config.read('config.ini')
-
-TOKEN_BOT = config['BOT']['bot_token']
-
-REDIS_DATA_CONNECTION = config['redis']['redis_data_conn']
-
 project_path = os.path.dirname(os.path.abspath(__file__))
 
-
-logging.basicConfig(level=logging.INFO)
-bot = Bot(TOKEN_BOT)
-storage = RedisStorage.from_url(REDIS_DATA_CONNECTION)
-dp = Dispatcher(storage=storage)
+# Handlers are registered on the router at import, everything that needs
+# config.ini is created by setup(). Spawned OCR workers import this module
+# as __mp_main__ and must not build a bot, pools or connections.
+router = Router()
+bot = None
+storage = None
+dp = None
+fixation_queue = None
+rate_limiter = None
+photo_downloader = None
+ocr_pool = None
+chat_cache = None
+WEBHOOK_PATH = '/webhook'
 
 user_commands = [
     BotCommand(command="start", description="Проверить номер"),
@@ -61,7 +76,13 @@ admin_commands = [
     BotCommand(command="upload_excel",
                description="Загрузка списка"),
     BotCommand(command="get_archive", description="Архив номеров"),
-    BotCommand(command="log", description="История добавленных/удалённых номеров")
+    BotCommand(command="log", description="История добавленных/удалённых номеров"),
+    BotCommand(command="queue_stats", description="Очередь фиксаций"),
+    BotCommand(command="db_stats", description="Время запросов к базе"),
+    BotCommand(command="export", description="Выгрузка в файл"),
+    BotCommand(command="flood_stats", description="Отклонённые сообщения"),
+    BotCommand(command="photo_stats",
+               description="Загрузка и распознавание фотографий")
 ]
 
 
@@ -96,23 +117,15 @@ async def set_commands():
                                       scope=BotCommandScopeChat(chat_id=admin))
 
 
-async def get_photo_bytes(photo: types.PhotoSize) -> bytes:
-    try:
-        photo_file = await bot.get_file(photo.file_id)
+async def get_photo_bytes(photo: types.PhotoSize):
+    """Download a photo into memory.
 
-        file_url = f"https://api.telegram.org/file/bot{bot.token}" \
-                   f"/{photo_file.file_path}"
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    photo_bytes = await response.read()
-                    return photo_bytes
-    except Exception as e:
-        print(e)
+    :return: bytearray with the photo or None
+    """
+    return await photo_downloader.download(bot, photo)
 
 
-@dp.message(ChatTypeFilter('private'), Command('start'))
+@router.message(ChatTypeFilter('private'), Command('start'))
 async def start_app(message: Message):
     text = 'Здравствуйте! Отправьте автомобильный номер.\n' \
            'Пример: <b>A542OH99</b>\n\n' \
@@ -123,12 +136,13 @@ async def start_app(message: Message):
     await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), Command('get_list'))
+@router.message(ChatTypeFilter('private'), Command('get_list'))
 async def not_registered_number(message: Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in ADMIN_ID:
-            numbers, total_count = await get_repeatable_parking(is_own=False,
-                                                                is_archive=False)
+            page = await get_repeatable_parking_page(False, False,
+                                                     LIMIT_PLATE_NUMBERS)
+            total_count = page[2]
             text = '<b>Статистика по чужим номерам</b>\n\n' \
                    '1. Список отображает количество зафиксированных ' \
                    'парковок* автомобиля.\n' \
@@ -141,7 +155,8 @@ async def not_registered_number(message: Message, state: FSMContext):
             current_page = 1
             keyboard = await get_add_plate_keyboard(is_own=False,
                                                     is_archive=False,
-                                                    current_page=current_page)
+                                                    current_page=current_page,
+                                                    page=page)
             text += f'\nОбщее количество обнаруженных ' \
                     f'незарегистрированных номеров (включая дубли): ' \
                     f'{compare_count(total_count)}'
@@ -157,12 +172,13 @@ async def not_registered_number(message: Message, state: FSMContext):
         await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), Command('get_archive'))
+@router.message(ChatTypeFilter('private'), Command('get_archive'))
 async def get_archive(message: Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in ADMIN_ID:
-            numbers, total_count = await get_repeatable_parking(is_own=False,
-                                                                is_archive=True)
+            page = await get_repeatable_parking_page(False, True,
+                                                     LIMIT_PLATE_NUMBERS)
+            total_count = page[2]
             text = '<b>Статистика по архивным номерам</b>\n\n' \
                    '1. Список отображает количество зафиксированных ' \
                    'парковок* архивного автомобиля.\n' \
@@ -180,7 +196,8 @@ async def get_archive(message: Message, state: FSMContext):
             current_page = 1
             keyboard = await get_add_plate_keyboard(is_own=False,
                                                     is_archive=True,
-                                                    current_page=current_page)
+                                                    current_page=current_page,
+                                                    page=page)
             text += f'\nОбщее количество обнаруженных ' \
                     f'незарегистрированных номеров в архиве(включая дубли): ' \
                     f'{compare_count(total_count)}\n'
@@ -198,7 +215,7 @@ async def get_archive(message: Message, state: FSMContext):
         await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), Command('upload_excel'))
+@router.message(ChatTypeFilter('private'), Command('upload_excel'))
 async def upload_excel(message: Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in [497503958, 1125759577]:
@@ -224,7 +241,7 @@ async def upload_excel(message: Message, state: FSMContext):
         await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), F.document)
+@router.message(ChatTypeFilter('private'), F.document)
 async def handle_excel_document(message: types.Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in [497503958, 1125759577]:
@@ -240,33 +257,41 @@ async def handle_excel_document(message: types.Message, state: FSMContext):
 
                     if "Данные были успешно загружены!" in text:
                         await state.update_data(upload_number_excel=False)
+                        await plate_index.publish_change(storage.redis)
 
                     await message.answer(text=text, parse_mode='HTML')
 
 
-async def template_stat_numbers(cp):
+async def template_stat_numbers(after=None, before=None):
     text = "<b>Ежедневная статистика по количеству " \
            "отправленных номеров (чужих и своих)</b>\n\n"
 
-    stat_numbers, total_count = await get_stat_numbers(cp)
+    stat_numbers, total_count, total_days = await get_stat_numbers(
+        after=after, before=before)
 
-    for date, count in stat_numbers:
+    for date, count, _ in stat_numbers:
         text += f"📅 <b>{date}</b> | " \
                 f"<b>{compare_count(count)}</b>\n"
 
     text += f"\nОбщее количество отправленных номеров: " \
             f"<b>{compare_count(total_count)}</b>"
-    return text
+
+    first_key = stat_numbers[0][2] if stat_numbers else None
+    last_key = stat_numbers[-1][2] if stat_numbers else None
+    return text, first_key, last_key, total_days
 
 
-@dp.message(ChatTypeFilter('private'), Command('get_stat_numbers'))
+@router.message(ChatTypeFilter('private'), Command('get_stat_numbers'))
 async def stat_numbers(message: Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in ADMIN_ID:
             current_page = 1
-            text = await template_stat_numbers(current_page)
+            text, first_key, last_key, total_days = \
+                await template_stat_numbers()
 
-            keyboard = await get_keyboard_stat_numbers(current_page)
+            keyboard = await get_keyboard_stat_numbers(current_page,
+                                                       first_key, last_key,
+                                                       total_days)
 
             sent_message = await message.answer(text=text, parse_mode='HTML',
                                                 reply_markup=keyboard)
@@ -277,71 +302,85 @@ async def stat_numbers(message: Message, state: FSMContext):
         await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), Command('get_general_activity'))
+async def template_general_activity(page=1):
+    text = "<b>Общая активность</b>\n\n" \
+           "Список отображает активность пользователей " \
+           "по вводу номеров\n\n"
+    try:
+        users, total_users = await get_activity_page(
+            storage.redis, page, LIMIT_ACTIVE_USERS)
+    except Exception as e:
+        print(e)
+        users = await get_general_activity() or []
+        total_users = len(users)
+        users = users[(page - 1) * LIMIT_ACTIVE_USERS:
+                      page * LIMIT_ACTIVE_USERS]
+
+    chats = await resolve_chats([user[0] for user in users])
+    for user in users:
+
+        chat = chats[user[0]]
+
+        if chat and chat.type == 'private':
+            first_name = chat.first_name
+            last_name = chat.last_name
+            username = chat.username
+            text += f'👤<b>{first_name} ' \
+                    f'{last_name if last_name else ""}</b> ' \
+                    f'{"".join(["@", username]) if username else ""} '\
+                    \
+                    f'| {compare_count(user[1])} ' \
+                    f'<a href="tg://user?id={user[0]}">📧</a> \n'
+        else:
+            text += f'👤<b>{user[0]}</b> ' \
+                    \
+                    f'| {compare_count(user[1])} ' \
+                    f'<a href="tg://user?id={user[0]}">📧</a> \n'
+    return text, total_users
+
+
+@router.message(ChatTypeFilter('private'), Command('get_general_activity'))
 async def general_activity(message: Message):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in ADMIN_ID:
-            s_key = StorageKey(bot_id=bot.id, chat_id=0,
-                               user_id=0)
-
-            data = await dp.storage.get_data(key=s_key)
-
-            if data and data.get('activity_users'):
-                text = data.get('activity_users')
-
-            else:
-                text = "<b>Общая активность</b>\n\n" \
-                       "Список отображает активность пользователей " \
-                       "по вводу номеров\n\n"
-                users = await get_general_activity()
-
-                for user in users:
-
-                    chat = await check_chat_existence(user[0])
-
-                    if chat and chat.type == 'private':
-                        first_name = chat.first_name
-                        last_name = chat.last_name
-                        username = chat.username
-                        text += f'👤<b>{first_name} ' \
-                                f'{last_name if last_name else ""}</b> ' \
-                                f'{"".join(["@", username]) if username else ""} '\
-                                \
-                                f'| {compare_count(user[1])} ' \
-                                f'<a href="tg://user?id={user[0]}">📧</a> \n'
-                    else:
-                        text += f'👤<b>{user[0]}</b> ' \
-                                \
-                                f'| {compare_count(user[1])} ' \
-                                f'<a href="tg://user?id={user[0]}">📧</a> \n'
-                await dp.storage.update_data(
-                    key=s_key,
-                    data={'activity_users': text})
             current_page = 1
-            keyboard = await get_active_user_keyboard(current_page)
+            text, total_users = await template_general_activity(current_page)
+            keyboard = await get_active_user_keyboard(current_page,
+                                                      total_users)
 
-            await message.answer(text=text, parse_mode='HTML')
-
-            #
-            # for first_name, last_name, count in users:
-            #     text += f"{first_name} {last_name} | {compare_count(count)}"
+            await message.answer(text=text, parse_mode='HTML',
+                                 reply_markup=keyboard)
         else:
             await message.answer(text='У Вас нет доступа к этой команде!')
         await message.delete()
 
 
-async def template_upload_excel_log(cp):
+@router.callback_query(F.data.startswith('active_user_page:'))
+async def active_user_page(query: types.CallbackQuery):
+    if await check_chat_existence(query.from_user.id):
+        current_page = max(int(query.data.split(':')[1]), 1)
+        text, total_users = await template_general_activity(current_page)
+        keyboard = await get_active_user_keyboard(current_page, total_users)
+        await refresh_keyboard_and_text(bot, query.message.chat.id,
+                                        query.message.message_id, text,
+                                        keyboard)
+
+
+async def template_upload_excel_log(after=None, before=None):
     text = "*История списка номеров*\n"
     text += "Содержит информацию об изменениях номеров в списке " \
             "(добавленных и удалённых)\n\n"
-    log_uploaded_numbers = await get_log_numbers_upload(cp)
+    log_uploaded_numbers, total_upload = await get_log_numbers_upload(
+        after=after, before=before)
 
     user_ids = {}
+    diffs = []
 
+    chats = await resolve_chats([row[0] for row in log_uploaded_numbers])
     for log_up_num in log_uploaded_numbers:
         if user_ids.get(str(log_up_num[0])) is None:
 
-            chat = await check_chat_existence(log_up_num[0])
+            chat = chats[log_up_num[0]]
 
             if chat and chat.type == 'private':
                 user_ids[f'{log_up_num[0]}'] = chat.first_name
@@ -351,15 +390,25 @@ async def template_upload_excel_log(cp):
         text += f"[{user_ids[f'{log_up_num[0]}']}]" \
                 f"(tg://user?id={log_up_num[0]}) {log_up_num[3]}\n"
 
-        text += f"Добавленные номера\n{log_up_num[1]}\n" if log_up_num[
-            1] else ''
-
-        text += f"Удалённые номера\n{log_up_num[2]}\n\n" if log_up_num[
-            2] else ''
-    return text
-
-
-@dp.message(ChatTypeFilter('private'), Command('log'))
+        for numbers, count, action, title in (
+                (log_up_num[1], log_up_num[5], 'ADD', 'Добавленные номера'),
+                (log_up_num[2], log_up_num[6], 'DELETE', 'Удалённые номера')):
+            if not count:
+                continue
+            text += f"{title} ({count})\n{numbers}"
+            if count > LIMIT_EXCEL_LOG_PREVIEW:
+                text += ' …'
+                diffs.append((log_up_num[4], action,
+                              f"{title} ({count}) {log_up_num[3]}"))
+            text += '\n'
+        text += '\n'
+
+    first_key = log_uploaded_numbers[0][4] if log_uploaded_numbers else None
+    last_key = log_uploaded_numbers[-1][4] if log_uploaded_numbers else None
+    return text, first_key, last_key, total_upload, diffs
+
+
+@router.message(ChatTypeFilter('private'), Command('log'))
 async def story_log(message: Message, state: FSMContext):
     if await check_chat_existence(message.from_user.id):
         if message.from_user.id in ADMIN_ID:
@@ -367,9 +416,12 @@ async def story_log(message: Message, state: FSMContext):
             text += "Содержит информацию об изменениях номеров в списке " \
                     "(добавленных и удалённых)\n\n"
             current_page = 1
-            text = await template_upload_excel_log(current_page)
+            text, first_key, last_key, total_upload, diffs = \
+                await template_upload_excel_log()
 
-            keyboard = await get_keyboard_upload_excel(current_page)
+            keyboard = await get_keyboard_upload_excel(current_page,
+                                                       first_key, last_key,
+                                                       total_upload, diffs)
 
             if len(text) > 4095:
                 for x in range(0, len(text), 4095):
@@ -392,97 +444,382 @@ async def story_log(message: Message, state: FSMContext):
         await message.delete()
 
 
-@dp.message(ChatTypeFilter('private'), F.photo)
+@router.message(ChatTypeFilter('private'), F.photo)
 async def handle_photo(message: Message):
     if await check_chat_existence(message.from_user.id):
         photo = message.photo[-1]
         photo_bytes = await get_photo_bytes(photo)
 
         if photo_bytes:
-            number_auto, img = get_number_auto(photo_bytes)
+            try:
+                number_auto = await ocr_pool.run(photo_bytes)
+            except PoolBusy:
+                await message.answer('Распознавание сейчас занято, '
+                                     'попробуйте позже')
+                return
+            except asyncio.TimeoutError:
+                await message.answer('Не удалось распознать номер вовремя, '
+                                     'попробуйте ещё раз')
+                return
+            except Exception as e:
+                print(e)
+                return
             await message.answer(text=number_auto)
+            # OCR confuses similar characters, a misread own plate is
+            # usually one edit away. Longer reads are noise and would not
+            # fit into the callback data of the keyboard.
+            recognized = number_auto.split(':', 1)[-1]
+            if 0 < len(recognized) <= 10:
+                await offer_own_plates(message, recognized)
 
 
-@dp.message(ChatTypeFilter('private'), F.text)
-async def handle_auto_number(message: Message):
-    if await check_chat_existence(message.from_user.id):
-        pattern = r'^(?:[А-ЯA-Z]|[а-яa-z])\d{3}' \
-                  r'(?:[А-ЯA-Z]|[а-яa-z]){2}\d{1,3}$'
-        if re.match(pattern, message.text) is not None:
-            translation_table = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
-            number = message.text.upper()
-            translated_text = number.translate(translation_table)
+background_tasks = set()
+fixation_consumer = None
 
-            auto_number_id, is_own, is_archive = await get_auto_number_id(translated_text)
-            if not auto_number_id:
-                auto_number_id = await add_auto_number(translated_text, False)
-
-            result = await add_log_history(message.from_user.id, auto_number_id)
-            is_us_or_not = "🟢" if is_own else "🔴"
-            if result:
-                await message.answer(
-                    f"Благодарим за отправку автомобильного номера "
-                    f"<b>{translated_text}</b> {is_us_or_not}\n\n"
-                    f"<i>Время фиксации: {get_time_now()}</i>", parse_mode="HTML")
-                # reset redis data
-                s_key = StorageKey(bot_id=bot.id, chat_id=0,
-                                   user_id=0)
-                await dp.storage.update_data(
-                    key=s_key,
-                    data={'activity_users': None})
-            else:
-                await message.answer('Сегодня этот номер уже был зафиксирован')
-        else:
-            await message.answer(
-                f"<b>Ошибка!</b>\nВы ввели: <b>{message.text}</b>"
-                f"\nПринимаются номера только "
-                f"российского формата. Повторите ввод.", parse_mode="HTML")
+
+def run_in_background(coroutine):
+    """Start a task and keep a reference to it until it is done."""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 
-async def update_flood_start_time(s_key, duration=2):
-    """Update the start time of anti-flood for the user.
+async def write_fixation(tg_user_id, number, sent_message: Message):
+    """Store a fixation that was already answered from the plate index.
 
-    :param s_key: StorageKey instance
-    :param duration: Anti-flood duration in seconds
-    :return: None.
+    If the plate was fixed within T_RANGE_H the answer is corrected.
     """
-    current_time = int(time.time())
-    await dp.storage.update_data(
-        key=s_key,
-        data={f"{s_key.user_id}_start": current_time + duration})
+    result = await register_fixation(tg_user_id, number)
+    if result is None:
+        await release_fixation(storage.redis, number)
+        return
+    is_own, inserted, last_seconds = result
+    if inserted:
+        await plate_index.discard_archive(storage.redis, [number])
+        await record_activity(storage.redis, [tg_user_id])
+    else:
+        await shorten_fixation(storage.redis, number, last_seconds)
+        try:
+            await sent_message.edit_text(
+                'Сегодня этот номер уже был зафиксирован')
+        except exceptions.TelegramBadRequest as e:
+            print(e)
+
+
+async def on_fixation_batch(written):
+    """Called with the fixations of a batch that were actually written."""
+    await plate_index.discard_archive(
+        storage.redis, [number for _, number, _ in written])
+    await record_activity(storage.redis,
+                          [tg_user_id for tg_user_id, _, _ in written])
+
+
+@router.message(ChatTypeFilter('private'), Command('queue_stats'))
+async def queue_stats(message: Message):
+    if await check_chat_existence(message.from_user.id):
+        if message.from_user.id in ADMIN_ID:
+            if not fixation_queue.enabled:
+                await message.answer('Отложенная запись фиксаций выключена')
+                return
+            try:
+                stats = await fixation_queue.get_stats(storage.redis)
+            except Exception as e:
+                print(e)
+                await message.answer('Не удалось получить состояние очереди')
+                return
+            last_flush = datetime.fromtimestamp(stats['last_flush']) \
+                .strftime('%H:%M:%S') if stats['last_flush'] else '—'
+            await message.answer(
+                f"<b>Очередь фиксаций</b>\n\n"
+                f"В потоке: {stats['length']}\n"
+                f"Ожидают записи: {stats['pending']}\n"
+                f"Задержка: {stats['lag_seconds']:.1f} с\n"
+                f"Размер пакета: {fixation_queue.batch_size}, "
+                f"ожидание: {fixation_queue.max_delay} с\n\n"
+                f"Записано пакетов: {stats['batches']}, "
+                f"фиксаций: {stats['fixations']}, повторов пропущено: "
+                f"{stats['skipped']}\n"
+                f"Повторных попыток: {stats['retried']}, "
+                f"в fixations:dead: {stats['dead_length']} "
+                f"(за сеанс {stats['dead_letters']})\n"
+                f"Последний пакет: {stats['last_batch_size']} "
+                f"({last_flush})\n"
+                f"Ошибок записи: {stats['failures']}", parse_mode="HTML")
+
+
+@router.message(ChatTypeFilter('private'), Command('flood_stats'))
+async def flood_stats(message: Message, command: CommandObject):
+    if await check_chat_existence(message.from_user.id):
+        if message.from_user.id in ADMIN_ID:
+            try:
+                if command.args == 'reset':
+                    await rate_limiter.reset_rejected(storage.redis)
+                rejected = await rate_limiter.get_rejected(storage.redis)
+            except Exception as e:
+                print(e)
+                await message.answer('Не удалось получить счётчики')
+                return
+            interval, burst = rate_limiter.default
+            lines = [f'По умолчанию: {burst} сообщ. за {interval:g} с']
+            lines += [f'{scope}: {limit[1]} за {limit[0]:g} с'
+                      for scope, limit in rate_limiter.limits.items()]
+            lines.append('')
+            lines += [f'{scope}: {count}'
+                      for scope, count in sorted(rejected.items())] \
+                or ['Отклонённых сообщений нет']
+            await message.answer('<b>Антифлуд</b>\n\n' + '\n'.join(lines),
+                                 parse_mode="HTML")
+
+
+@router.message(ChatTypeFilter('private'), Command('photo_stats'))
+async def photo_stats(message: Message):
+    if await check_chat_existence(message.from_user.id):
+        if message.from_user.id in ADMIN_ID:
+            stats = photo_downloader.get_stats()
+            ocr = ocr_pool.get_stats()
+            size = stats['rows'] / stats['count'] / 1024 \
+                if stats['count'] else 0
+            await message.answer(
+                f"<b>Загрузка фотографий</b>\n\n"
+                f"Загружено: {stats['count']}, в среднем {size:.0f} КБ\n"
+                f"Время: среднее {stats['avg_ms']:.0f} мс, "
+                f"p50 {stats['p50_ms']:.0f} мс, p95 {stats['p95_ms']:.0f} мс, "
+                f"макс. {stats['max_ms']:.0f} мс\n"
+                f"Слишком большие: {stats['too_large']}\n"
+                f"Ошибки: {stats['failures']}\n\n"
+                f"<b>Распознавание</b>\n\n"
+                f"Процессов: {ocr_pool.workers}, очередь до "
+                f"{ocr_pool.queue_size}\n"
+                f"В работе: {ocr['pending'] - ocr['queued']}, "
+                f"в очереди: {ocr['queued']}, максимум: "
+                f"{ocr['max_pending']}\n"
+                f"Распознано: {ocr['count']}, время: среднее "
+                f"{ocr['avg_ms']:.0f} мс, p95 {ocr['p95_ms']:.0f} мс\n"
+                f"Отказов «занято»: {ocr['rejected']}, таймаутов: "
+                f"{ocr['timeouts']}, ошибок: {ocr['failures']}, "
+                f"перезапусков: {ocr['restarts']}", parse_mode="HTML")
+
+
+async def suggest_own_plates(number):
+    """Own plates the sender probably meant instead of number.
+
+    :return: Empty list if number is own, archived or no own plate is one
+        edit away
+    """
+    if plate_index.loaded:
+        if plate_index.is_own(number) or plate_index.is_archive(number):
+            return []
+        return plate_index.similar_own(number)
+
+    candidates = await find_similar_plates(number)
+    if not candidates or number in candidates:
+        return []
+    return [candidate for candidate in candidates
+            if levenshtein(number, candidate) == 1]
 
 
-async def get_flood_start_time(s_key):
-    """Get start time of anti-flood for the user.
+async def offer_own_plates(message: Message, number):
+    """Ask the sender whether an own plate was meant instead of number.
 
-    :param s_key: StorageKey instance
-    :return: Start time of anti-flood or None if not in anti-flood
+    :return: True if candidates were offered
     """
-    data = await dp.storage.get_data(key=s_key)
-    if data:
-        return data.get(f'{s_key.user_id}_start')
+    candidates = await suggest_own_plates(number)
+    if not candidates:
+        return False
+    keyboard = await get_keyboard_plate_candidates(number, candidates)
+    await message.answer(
+        f"Номера <b>{number}</b> нет в списке своих. "
+        f"Возможно, Вы имели в виду:", parse_mode="HTML",
+        reply_markup=keyboard)
+    return True
+
+
+async def fix_number(message: Message, tg_user_id, translated_text):
+    if not await claim_fixation(storage.redis, translated_text):
+        await message.answer('Сегодня этот номер уже был зафиксирован')
+        return
+
+    if plate_index.loaded:
+        # Answer from the in-memory index, write the fixation after.
+        is_us_or_not = "🟢" if plate_index.is_own(translated_text) \
+            else "🔴"
+        sent_message = await message.answer(
+            f"Благодарим за отправку автомобильного номера "
+            f"<b>{translated_text}</b> {is_us_or_not}\n\n"
+            f"<i>Время фиксации: {get_time_now()}</i>", parse_mode="HTML")
+        if not (fixation_queue.enabled and
+                await fixation_queue.enqueue(storage.redis, tg_user_id,
+                                             translated_text)):
+            run_in_background(write_fixation(tg_user_id, translated_text,
+                                             sent_message))
+        return
+
+    fixation = await register_fixation(tg_user_id, translated_text)
+    if fixation is None:
+        await release_fixation(storage.redis, translated_text)
+        return
+    is_own, result, last_seconds = fixation
+    is_us_or_not = "🟢" if is_own else "🔴"
+    if result:
+        await message.answer(
+            f"Благодарим за отправку автомобильного номера "
+            f"<b>{translated_text}</b> {is_us_or_not}\n\n"
+            f"<i>Время фиксации: {get_time_now()}</i>", parse_mode="HTML")
+        await record_activity(storage.redis, [tg_user_id])
+    else:
+        await shorten_fixation(storage.redis, translated_text, last_seconds)
+        await message.answer('Сегодня этот номер уже был зафиксирован')
+
+
+EXPORT_USAGE = 'Выгрузка в файл:\n' \
+               '/export foreign — чужие номера\n' \
+               '/export archive — архив номеров\n' \
+               '/export number A542OH99 — фиксации номера\n' \
+               '/export fixations — все фиксации\n\n' \
+               'По умолчанию xlsx, для csv добавьте в конце csv'
+# Telegram bots can send documents up to 50 MB
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+
+def export_source(args):
+    """Query, header and file name for /export arguments, None if unknown."""
+    if not args:
+        return None
+    parking_header = ['Номер', 'Парковок', 'Выходов из архива',
+                      'Первая фиксация', 'Последняя фиксация']
+    if args[0] == 'foreign':
+        return parking_export_query(False, False), parking_header, 'foreign'
+    if args[0] == 'archive':
+        return parking_export_query(False, True), parking_header, 'archive'
+    if args[0] == 'fixations':
+        return fixations_export_query(), ['Дата', 'Номер', 'Свой',
+                                          'Отправитель'], 'fixations'
+    if args[0] == 'number' and len(args) > 1:
+        number = args[1].upper().translate(
+            str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX"))
+        return number_history_query(number), ['Дата', 'Отправитель'], \
+            f'number_{number}'
     return None
 
 
-async def is_flood(bot_id, chat_id, user_id):
-    """Check if the user is in anti-flood.
+@router.message(ChatTypeFilter('private'), Command('export'))
+async def export(message: Message, command: CommandObject):
+    if await check_chat_existence(message.from_user.id):
+        if message.from_user.id in ADMIN_ID:
+            args = (command.args or '').split()
+            file_format = 'csv' if args and args[-1] == 'csv' else 'xlsx'
+            if file_format == 'csv':
+                args = args[:-1]
+            source = export_source(args)
+            if source is None:
+                await message.answer(EXPORT_USAGE)
+                return
+            query, header, name = source
+
+            await message.answer('Готовлю файл, это может занять время')
+            file_name = f'{name}_{datetime.now():%Y%m%d_%H%M}' \
+                        f'{EXPORT_EXTENSIONS[file_format]}'
+            handle, path = tempfile.mkstemp(
+                suffix=EXPORT_EXTENSIONS[file_format])
+            os.close(handle)
+            try:
+                count = await export_rows(path, header,
+                                          stream_partitions(query),
+                                          file_format)
+                if os.path.getsize(path) > EXPORT_MAX_BYTES:
+                    await message.answer(
+                        'Файл больше 50 МБ и не может быть отправлен. '
+                        'Попробуйте формат csv.')
+                    return
+                await message.answer_document(
+                    types.FSInputFile(path, filename=file_name),
+                    caption=f'Строк: {compare_count(count)}')
+            except Exception as e:
+                print(e)
+                await message.answer('Не удалось сформировать файл')
+            finally:
+                os.remove(path)
+        else:
+            await message.answer('У Вас нет доступа к команде!')
 
-    :param bot_id: Bot id
-    :param chat_id: Chat id
-    :param user_id: User id
-    :return: True if flood, False otherwise
-    """
-    s_key = StorageKey(bot_id=bot_id, chat_id=chat_id,
-                       user_id=user_id)
 
-    start_time = await get_flood_start_time(s_key)
-    if start_time is None or start_time < int(time.time()):
-        await update_flood_start_time(s_key)
-        return False
-    return True
+def template_db_stats():
+    pool = get_pool_stats()
+    text = f"<b>Запросы к базе</b>\n\n" \
+           f"Замер: {'включён' if instrumentation.enabled else 'выключен'}, " \
+           f"медленные от {instrumentation.slow_query_ms:.0f} мс: " \
+           f"{instrumentation.slow_queries}\n" \
+           f"Пул: выдано {pool['checkouts']}, ожидание ср. " \
+           f"{pool['wait_avg'] * 1000:.1f} мс, макс. " \
+           f"{pool['wait_max'] * 1000:.1f} мс\n\n"
+
+    text += "<b>Функции</b> (вызовов, ср./p95/макс. мс)\n"
+    for name, stats in instrumentation.top(instrumentation.functions):
+        text += f"{name}: {stats['count']}, {stats['avg_ms']:.1f}/" \
+                f"{stats['p95_ms']:.0f}/{stats['max_ms']:.1f}\n"
+
+    text += "\n<b>Запросы</b> (вызовов, ср./p95 мс, строк)\n"
+    for statement, stats in instrumentation.top(instrumentation.statements,
+                                                limit=5):
+        text += f"<code>{html.escape(statement[:80])}</code>\n" \
+                f"{stats['count']}, {stats['avg_ms']:.1f}/" \
+                f"{stats['p95_ms']:.0f}, {stats['rows']}\n"
+    return text
+
+
+@router.message(ChatTypeFilter('private'), Command('db_stats'))
+async def db_stats(message: Message, command: CommandObject):
+    if await check_chat_existence(message.from_user.id):
+        if message.from_user.id in ADMIN_ID:
+            if command.args == 'on':
+                instrumentation.enable()
+            elif command.args == 'off':
+                instrumentation.disable()
+            elif command.args == 'reset':
+                instrumentation.reset()
+            await message.answer(template_db_stats(), parse_mode="HTML")
+        else:
+            await message.answer('У Вас нет доступа к команде!')
 
 
-@dp.message.outer_middleware()
+@router.message(ChatTypeFilter('private'), F.text)
+async def handle_auto_number(message: Message):
+    if await check_chat_existence(message.from_user.id):
+        pattern = r'^(?:[А-ЯA-Z]|[а-яa-z])\d{3}' \
+                  r'(?:[А-ЯA-Z]|[а-яa-z]){2}\d{1,3}$'
+        if re.match(pattern, message.text) is not None:
+            translation_table = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+            number = message.text.upper()
+            translated_text = number.translate(translation_table)
+
+            if await offer_own_plates(message, translated_text):
+                return
+
+            await fix_number(message, message.from_user.id, translated_text)
+        else:
+            await message.answer(
+                f"<b>Ошибка!</b>\nВы ввели: <b>{message.text}</b>"
+                f"\nПринимаются номера только "
+                f"российского формата. Повторите ввод.", parse_mode="HTML")
+
+
+@router.callback_query(F.data.startswith('confirm_plate:'))
+async def confirm_plate(query: types.CallbackQuery):
+    if await check_chat_existence(query.from_user.id):
+        number = query.data.split(':', 1)[1]
+        if re.match(r'^[ABEKMHOPCTYX]\d{3}[ABEKMHOPCTYX]{2}\d{1,3}$',
+                    number) is None:
+            return
+        try:
+            await query.message.delete()
+        except exceptions.TelegramBadRequest as e:
+            print(e)
+        await fix_number(query.message, query.from_user.id, number)
+        await query.answer()
+
+
+@router.message.outer_middleware()
 async def anti_flood(
         handler: Callable[[Message, dict[str, Any]], Awaitable[Any]],
         event: Message,
@@ -494,20 +831,23 @@ async def anti_flood(
     :param data: dict[str, Any]
     :return: await handler(event, data)
     """
-    status_flood = await is_flood(bot.id, event.chat.id, event.from_user.id)
+    allowed = await rate_limiter.hit(storage.redis, event.chat.id,
+                                     event.from_user.id,
+                                     rate_limiter.scope(event))
 
-    if status_flood:
+    if not allowed:
         return
 
     return await handler(event, data)
 
 
-@dp.callback_query(
-    F.data.in_({'plate_numbers', 'numbers_left', 'numbers_right'}))
+@router.callback_query(
+    F.data.startswith(('plate_numbers', 'numbers_left', 'numbers_right')))
 async def plate_numbers(query: types.CallbackQuery,
                         state: FSMContext):
     await state.update_data(message_id=query.message.message_id)
-    if query.data == "plate_numbers":
+    action, cursor = decode_cursor(query.data)
+    if action == "plate_numbers":
         current_page = 1
         await state.update_data({f'{query.message.message_id}': current_page})
         keyboard = await get_add_plate_keyboard(False, False, current_page)
@@ -515,7 +855,7 @@ async def plate_numbers(query: types.CallbackQuery,
         await refresh_keyboard(bot, query.message.chat.id,
                                query.message.message_id, keyboard)
 
-    elif query.data == "numbers_left":
+    elif action == "numbers_left":
         data = await state.get_data()
         cp = data.get(f'{query.message.message_id}')
         is_own = data.get(f'{query.message.message_id}_is_own')
@@ -524,12 +864,13 @@ async def plate_numbers(query: types.CallbackQuery,
             cp -= 1
             await state.update_data({f'{query.message.message_id}': cp})
 
-        keyboard = await get_add_plate_keyboard(is_own, is_archive, cp)
+        keyboard = await get_add_plate_keyboard(is_own, is_archive, cp,
+                                                before=cursor)
 
         await refresh_keyboard(bot, query.message.chat.id,
                                query.message.message_id, keyboard)
 
-    elif query.data == "numbers_right":
+    elif action == "numbers_right":
         data = await state.get_data()
         cp = data.get(f'{query.message.message_id}')
         is_own = data.get(f'{query.message.message_id}_is_own')
@@ -537,73 +878,143 @@ async def plate_numbers(query: types.CallbackQuery,
 
         cp += 1
         await state.update_data({f'{query.message.message_id}': cp})
-        keyboard = await get_add_plate_keyboard(is_own, is_archive, cp)
+        keyboard = await get_add_plate_keyboard(is_own, is_archive, cp,
+                                                after=cursor)
         await refresh_keyboard(bot, query.message.chat.id,
                                query.message.message_id, keyboard)
 
 
-@dp.callback_query(F.data.in_({'stat_numbers_left', 'stat_numbers_right'}))
+@router.callback_query(F.data.startswith(('stat_numbers_left',
+                                      'stat_numbers_right')))
 async def stat_numbers_arrow(query: types.CallbackQuery, state: FSMContext):
     if await check_chat_existence(query.from_user.id):
-        if query.data == 'stat_numbers_left':
+        action, cursor = decode_cursor(query.data, str)
+        cursor = cursor[0] if cursor else None
+        if action == 'stat_numbers_left':
             data = await state.get_data()
             cp = data.get(f'{query.message.message_id}')
             if cp > 1:
                 cp -= 1
                 await state.update_data({f'{query.message.message_id}': cp})
 
-            text = await template_stat_numbers(cp)
+            text, first_key, last_key, total_days = \
+                await template_stat_numbers(before=cursor)
 
-            keyboard = await get_keyboard_stat_numbers(cp)
+            keyboard = await get_keyboard_stat_numbers(cp, first_key,
+                                                       last_key, total_days)
 
             await refresh_keyboard_and_text(bot, query.message.chat.id,
                                    query.message.message_id, text, keyboard)
 
-        elif query.data == "stat_numbers_right":
+        elif action == "stat_numbers_right":
             data = await state.get_data()
             cp = data.get(f'{query.message.message_id}')
 
             cp += 1
             await state.update_data({f'{query.message.message_id}': cp})
-            text = await template_stat_numbers(cp)
-            keyboard = await get_keyboard_stat_numbers(cp)
+            text, first_key, last_key, total_days = \
+                await template_stat_numbers(after=cursor)
+            keyboard = await get_keyboard_stat_numbers(cp, first_key,
+                                                       last_key, total_days)
             await refresh_keyboard_and_text(bot, query.message.chat.id,
                                             query.message.message_id, text,
                                             keyboard)
 
 
-@dp.callback_query(F.data.in_({'upload_excel_left', 'upload_excel_right'}))
+@router.callback_query(F.data.startswith(('upload_excel_left',
+                                      'upload_excel_right')))
 async def upload_excel_arrow(query: types.CallbackQuery, state: FSMContext):
     if await check_chat_existence(query.from_user.id):
-        if query.data == 'upload_excel_left':
+        action, cursor = decode_cursor(query.data)
+        if action == 'upload_excel_left':
             data = await state.get_data()
             cp = data.get(f'{query.message.message_id}')
             if cp > 1:
                 cp -= 1
                 await state.update_data({f'{query.message.message_id}': cp})
 
-            text = await template_upload_excel_log(cp)
+            text, first_key, last_key, total_upload, diffs = \
+                await template_upload_excel_log(before=cursor)
 
-            keyboard = await get_keyboard_upload_excel(cp)
+            keyboard = await get_keyboard_upload_excel(cp, first_key,
+                                                       last_key, total_upload,
+                                                       diffs)
 
             await refresh_keyboard_and_text(bot, query.message.chat.id,
                                             query.message.message_id, text,
                                             keyboard, "markdown")
 
-        elif query.data == "upload_excel_right":
+        elif action == "upload_excel_right":
             data = await state.get_data()
             cp = data.get(f'{query.message.message_id}')
 
             cp += 1
             await state.update_data({f'{query.message.message_id}': cp})
-            text = await template_upload_excel_log(cp)
-            keyboard = await get_keyboard_upload_excel(cp)
+            text, first_key, last_key, total_upload, diffs = \
+                await template_upload_excel_log(after=cursor)
+            keyboard = await get_keyboard_upload_excel(cp, first_key,
+                                                       last_key, total_upload,
+                                                       diffs)
             await refresh_keyboard_and_text(bot, query.message.chat.id,
                                             query.message.message_id, text,
                                             keyboard, "markdown")
 
 
-@dp.callback_query(F.data.startswith('get_numbers_data:'))
+async def template_excel_log_items(excel_log_id, action, after=None,
+                                   before=None):
+    numbers, total_items = await get_excel_log_items(
+        excel_log_id, action, after=after, before=before)
+    title = 'Добавленные номера' if action == 'ADD' else 'Удалённые номера'
+    text = f"<b>{title}</b> ({total_items})\n\n" + '\n'.join(numbers)
+    first_key = numbers[0] if numbers else None
+    last_key = numbers[-1] if numbers else None
+    return text, first_key, last_key, total_items
+
+
+@router.callback_query(F.data.startswith('excel_log_items:'))
+async def excel_log_items(query: types.CallbackQuery, state: FSMContext):
+    if await check_chat_existence(query.from_user.id):
+        _, excel_log_id, action = query.data.split(':')
+        text, first_key, last_key, total_items = \
+            await template_excel_log_items(int(excel_log_id), action)
+        keyboard = await get_keyboard_excel_log_items(
+            excel_log_id, action, 1, first_key, last_key, total_items)
+        sent_message = await query.message.answer(text=text,
+                                                  parse_mode="HTML",
+                                                  reply_markup=keyboard)
+        await state.update_data({f'{sent_message.message_id}': 1})
+        await query.answer()
+
+
+@router.callback_query(F.data.startswith(('excel_items_left',
+                                      'excel_items_right')))
+async def excel_log_items_arrow(query: types.CallbackQuery,
+                                state: FSMContext):
+    if await check_chat_existence(query.from_user.id):
+        action, cursor = decode_cursor(query.data, cast=str)
+        if cursor is None:
+            return
+        excel_log_id, item_action, number = cursor
+        data = await state.get_data()
+        cp = data.get(f'{query.message.message_id}', 1)
+        if action == 'excel_items_left':
+            cp = max(cp - 1, 1)
+            page = await template_excel_log_items(
+                int(excel_log_id), item_action, before=[number])
+        else:
+            cp += 1
+            page = await template_excel_log_items(
+                int(excel_log_id), item_action, after=[number])
+        await state.update_data({f'{query.message.message_id}': cp})
+        text, first_key, last_key, total_items = page
+        keyboard = await get_keyboard_excel_log_items(
+            excel_log_id, item_action, cp, first_key, last_key, total_items)
+        await refresh_keyboard_and_text(bot, query.message.chat.id,
+                                        query.message.message_id, text,
+                                        keyboard)
+
+
+@router.callback_query(F.data.startswith('get_numbers_data:'))
 async def numbers_detail(query: types.CallbackQuery):
     if await check_chat_existence(query.from_user.id):
         data = query.data.split(':')
@@ -633,7 +1044,7 @@ async def numbers_detail(query: types.CallbackQuery):
                 ))
 
 
-@dp.callback_query(F.data.startswith('info_change_log'))
+@router.callback_query(F.data.startswith('info_change_log'))
 async def info_log_change_number(query: types.CallbackQuery):
     if await check_chat_existence(query.from_user.id):
         data = query.data.split(':')
@@ -648,11 +1059,12 @@ async def info_log_change_number(query: types.CallbackQuery):
         text = f'История действий с номером <b>{number_plate}</b>\n\n'
 
         user_ids = {}
+        chats = await resolve_chats([story[0] for story in result])
 
         for story in result:
             if user_ids.get(str(story[0])) is None:
                 ##
-                chat = await check_chat_existence(story[0])
+                chat = chats[story[0]]
                 if chat:
                     if chat.type == 'private':
                         user_ids[f'{story[0]}'] = chat.first_name
@@ -672,7 +1084,7 @@ async def info_log_change_number(query: types.CallbackQuery):
         await bot.send_message(chat_id=query.from_user.id, text=text, parse_mode="HTML")
 
 
-@dp.callback_query(F.data.startswith('add_archive:'))
+@router.callback_query(F.data.startswith('add_archive:'))
 async def set_archive(query: types.CallbackQuery):
     if await check_chat_existence(query.from_user.id):
         data = query.data.split(':')
@@ -691,7 +1103,7 @@ async def set_archive(query: types.CallbackQuery):
                 parse_mode="HTML")
 
 
-@dp.callback_query(F.data.startswith('confirm_add_archive_btn:'))
+@router.callback_query(F.data.startswith('confirm_add_archive_btn:'))
 async def confirm_set_archive(query: types.CallbackQuery):
     if await check_chat_existence(query.from_user.id):
         data = query.data.split(':')
@@ -705,12 +1117,13 @@ async def confirm_set_archive(query: types.CallbackQuery):
                                    parse_mode='HTML')
         else:
             await set_archive_db(query.from_user.id, number_plate)
+            await plate_index.publish_change(storage.redis)
 
             await bot.send_message(chat_id=query.from_user.id,
                                    text=f'Номер <b>{number_plate}</b> был добавлен в архив!', parse_mode='HTML')
 
 
-@dp.callback_query(F.data.startswith('disable_add_archive_btn:'))
+@router.callback_query(F.data.startswith('disable_add_archive_btn:'))
 async def disable_set_archive(query: types.CallbackQuery):
     if await check_chat_existence(query.from_user.id):
         data = query.data.split(':')
@@ -721,7 +1134,6 @@ async def disable_set_archive(query: types.CallbackQuery):
 
 
 async def send_day_stat():
-    users = await get_active_users()
     actual_day, today_numbers, all_numbers, other_numbers = \
         await get_end_day_stats()
     # for user in users:
@@ -755,34 +1167,224 @@ async def send_day_stat():
 
 async def scheduler():
     aioschedule.every().day.at("23:59").do(send_day_stat)
+    aioschedule.every().day.at("03:00").do(maintain_log_history)
+    aioschedule.every().hour.do(reconcile_activity, storage.redis)
     while True:
         await aioschedule.run_pending()
         await asyncio.sleep(1)
 
 
+async def report_schema_state():
+    """Warn about pending migrations and missing or invalid indexes.
+
+    Upcoming log_history partitions are created once the schema is current.
+    """
+    try:
+        pending = await get_pending_migrations()
+        if pending:
+            logging.warning('Не применены миграции: %s. Запустите '
+                            'python -m db.migrations',
+                            ', '.join(f'{m.version}_{m.name}'
+                                      for m in pending))
+        else:
+            await ensure_partitions()
+        for table, index in await check_indexes():
+            logging.warning('Отсутствует или не построен индекс %s '
+                            'в таблице %s', index, table)
+    except Exception as e:
+        print(e)
+
+
 async def on_startup():
     print('Bot is start')
+    init_engine()
+    await report_schema_state()
+    try:
+        await plate_index.load(storage.redis)
+        await warm_fixation_window(storage.redis)
+        await ensure_activity_board(storage.redis)
+    except Exception as e:
+        print(e)
+    asyncio.create_task(plate_index.listen(storage.redis))
+    ocr_pool.start()
+    if fixation_queue.enabled:
+        global fixation_consumer
+        fixation_consumer = asyncio.create_task(
+            fixation_queue.consume(storage.redis))
     asyncio.create_task(scheduler())
     await set_commands()
 
 
 async def on_shutdown(dp):
+    if fixation_consumer is not None:
+        fixation_consumer.cancel()
+        await asyncio.wait([fixation_consumer])
+        await fixation_queue.drain(storage.redis)
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=10)
+    ocr_pool.shutdown()
     await dp.storage.close()
     await bot.session.close()
+    await dispose_engine()
 
 
-async def check_chat_existence(chat_id):
+async def fetch_chat(chat_id):
     try:
-        chat = await bot.get_chat(chat_id)
-        return chat
+        return await bot.get_chat(chat_id)
     except (exceptions.TelegramBadRequest, exceptions.TelegramNotFound):
-        return False
+        return None
+
+
+async def check_chat_existence(chat_id):
+    return await chat_cache.get(storage.redis, chat_id) or False
+
+
+async def resolve_chats(chat_ids):
+    """Chats of many users at once, see ChatCache.resolve_chats."""
+    return await chat_cache.resolve_chats(storage.redis, chat_ids)
+
+
+async def process_update(update, semaphore):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        print(e)
+    finally:
+        semaphore.release()
+
+
+def make_webhook_app(secret_token, concurrency):
+    """aiohttp application that accepts updates from Telegram.
+
+    An update is answered as soon as it is taken for processing. While
+    concurrency updates are being processed the next request waits for
+    a slot, so Telegram backs off instead of tasks piling up here.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    draining = asyncio.Event()
+
+    async def handle_update(request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, secret_token):
+            return web.Response(status=401)
+        if draining.is_set():
+            # Telegram retries the update after the restart
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await semaphore.acquire()
+        if draining.is_set():
+            semaphore.release()
+            return web.Response(status=503)
+        run_in_background(process_update(update, semaphore))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app['draining'] = draining
+    return app
+
+
+async def run_webhook():
+    secret_token = config.get('webhook', 'secret_token',
+                              fallback=None) or secrets.token_urlsafe(32)
+    app = make_webhook_app(
+        secret_token, config.getint('webhook', 'concurrency', fallback=20))
+    # Telegram keeps delivering to the registered URL, so the endpoint is
+    # opened only when everything the handlers use is up
+    await on_startup()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner,
+                       config.get('webhook', 'host', fallback='127.0.0.1'),
+                       config.getint('webhook', 'port', fallback=8080))
+    await site.start()
+    await bot.set_webhook(
+        config['webhook']['url'].rstrip('/') + WEBHOOK_PATH,
+        secret_token=secret_token,
+        max_connections=config.getint('webhook', 'max_connections',
+                                      fallback=40),
+        allowed_updates=dp.resolve_used_update_types())
+    logging.info('Webhook: приём обновлений на %s', WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except NotImplementedError:
+            pass  # Windows, KeyboardInterrupt cancels the wait instead
+    try:
+        await stop.wait()
+    finally:
+        app['draining'].set()
+        pending = set(background_tasks)
+        if pending:
+            logging.info('Webhook: завершение %s обновлений', len(pending))
+            await asyncio.wait(pending, timeout=config.getfloat(
+                'webhook', 'drain_timeout', fallback=30))
+        await runner.cleanup()
+
+
+def setup():
+    """Read config.ini and create the bot, its storage and helpers."""
+    global bot, storage, dp, fixation_queue, rate_limiter, \
+        photo_downloader, ocr_pool, chat_cache, WEBHOOK_PATH
+    config.read('config.ini')
+    logging.basicConfig(level=logging.INFO)
+
+    fixation_queue = FixationQueue(
+        enabled=config.getboolean('write_behind', 'enabled', fallback=False),
+        batch_size=config.getint('write_behind', 'batch_size', fallback=100),
+        max_delay=config.getfloat('write_behind', 'max_delay', fallback=0.5),
+        claim_idle=config.getfloat('write_behind', 'claim_idle',
+                                   fallback=60),
+        max_deliveries=config.getint('write_behind', 'max_deliveries',
+                                     fallback=5))
+    fixation_queue.on_batch = on_fixation_batch
+
+    rate_limiter = RateLimiter.from_config(config)
+
+    photo_downloader = PhotoDownloader(
+        max_bytes=config.getint('photo', 'max_bytes',
+                                fallback=PHOTO_MAX_BYTES),
+        timeout=config.getfloat('photo', 'download_timeout',
+                                fallback=PHOTO_DOWNLOAD_TIMEOUT))
+
+    ocr_pool = OcrPool(
+        recognize_plate, initializer=init_worker,
+        workers=config.getint('ocr', 'workers', fallback=2),
+        queue_size=config.getint('ocr', 'queue_size', fallback=8),
+        timeout=config.getfloat('ocr', 'timeout', fallback=20))
+
+    chat_cache = ChatCache(
+        fetch_chat,
+        ttl=config.getint('chat_cache', 'ttl', fallback=3600),
+        negative_ttl=config.getint('chat_cache', 'negative_ttl',
+                                   fallback=300),
+        maxsize=config.getint('chat_cache', 'maxsize', fallback=10000),
+        concurrency=config.getint('chat_cache', 'concurrency', fallback=10))
+
+    WEBHOOK_PATH = config.get('webhook', 'path', fallback='/webhook')
+
+    bot = Bot(config['BOT']['bot_token'])
+    storage = RedisStorage.from_url(config['redis']['redis_data_conn'])
+    dp = Dispatcher(storage=storage)
+    dp.include_router(router)
 
 
 async def main():
-    dp.startup.register(on_startup)
+    setup()
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if config.getboolean('webhook', 'enabled', fallback=False):
+            await run_webhook()
+        else:
+            dp.startup.register(on_startup)
+            await bot.delete_webhook()
+            await dp.start_polling(
+                bot, allowed_updates=dp.resolve_used_update_types())
     finally:
         await on_shutdown(dp)
 
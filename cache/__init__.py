@@ -0,0 +1,13 @@
+from .plate_index import plate_index, PlateIndex
+from .fixation_window import claim_fixation, release_fixation, \
+    shorten_fixation, warm_fixation_window
+from .fixation_queue import FixationQueue
+from .activity_board import record_activity, get_activity_page, \
+    reconcile_activity, ensure_activity_board
+from .chat_cache import ChatCache, ChatInfo
+from .rate_limiter import RateLimiter
+
+__all__ = ['plate_index', 'PlateIndex', 'claim_fixation', 'release_fixation',
+           'shorten_fixation', 'warm_fixation_window', 'FixationQueue',
+           'record_activity', 'get_activity_page', 'reconcile_activity',
+           'ensure_activity_board', 'ChatCache', 'ChatInfo', 'RateLimiter']
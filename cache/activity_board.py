@@ -0,0 +1,66 @@
+import logging
+from collections import Counter
+
+from db import get_general_activity
+
+ACTIVITY_BOARD_KEY = 'activity:leaderboard'
+
+
+async def record_activity(redis, tg_user_ids):
+    """Count accepted fixations of the given users.
+
+    :param tg_user_ids: One id per accepted fixation
+    """
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for tg_user_id, count in Counter(tg_user_ids).items():
+            pipe.zincrby(ACTIVITY_BOARD_KEY, count, tg_user_id)
+        await pipe.execute()
+    except Exception as e:
+        print(e)
+
+
+async def get_activity_page(redis, page, limit):
+    """Users sorted by fixations, page counts from 1.
+
+    :return: (list of (tg_user_id, count), total_users)
+    """
+    start = (page - 1) * limit
+    pipe = redis.pipeline(transaction=False)
+    pipe.zrevrange(ACTIVITY_BOARD_KEY, start, start + limit - 1,
+                   withscores=True)
+    pipe.zcard(ACTIVITY_BOARD_KEY)
+    rows, total_users = await pipe.execute()
+    return [(int(member), int(score)) for member, score in rows], total_users
+
+
+async def reconcile_activity(redis):
+    """Replace the leaderboard with counts from Postgres.
+
+    The board is built under a temporary key and swapped in with RENAME,
+    readers never see a half-filled set. Increments made while the query
+    runs can be lost, the next reconciliation restores them.
+
+    :return: Number of users on the board
+    """
+    users = await get_general_activity()
+    if users is None:
+        return None
+    if not users:
+        await redis.delete(ACTIVITY_BOARD_KEY)
+        return 0
+    temporary_key = f'{ACTIVITY_BOARD_KEY}:rebuild'
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(temporary_key)
+    pipe.zadd(temporary_key, {tg_user_id: count
+                              for tg_user_id, count in users})
+    pipe.rename(temporary_key, ACTIVITY_BOARD_KEY)
+    await pipe.execute()
+    logging.info('Рейтинг активности сверен: %s пользователей', len(users))
+    return len(users)
+
+
+async def ensure_activity_board(redis):
+    """Fill the leaderboard on startup if Redis lost it."""
+    if not await redis.exists(ACTIVITY_BOARD_KEY):
+        await reconcile_activity(redis)
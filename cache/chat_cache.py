@@ -0,0 +1,144 @@
+import json
+import asyncio
+from time import monotonic
+from collections import OrderedDict
+
+CHAT_CACHE_PREFIX = 'chat_info:'
+CHAT_FIELDS = ('id', 'type', 'first_name', 'last_name', 'username', 'title')
+
+
+class ChatInfo:
+    """The fields of a Telegram chat the bot shows in its messages."""
+
+    __slots__ = CHAT_FIELDS
+
+    def __init__(self, id, type, first_name=None, last_name=None,
+                 username=None, title=None):
+        self.id = id
+        self.type = type
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        self.title = title
+
+    @classmethod
+    def from_chat(cls, chat):
+        return cls(*(getattr(chat, field, None) for field in CHAT_FIELDS))
+
+    def dumps(self):
+        return json.dumps({field: getattr(self, field)
+                           for field in CHAT_FIELDS})
+
+
+class ChatCache:
+    """Chat lookups cached in process (LRU) and in Redis.
+
+    Missing chats are cached too, for negative_ttl seconds, so a user who
+    blocked the bot does not cost a request on every mention.
+    """
+
+    def __init__(self, fetch, ttl=3600, negative_ttl=300, maxsize=10000,
+                 concurrency=10):
+        """
+        :param fetch: Coroutine function chat_id -> chat or None if the
+            chat does not exist, other errors are not cached
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.local = OrderedDict()
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'fetches': 0}
+
+    def _get_local(self, chat_id):
+        entry = self.local.get(chat_id)
+        if entry is None:
+            return False, None
+        expires_at, chat = entry
+        if expires_at < monotonic():
+            del self.local[chat_id]
+            return False, None
+        self.local.move_to_end(chat_id)
+        return True, chat
+
+    def _set_local(self, chat_id, chat):
+        ttl = self.ttl if chat is not None else self.negative_ttl
+        self.local[chat_id] = (monotonic() + ttl, chat)
+        self.local.move_to_end(chat_id)
+        while len(self.local) > self.maxsize:
+            self.local.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        self.local.pop(chat_id, None)
+
+    async def _fetch(self, chat_id):
+        async with self.semaphore:
+            self.stats['fetches'] += 1
+            chat = await self.fetch(chat_id)
+        return ChatInfo.from_chat(chat) if chat is not None else None
+
+    async def get(self, redis, chat_id):
+        """:return: ChatInfo or None if the chat does not exist"""
+        return (await self.resolve_chats(redis, [chat_id]))[chat_id]
+
+    async def resolve_chats(self, redis, chat_ids):
+        """Look up many chats, misses are fetched concurrently.
+
+        :return: dict chat_id -> ChatInfo or None
+        """
+        found = {}
+        missing = []
+        for chat_id in dict.fromkeys(chat_ids):
+            hit, chat = self._get_local(chat_id)
+            if hit:
+                self.stats['local_hits'] += 1
+                found[chat_id] = chat
+            else:
+                missing.append(chat_id)
+        if not missing:
+            return found
+
+        try:
+            cached = await redis.mget([f'{CHAT_CACHE_PREFIX}{chat_id}'
+                                       for chat_id in missing])
+        except Exception as e:
+            print(e)
+            cached = [None] * len(missing)
+        to_fetch = []
+        for chat_id, value in zip(missing, cached):
+            if value is None:
+                to_fetch.append(chat_id)
+                continue
+            self.stats['redis_hits'] += 1
+            fields = json.loads(value)
+            chat = ChatInfo(**fields) if fields else None
+            self._set_local(chat_id, chat)
+            found[chat_id] = chat
+        if not to_fetch:
+            return found
+
+        results = await asyncio.gather(
+            *(self._fetch(chat_id) for chat_id in to_fetch),
+            return_exceptions=True)
+        fetched = {}
+        for chat_id, chat in zip(to_fetch, results):
+            if isinstance(chat, Exception):
+                # a network error says nothing about the chat, not cached
+                print(chat)
+                found[chat_id] = None
+                continue
+            self._set_local(chat_id, chat)
+            found[chat_id] = fetched[chat_id] = chat
+
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for chat_id, chat in fetched.items():
+                pipe.set(f'{CHAT_CACHE_PREFIX}{chat_id}',
+                         chat.dumps() if chat is not None else '{}',
+                         ex=self.ttl if chat is not None
+                         else self.negative_ttl)
+            await pipe.execute()
+        except Exception as e:
+            print(e)
+        return found
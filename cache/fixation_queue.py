@@ -0,0 +1,219 @@
+import os
+import time
+import socket
+import asyncio
+
+from redis.exceptions import ResponseError
+
+from db import register_fixations_batch
+
+FIXATION_STREAM = 'fixations'
+FIXATION_GROUP = 'fixation_writers'
+# entries that failed max_deliveries times, kept for manual inspection
+FIXATION_DEAD_STREAM = 'fixations:dead'
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def entry_time(entry_id):
+    """Epoch seconds when a stream entry was added, taken from its id."""
+    return int(_decode(entry_id).split('-')[0]) / 1000
+
+
+def entry_age(entry_id):
+    """Seconds since a stream entry was added."""
+    return max(time.time() - entry_time(entry_id), 0.0)
+
+
+class FixationQueue:
+    """Write-behind queue of fixations on a Redis Stream.
+
+    The handler appends a fixation and answers at once, a consumer task
+    drains the stream in batches and writes each batch in one transaction.
+    Entries are acknowledged and deleted only after the commit, so delivery
+    is at-least-once. A fixation keeps the time of its entry id as
+    record_date, a replayed entry collides with the written row and is
+    skipped. An entry that fails on its own is left pending and moved to
+    FIXATION_DEAD_STREAM after max_deliveries attempts.
+    """
+
+    def __init__(self, enabled=False, batch_size=100, max_delay=0.5,
+                 claim_idle=60, max_deliveries=5, consumer=None):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.stats = {'batches': 0, 'fixations': 0, 'skipped': 0,
+                      'failures': 0, 'retried': 0, 'dead_letters': 0,
+                      'last_batch_size': 0, 'last_flush': None}
+        self.on_batch = None
+
+    async def ensure_group(self, redis):
+        try:
+            await redis.xgroup_create(FIXATION_STREAM, FIXATION_GROUP,
+                                      id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def enqueue(self, redis, tg_user_id, number):
+        """Append a fixation to the stream.
+
+        :return: False if Redis is unavailable and the caller must write
+            the fixation itself
+        """
+        try:
+            # no MAXLEN: trimming could drop entries that were never
+            # written, flush deletes entries once they are committed
+            await redis.xadd(FIXATION_STREAM,
+                             {'tg_user_id': tg_user_id, 'number': number})
+        except Exception as e:
+            print(e)
+            return False
+        return True
+
+    async def read_batch(self, redis):
+        """Collect up to batch_size entries, waiting at most max_delay."""
+        batch = []
+        claimed = await redis.xautoclaim(
+            FIXATION_STREAM, FIXATION_GROUP, self.consumer,
+            min_idle_time=int(self.claim_idle * 1000), start_id='0-0',
+            count=self.batch_size)
+        batch.extend(claimed[1])
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.batch_size:
+            block = int((deadline - loop.time()) * 1000)
+            if block <= 0:
+                break
+            response = await redis.xreadgroup(
+                FIXATION_GROUP, self.consumer, {FIXATION_STREAM: '>'},
+                count=self.batch_size - len(batch), block=block)
+            if not response:
+                break
+            batch.extend(response[0][1])
+        return batch
+
+    async def deliveries(self, redis, entry_id):
+        """How many times an entry was delivered to the group."""
+        pending = await redis.xpending_range(
+            FIXATION_STREAM, FIXATION_GROUP, min=entry_id, max=entry_id,
+            count=1)
+        return pending[0]['times_delivered'] if pending else 0
+
+    async def flush(self, redis, batch):
+        """Write a batch and acknowledge what is done with.
+
+        :return: False if some entries were left pending
+        """
+        entries = []
+        fixations = []
+        for entry_id, fields in batch:
+            fields = {_decode(key): _decode(value)
+                      for key, value in fields.items()}
+            entries.append((entry_id, fields))
+            fixations.append((int(fields['tg_user_id']), fields['number'],
+                              entry_time(entry_id)))
+
+        result = await register_fixations_batch(fixations)
+        if result is None:
+            # Left pending, the batch is claimed again after claim_idle.
+            self.stats['failures'] += 1
+            return False
+        written, failed = result
+
+        retry = set()
+        dead = 0
+        pipe = redis.pipeline(transaction=True)
+        for position in failed:
+            entry_id, fields = entries[position]
+            deliveries = await self.deliveries(redis, entry_id)
+            if deliveries < self.max_deliveries:
+                retry.add(position)
+                continue
+            pipe.xadd(FIXATION_DEAD_STREAM,
+                      {**fields, 'entry_id': _decode(entry_id),
+                       'deliveries': deliveries})
+            dead += 1
+        self.stats['dead_letters'] += dead
+        self.stats['retried'] += len(retry)
+
+        done = [entry_id for position, (entry_id, _) in enumerate(entries)
+                if position not in retry]
+        if done:
+            pipe.xack(FIXATION_STREAM, FIXATION_GROUP, *done)
+            pipe.xdel(FIXATION_STREAM, *done)
+        await pipe.execute()
+        self.stats['batches'] += 1
+        self.stats['fixations'] += len(written)
+        self.stats['skipped'] += len(done) - len(written) - dead
+        self.stats['last_batch_size'] = len(fixations)
+        self.stats['last_flush'] = time.time()
+        if self.on_batch is not None and written:
+            await self.on_batch([fixations[position] for position in written])
+        return not retry
+
+    async def flush_pending(self, redis):
+        """Write entries delivered to this consumer but not acknowledged."""
+        while True:
+            response = await redis.xreadgroup(
+                FIXATION_GROUP, self.consumer, {FIXATION_STREAM: '0'},
+                count=self.batch_size)
+            if not response or not response[0][1]:
+                return
+            if not await self.flush(redis, response[0][1]):
+                return
+
+    async def consume(self, redis):
+        """Drain the stream until cancelled."""
+        await self.ensure_group(redis)
+        # Entries read before a restart come first.
+        await self.flush_pending(redis)
+        while True:
+            try:
+                batch = await self.read_batch(redis)
+                if batch and not await self.flush(redis, batch):
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(e)
+                await asyncio.sleep(1)
+
+    async def drain(self, redis):
+        """Write what was already read, called on shutdown."""
+        try:
+            await self.flush_pending(redis)
+        except Exception as e:
+            print(e)
+
+    async def get_stats(self, redis):
+        """Queue length, consumer lag and counters of this process.
+
+        :return: dict, lag_seconds is the age of the oldest unwritten entry
+        """
+        stats = dict(self.stats)
+        stats['length'] = await redis.xlen(FIXATION_STREAM)
+        stats['dead_length'] = await redis.xlen(FIXATION_DEAD_STREAM)
+        summary = await redis.xpending(FIXATION_STREAM, FIXATION_GROUP)
+        stats['pending'] = summary['pending']
+        oldest = summary['min'] if summary['pending'] else None
+
+        groups = await redis.xinfo_groups(FIXATION_STREAM)
+        for group in groups:
+            if _decode(group['name']) == FIXATION_GROUP:
+                stats['lag'] = group.get('lag')
+                if oldest is None:
+                    last = _decode(group['last-delivered-id'])
+                    unread = await redis.xrange(FIXATION_STREAM,
+                                                min=f'({last}', count=1)
+                    if unread:
+                        oldest = unread[0][0]
+        stats['lag_seconds'] = entry_age(oldest) if oldest else 0.0
+        return stats
+
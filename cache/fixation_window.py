@@ -0,0 +1,76 @@
+import logging
+
+from consts import T_RANGE_H
+from db import get_recent_fixations
+
+FIXATION_WINDOW_PREFIX = 'fixation_window:'
+FIXATION_WINDOW_TTL = T_RANGE_H * 3600
+
+
+def fixation_key(number):
+    return f'{FIXATION_WINDOW_PREFIX}{number}'
+
+
+async def claim_fixation(redis, number):
+    """Reserve the dedup window for a plate.
+
+    Fails open: if Redis is unavailable the database check decides.
+
+    :return: False if the plate was already fixed within T_RANGE_H
+    """
+    try:
+        claimed = await redis.set(fixation_key(number), 1, nx=True,
+                                  ex=FIXATION_WINDOW_TTL)
+    except Exception as e:
+        print(e)
+        return True
+    return bool(claimed)
+
+
+async def release_fixation(redis, number):
+    """Drop a claim whose fixation was not written to the database."""
+    try:
+        await redis.delete(fixation_key(number))
+    except Exception as e:
+        print(e)
+
+
+def remaining_ttl(seconds):
+    """Seconds left in the window of a fixation made seconds ago."""
+    return FIXATION_WINDOW_TTL - int(seconds)
+
+
+async def shorten_fixation(redis, number, seconds):
+    """Align a claim with the fixation the database already has.
+
+    The claim was taken for a full window, but the window started with the
+    earlier fixation. Without a known fixation the claim is released.
+
+    :param seconds: Seconds since the last fixation, None if unknown
+    """
+    if seconds is None or remaining_ttl(seconds) <= 0:
+        await release_fixation(redis, number)
+        return
+    try:
+        await redis.set(fixation_key(number), 1, xx=True,
+                        ex=remaining_ttl(seconds))
+    except Exception as e:
+        print(e)
+
+
+async def warm_fixation_window(redis):
+    """Restore the window from log_history after a Redis flush or restart.
+
+    :return: Number of restored keys
+    """
+    recent = await get_recent_fixations(T_RANGE_H)
+    if not recent:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    for number, seconds in recent:
+        ttl = remaining_ttl(seconds)
+        if ttl > 0:
+            pipe.set(fixation_key(number), 1, nx=True, ex=ttl)
+    restored = sum(1 for value in await pipe.execute() if value)
+    logging.info('Окно фиксаций: восстановлено %s номеров', restored)
+    return restored
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+from db import get_plate_index_numbers
+from utils import DeletionIndex
+
+PLATE_INDEX_CHANNEL = 'plate_index'
+PLATE_INDEX_VERSION_KEY = 'plate_index:version'
+
+
+class PlateIndex:
+    """In-process set of own and archived plates.
+
+    Every bot process keeps its own copy. Writers bump a version in Redis
+    and publish it, processes reload when they see a newer version, so
+    they converge even if a pub/sub message is lost.
+    """
+
+    def __init__(self, poll_interval=60):
+        self.own = frozenset()
+        self.archive = frozenset()
+        self.own_nearby = DeletionIndex()
+        self.version = -1
+        self.poll_interval = poll_interval
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self):
+        return self.version >= 0
+
+    def is_own(self, number):
+        return number in self.own
+
+    def is_archive(self, number):
+        return number in self.archive
+
+    def similar_own(self, number, limit=3):
+        """Own plates one typo or OCR mistake away from number."""
+        return self.own_nearby.search(number, limit)
+
+    async def discard_archive(self, redis, numbers):
+        """New fixations take the plates out of the archive.
+
+        The change is published like any other, so other processes drop
+        the plates too instead of treating them as archived until their
+        next reload.
+        """
+        taken = self.archive.intersection(numbers)
+        if not taken:
+            return
+        self.archive = self.archive - taken
+        try:
+            await self.publish_change(redis)
+        except Exception as e:
+            print(e)
+
+    async def reload(self, version):
+        async with self._lock:
+            if version <= self.version:
+                return
+            numbers = await get_plate_index_numbers()
+            if numbers is None:
+                return
+            own, archive = numbers
+            self.own = frozenset(own)
+            self.archive = frozenset(archive)
+            self.own_nearby = DeletionIndex(self.own)
+            self.version = version
+            logging.info('Индекс номеров v%s: своих %s, в архиве %s',
+                         version, len(self.own), len(self.archive))
+
+    async def load(self, redis):
+        version = await redis.get(PLATE_INDEX_VERSION_KEY)
+        await self.reload(int(version or 0))
+
+    async def publish_change(self, redis):
+        """Call after the own list or the archive was changed in the db."""
+        version = await redis.incr(PLATE_INDEX_VERSION_KEY)
+        await self.reload(version)
+        await redis.publish(PLATE_INDEX_CHANNEL, version)
+
+    async def listen(self, redis):
+        """Follow invalidation messages, poll the version as a fallback."""
+        pubsub = redis.pubsub()
+        await pubsub.subscribe(PLATE_INDEX_CHANNEL)
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + self.poll_interval
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None:
+                        await self.reload(int(message['data']))
+                    if loop.time() >= next_poll:
+                        next_poll = loop.time() + self.poll_interval
+                        await self.load(redis)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(e)
+                    await asyncio.sleep(1)
+        finally:
+            await pubsub.unsubscribe(PLATE_INDEX_CHANNEL)
+            await pubsub.close()
+
+
+plate_index = PlateIndex()
@@ -0,0 +1,101 @@
+RATE_LIMIT_PREFIX = 'anti_flood:'
+RATE_LIMIT_REJECTED = 'anti_flood_rejected'
+DEFAULT_SCOPE = 'message'
+
+# Token bucket on one hash per user and scope. The clock is Redis TIME,
+# so several bot processes share the bucket without skew.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+def parse_limit(value):
+    """'<interval> [burst]' -> (interval, burst)."""
+    parts = value.replace(',', ' ').split()
+    return float(parts[0]), int(parts[1]) if len(parts) > 1 else 1
+
+
+class RateLimiter:
+    """Anti-flood limiter, one token per interval seconds, up to burst.
+
+    Commands listed in limits get their own bucket, other messages share
+    the default one. Rejected messages are counted per scope.
+    """
+
+    def __init__(self, interval=2, burst=1, limits=None):
+        """
+        :param limits: dict scope -> (interval, burst), scope is a command
+            name without the slash or 'photo'
+        """
+        self.default = (interval, burst)
+        self.limits = limits or {}
+        self.script = None
+
+    @classmethod
+    def from_config(cls, config, section='anti_flood'):
+        """Read interval, burst and '<scope> = <interval> [burst]' keys."""
+        if not config.has_section(section):
+            return cls()
+        options = dict(config.items(section))
+        limits = {scope: parse_limit(value)
+                  for scope, value in options.items()
+                  if scope not in ('interval', 'burst')}
+        return cls(interval=float(options.get('interval', 2)),
+                   burst=int(options.get('burst', 1)), limits=limits)
+
+    def scope(self, message):
+        """Bucket name of a message."""
+        text = message.text or ''
+        if text.startswith('/'):
+            command = text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+            if command in self.limits:
+                return command
+        if message.photo and 'photo' in self.limits:
+            return 'photo'
+        return DEFAULT_SCOPE
+
+    async def hit(self, redis, chat_id, user_id, scope=DEFAULT_SCOPE):
+        """Take a token for the user.
+
+        Fails open: if Redis is unavailable the message is let through.
+
+        :return: True if the message is allowed
+        """
+        interval, burst = self.limits.get(scope, self.default)
+        if self.script is None:
+            self.script = redis.register_script(TOKEN_BUCKET_LUA)
+        try:
+            allowed = await self.script(
+                keys=[f'{RATE_LIMIT_PREFIX}{scope}:{chat_id}:{user_id}',
+                      RATE_LIMIT_REJECTED],
+                args=[1 / interval, burst, scope])
+        except Exception as e:
+            print(e)
+            return True
+        return bool(allowed)
+
+    async def get_rejected(self, redis):
+        """:return: dict scope -> number of rejected messages"""
+        counters = await redis.hgetall(RATE_LIMIT_REJECTED)
+        return {(scope.decode() if isinstance(scope, bytes) else scope):
+                int(count) for scope, count in counters.items()}
+
+    async def reset_rejected(self, redis):
+        await redis.delete(RATE_LIMIT_REJECTED)
@@ -1,3 +1,3 @@
-from .consts import T_RANGE_H
+from .consts import T_RANGE_H, LOG_HISTORY_RETENTION_MONTHS
 
-__all__ = ['T_RANGE_H']
\ No newline at end of file
+__all__ = ['T_RANGE_H', 'LOG_HISTORY_RETENTION_MONTHS']
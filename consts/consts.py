@@ -1,3 +1,20 @@
 T_RANGE_H = 12
+# log_history partitions older than this are compacted and detached
+LOG_HISTORY_RETENTION_MONTHS = 24
+# months a partition past retention may stay attached until the daily
+# maintenance job compacts it
+LOG_HISTORY_COMPACTION_LAG_MONTHS = 1
+LOG_HISTORY_PARTITIONS_AHEAD = 3
 LIMIT_STAT_NUMBERS = 10
 LIMIT_UPLOAD_EXCEL_LOG = 5
+LIMIT_PLATE_NUMBERS = 10
+LIMIT_ACTIVE_USERS = 10
+STATS_TIMEZONE = 'Europe/Moscow'
+# plates of every diff shown in /log, the rest is paged per upload
+LIMIT_EXCEL_LOG_PREVIEW = 20
+LIMIT_EXCEL_LOG_ITEMS = 100
+# rows fetched per round trip when exporting to a file
+EXPORT_YIELD_PER = 5000
+# Telegram Bot API does not serve files larger than 20 MB to bots
+PHOTO_MAX_BYTES = 20 * 1024 * 1024
+PHOTO_DOWNLOAD_TIMEOUT = 30
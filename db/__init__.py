@@ -1,17 +1,34 @@
 from .db import add_auto_number, add_log_history, get_repeatable_parking, \
     get_auto_number_id, get_stat_numbers, get_general_activity, \
-    get_repeatable_parking_offset, get_active_users, get_end_day_stats, \
-    get_number_detail, update_plate_numbers_list, get_general_activity_offset, \
+    get_end_day_stats, get_number_detail, update_plate_numbers_list, \
     is_in_archive_number, set_archive_db, get_number_detail_info_change, \
     is_exists_number_info_change, get_log_numbers_upload, \
-    get_stat_numbers_dates_count, get_numbers_upload_count
+    get_stat_numbers_dates_count, get_numbers_upload_count, init_engine, \
+    dispose_engine, get_pool_stats, register_fixation, rebuild_parking_stats, \
+    get_repeatable_parking_page, rebuild_daily_stats, \
+    get_plate_index_numbers, get_recent_fixations, register_fixations_batch, \
+    get_excel_log_items, find_similar_plates, instrumentation, \
+    stream_partitions, parking_export_query, number_history_query, \
+    fixations_export_query
+from .migrations import upgrade, check_indexes, get_pending_migrations
+from .partitions import ensure_partitions, compact_log_history, \
+    maintain_log_history
 
 __all__ = ['add_auto_number', 'add_log_history', 'get_repeatable_parking',
            'get_auto_number_id', 'get_stat_numbers', 'get_general_activity',
-           'get_repeatable_parking_offset', 'get_active_users',
            'get_end_day_stats', 'get_number_detail',
-           'update_plate_numbers_list', 'get_general_activity_offset',
-           'is_in_archive_number', 'set_archive_db',
+           'update_plate_numbers_list', 'is_in_archive_number',
+           'set_archive_db',
            'get_number_detail_info_change', 'is_exists_number_info_change',
            'get_log_numbers_upload', 'get_stat_numbers_dates_count',
-           'get_numbers_upload_count']
+           'get_numbers_upload_count', 'init_engine', 'dispose_engine',
+           'get_pool_stats', 'register_fixation', 'upgrade',
+           'check_indexes', 'get_pending_migrations',
+           'rebuild_parking_stats', 'get_repeatable_parking_page',
+           'rebuild_daily_stats',
+           'ensure_partitions', 'compact_log_history', 'maintain_log_history',
+           'get_plate_index_numbers', 'get_recent_fixations',
+           'register_fixations_batch', 'get_excel_log_items',
+           'find_similar_plates', 'instrumentation', 'stream_partitions',
+           'parking_export_query', 'number_history_query',
+           'fixations_export_query']
@@ -1,21 +1,27 @@
 import asyncio
+import logging
 import configparser
-from time import time
+from time import time, perf_counter
 from datetime import datetime, timezone, timedelta
 
 import openpyxl
 import enum
 from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, \
     func, select, BigInteger, text, delete, and_, desc, join, UniqueConstraint, \
-    Enum, Text
+    Enum, event, Index, tuple_, Date, bindparam, union_all, inspect, \
+    update, Float, or_
 from sqlalchemy.orm import declarative_base, aliased, sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, OperationalError, \
+    InterfaceError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, \
     AsyncConnection
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 
-from consts import T_RANGE_H
-from consts.consts import LIMIT_STAT_NUMBERS, LIMIT_UPLOAD_EXCEL_LOG
+from consts import T_RANGE_H, LOG_HISTORY_RETENTION_MONTHS
+from consts.consts import LIMIT_STAT_NUMBERS, LIMIT_UPLOAD_EXCEL_LOG, \
+    STATS_TIMEZONE, LIMIT_EXCEL_LOG_PREVIEW, LIMIT_EXCEL_LOG_ITEMS, \
+    EXPORT_YIELD_PER, LOG_HISTORY_COMPACTION_LAG_MONTHS
+from .instrumentation import Instrumentation
 
 config = configparser.ConfigParser()
 
@@ -33,21 +39,100 @@ Base = declarative_base()
 POSTGRES_CONF = f'{TYPE_DIALECT}://{DB_USERNAME}:{DB_PASSWORD}@{DB_IP}:{DB_PORT}/{DB_NAME}'
 
 
-async def create_async_engine_and_session():
-    engine = create_async_engine(POSTGRES_CONF, echo=True)
-    async_session = sessionmaker(bind=engine, class_=AsyncSession,
-                                 expire_on_commit=False, autoflush=False)
+POOL_SIZE = config.getint('DB', 'pool_size', fallback=10)
+POOL_MAX_OVERFLOW = config.getint('DB', 'pool_max_overflow', fallback=20)
+POOL_TIMEOUT = config.getint('DB', 'pool_timeout', fallback=30)
+POOL_RECYCLE = config.getint('DB', 'pool_recycle', fallback=1800)
+POOL_PRE_PING = config.getboolean('DB', 'pool_pre_ping', fallback=True)
+ECHO = config.getboolean('DB', 'echo', fallback=False)
+
+instrumentation = Instrumentation(
+    enabled=config.getboolean('DB', 'instrumentation', fallback=False),
+    slow_query_ms=config.getfloat('DB', 'slow_query_ms', fallback=200))
+
+engine = None
+async_session = None
+
+# waits are measured in connection_and_session only, wait_avg is taken
+# over those calls and not over every pool checkout
+pool_stats = {'checkouts': 0, 'checkins': 0, 'waits': 0, 'wait_total': 0.0,
+              'wait_max': 0.0}
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats['checkouts'] += 1
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    pool_stats['checkins'] += 1
+
+
+def init_engine():
+    """Create the process-wide engine and session factory once.
+
+    :return: (engine, async_session)
+    """
+    global engine, async_session
+    if engine is None:
+        engine = create_async_engine(POSTGRES_CONF, echo=ECHO,
+                                     pool_size=POOL_SIZE,
+                                     max_overflow=POOL_MAX_OVERFLOW,
+                                     pool_timeout=POOL_TIMEOUT,
+                                     pool_recycle=POOL_RECYCLE,
+                                     pool_pre_ping=POOL_PRE_PING)
+        event.listen(engine.sync_engine.pool, 'checkout', _on_checkout)
+        event.listen(engine.sync_engine.pool, 'checkin', _on_checkin)
+        instrumentation.attach(engine)
+        async_session = sessionmaker(bind=engine, class_=AsyncSession,
+                                     expire_on_commit=False, autoflush=False)
     return engine, async_session
 
 
+async def dispose_engine():
+    """Close every pooled connection, called from bot shutdown."""
+    global engine, async_session
+    if engine is not None:
+        instrumentation.detach()
+        await engine.dispose()
+        engine = None
+        async_session = None
+
+
+def get_pool_stats():
+    """Return checkout/wait statistics of the shared connection pool.
+
+    :return: dict with pool counters, wait times are in seconds
+    """
+    stats = dict(pool_stats)
+    stats['wait_avg'] = (stats['wait_total'] / stats['waits']
+                         if stats['waits'] else 0.0)
+    if engine is not None:
+        pool = engine.sync_engine.pool
+        stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                     overflow=pool.overflow(), idle=pool.checkedin())
+    return stats
+
+
 def connection_and_session(func):
     async def wrapper(*args, **kwargs):
         try:
-            engine, async_session = await create_async_engine_and_session()
-
-            async with engine.begin() as connection:
-                async with async_session() as session:
+            _, session_factory = init_engine()
+
+            async with session_factory() as session:
+                wait_start = perf_counter()
+                connection = await session.connection()
+                wait = perf_counter() - wait_start
+                pool_stats['waits'] += 1
+                pool_stats['wait_total'] += wait
+                pool_stats['wait_max'] = max(pool_stats['wait_max'], wait)
+                if not instrumentation.enabled:
                     return await func(connection, session, *args, **kwargs)
+                call_start = perf_counter()
+                try:
+                    return await func(connection, session, *args, **kwargs)
+                finally:
+                    instrumentation.observe_function(
+                        func.__name__, perf_counter() - call_start + wait)
 
         except SQLAlchemyError as e:
             print(f'Произошла ошибка {e}')
@@ -69,8 +154,20 @@ class CarNumber(Base):
     is_archive = Column(Boolean, default=False)
     status = Column(Enum(CarStatus), nullable=True)
     count_out_archive = Column(Integer, default=0)
-
-    __table_args__ = (UniqueConstraint('number', name='unique_number'),)
+    parking_count = Column(Integer, nullable=False, default=0,
+                           server_default='0')
+    first_seen = Column(DateTime, nullable=True)
+    last_seen = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('number', name='unique_number'),
+        Index('ix_car_numbers_parking', 'is_own', 'is_archive',
+              parking_count.desc(), id.desc()),
+        # needs the pg_trgm extension, see find_similar_plates
+        Index('ix_car_numbers_number_trgm', 'number',
+              postgresql_using='gin',
+              postgresql_ops={'number': 'gin_trgm_ops'}),
+    )
 
     def __init__(self, auto_number, is_own=False,
                  is_archive=False, status=None):
@@ -84,9 +181,25 @@ class LogHistory(Base):
     __tablename__ = 'log_history'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    tg_user_id = Column(BigInteger, nullable=False, unique=True)
+    tg_user_id = Column(BigInteger, nullable=False)
     car_number_id = Column(Integer, ForeignKey('car_numbers.id'))
-    record_date = Column(DateTime, default=func.now())
+    # part of the primary key because the table is partitioned by month,
+    # see db/partitions.py
+    record_date = Column(DateTime, primary_key=True, default=func.now())
+    # is_own of the plate at the time of the fixation, daily_stats counts
+    # foreign fixations by it
+    is_own = Column(Boolean, nullable=False, default=False,
+                    server_default=text('false'))
+
+    __table_args__ = (
+        # unique: a fixation replayed from the write-behind queue keeps its
+        # record_date and is skipped
+        Index('ix_log_history_car_number_id_record_date', 'car_number_id',
+              record_date.desc(), unique=True),
+        Index('ix_log_history_record_date', 'record_date'),
+        Index('ix_log_history_tg_user_id', 'tg_user_id'),
+        {'postgresql_partition_by': 'RANGE (record_date)'},
+    )
 
     def __init__(self, tg_user_id, car_number_id):
         self.tg_user_id = tg_user_id
@@ -108,6 +221,10 @@ class AuditLog(Base):
     number = Column(String(10), nullable=False)
     timestamp = Column(DateTime, default=func.now())
 
+    __table_args__ = (
+        Index('ix_audit_log_number_timestamp', 'number', 'timestamp'),
+    )
+
     def __init__(self, actor_tg_id, action, number):
         self.actor_tg_id = actor_tg_id
         self.action = action
@@ -119,57 +236,119 @@ class ExcelLog(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     tg_user_id = Column(BigInteger, nullable=False)
-    added_numbers = Column(Text)
-    deleted_numbers = Column(Text)
+    added_count = Column(Integer, nullable=False, default=0,
+                         server_default='0')
+    deleted_count = Column(Integer, nullable=False, default=0,
+                           server_default='0')
     timestamp = Column(DateTime, default=func.now())
 
-    def __init__(self, tg_user_id, added_numbers, deleted_numbers):
+    def __init__(self, tg_user_id, added_count, deleted_count):
         self.tg_user_id = tg_user_id
-        self.added_numbers = added_numbers
-        self.deleted_numbers = deleted_numbers
+        self.added_count = added_count
+        self.deleted_count = deleted_count
+
+
+class ExcelLogItem(Base):
+    __tablename__ = 'excel_log_item'
+
+    excel_log_id = Column(Integer,
+                          ForeignKey('excel_log.id', ondelete='CASCADE'),
+                          primary_key=True)
+    action = Column(Enum(CarAction), primary_key=True)
+    number = Column(String(10), primary_key=True)
+
+    def __init__(self, excel_log_id, action, number):
+        self.excel_log_id = excel_log_id
+        self.action = action
+        self.number = number
+
+
+class LogHistoryPlateSummary(Base):
+    """Per-plate counts of a compacted log_history partition."""
+    __tablename__ = 'log_history_plate_summary'
+
+    month = Column(Date, primary_key=True)
+    car_number_id = Column(Integer, ForeignKey('car_numbers.id'),
+                           primary_key=True)
+    parking_count = Column(Integer, nullable=False, default=0)
+    first_seen = Column(DateTime)
+    last_seen = Column(DateTime)
+
+
+class LogHistoryDaySummary(Base):
+    """Per-day and per-user counts of a compacted log_history partition."""
+    __tablename__ = 'log_history_day_summary'
+
+    day = Column(Date, primary_key=True)
+    tg_user_id = Column(BigInteger, primary_key=True)
+    fixations = Column(Integer, nullable=False, default=0)
+
+
+class DailyStats(Base):
+    __tablename__ = 'daily_stats'
+
+    day = Column(Date, primary_key=True)
+    total_fixations = Column(Integer, nullable=False, default=0)
+    foreign_fixations = Column(Integer, nullable=False, default=0)
+    distinct_plates = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, day, total_fixations=0, foreign_fixations=0,
+                 distinct_plates=0):
+        self.day = day
+        self.total_fixations = total_fixations
+        self.foreign_fixations = foreign_fixations
+        self.distinct_plates = distinct_plates
+
+
+class PlateRow:
+    """Columns of car_numbers needed on the fixation path."""
+
+    __slots__ = ('id', 'is_own', 'is_archive')
+
+    def __init__(self, id, is_own, is_archive):
+        self.id = id
+        self.is_own = is_own
+        self.is_archive = is_archive
+
+
+async def fetch_plate_row(session: AsyncSession, auto_number):
+    """Read id/is_own/is_archive as a plain row, without an ORM entity.
+
+    :return: PlateRow or None
+    """
+    row = (await session.execute(
+        select(CarNumber.id, CarNumber.is_own, CarNumber.is_archive)
+        .where(CarNumber.number == auto_number))).first()
+    return PlateRow(*row) if row is not None else None
 
 
 @connection_and_session
 async def get_auto_number_id(connection: AsyncConnection,
                              session: AsyncSession,
                              auto_number) -> (int, bool):
-    number = await session.execute(
-        select(CarNumber).where(CarNumber.number == auto_number))
-    number = number.scalar_one_or_none()
-    if number:
-        return number.id, number.is_own, number.is_archive
+    plate = await fetch_plate_row(session, auto_number)
+    if plate:
+        return plate.id, plate.is_own, plate.is_archive
     return None, False, False
 
 
 @connection_and_session
 async def add_log_history(connection: AsyncConnection, session: AsyncSession,
-                          tg_user_id, car_number_id) -> bool:
-    existing_number = await session.execute(
-        select(CarNumber).filter_by(id=car_number_id))
-    existing_number = existing_number.scalar_one_or_none()
-    if existing_number and existing_number.is_archive:
-        existing_number.is_archive = False
-        existing_number.count_out_archive += 1
-
-    moscow_timezone = timezone(timedelta(hours=3))
-    moscow_time = datetime.now(moscow_timezone)
-    timestamp = moscow_time.timestamp()
-    query = (
-        select(
-            func.EXTRACT('epoch', LogHistory.record_date)).where(
-            LogHistory.car_number_id == car_number_id
-        ).order_by(desc(LogHistory.record_date)).limit(1)
-    )
-    last_record = (await session.execute(query)).scalar_one_or_none()
-
-    if (last_record is None or
-            (isinstance(last_record, float) and (
-                    int(timestamp) - last_record) / 3600 > (T_RANGE_H - 3))):
-        log_history = LogHistory(tg_user_id, car_number_id)
-        session.add(log_history)
-        await session.commit()
-        return True
-    return False
+                          tg_user_id, number) -> bool:
+    """Fixation of a plate, see register_fixation.
+
+    Goes through REGISTER_FIXATION_SQL so the parking counters and
+    daily_stats are updated like for any other fixation.
+
+    :param number: Normalized plate number, created if it is new
+    :return: True if the fixation was written
+    """
+    row = (await session.execute(
+        REGISTER_FIXATION_SQL,
+        {'number': number, 'tg_user_id': tg_user_id,
+         't_range_h': T_RANGE_H, 'sent_at': None})).first()
+    await session.commit()
+    return row is not None and bool(row.inserted)
 
 
 @connection_and_session
@@ -181,191 +360,583 @@ async def add_auto_number(connection: AsyncConnection, session: AsyncSession,
     return car.id
 
 
-@connection_and_session
-async def get_repeatable_parking(connection: AsyncConnection,
-                                 session: AsyncSession, is_own: bool,
-                                 is_archive: bool):
-    car_numbers = CarNumber.__table__
-    ranked_records_cte = (
-        select(
-            LogHistory.id,
-            LogHistory.car_number_id,
-            LogHistory.record_date
+# The fixation is stamped with :sent_at (epoch seconds) when it was queued,
+# otherwise with now(). A fixation with the same plate and record_date is
+# skipped by the unique index, so replaying a queued entry is a no-op.
+REGISTER_FIXATION_SQL = text(f"""
+    WITH fixed AS (
+        SELECT COALESCE(to_timestamp(CAST(:sent_at AS double precision)),
+                        now()) AS at
+    ), inserted_car AS (
+        INSERT INTO car_numbers (number, is_own, is_archive,
+                                 count_out_archive, timestamp,
+                                 parking_count, first_seen, last_seen)
+        SELECT :number, FALSE, FALSE, 0, now(), 1, fixed.at, fixed.at
+        FROM fixed
+        ON CONFLICT ON CONSTRAINT unique_number DO NOTHING
+        RETURNING id, is_own, is_archive
+    ), car AS (
+        SELECT id, is_own, is_archive FROM inserted_car
+        UNION ALL
+        SELECT id, is_own, is_archive FROM car_numbers
+        WHERE number = :number
+    ), fixation AS (
+        INSERT INTO log_history (tg_user_id, car_number_id, record_date,
+                                 is_own)
+        SELECT :tg_user_id, car.id, fixed.at, COALESCE(car.is_own, FALSE)
+        FROM car, fixed
+        WHERE NOT EXISTS (
+            SELECT 1 FROM log_history lh
+            WHERE lh.car_number_id = car.id
+              AND lh.record_date > fixed.at::timestamp
+                                   - make_interval(hours => :t_range_h)
+              AND lh.record_date < fixed.at::timestamp
+                                   + make_interval(hours => :t_range_h)
         )
-        .cte('ranked_records')
+        ON CONFLICT DO NOTHING
+        RETURNING car_number_id, is_own
+    ), counted AS (
+        -- rows from inserted_car are invisible here, they are created
+        -- with parking_count = 1 instead
+        UPDATE car_numbers
+        SET parking_count = car_numbers.parking_count + 1,
+            first_seen = LEAST(car_numbers.first_seen, fixed.at),
+            last_seen = GREATEST(car_numbers.last_seen, fixed.at),
+            is_archive = FALSE,
+            count_out_archive = car_numbers.count_out_archive
+                                + CASE WHEN car.is_archive THEN 1 ELSE 0 END
+        FROM fixation, car, fixed
+        WHERE car_numbers.id = fixation.car_number_id
+          AND car_numbers.id = car.id
+        RETURNING car_numbers.id
+    ), daily AS (
+        INSERT INTO daily_stats AS ds (day, total_fixations,
+                                       foreign_fixations, distinct_plates)
+        SELECT (fixed.at AT TIME ZONE '{STATS_TIMEZONE}')::date, 1,
+               CASE WHEN fixation.is_own THEN 0 ELSE 1 END,
+               CASE WHEN EXISTS (
+                   SELECT 1 FROM log_history lh
+                   WHERE lh.car_number_id = car.id
+                     AND lh.record_date >= date_trunc(
+                         'day', fixed.at AT TIME ZONE '{STATS_TIMEZONE}')
+                         AT TIME ZONE '{STATS_TIMEZONE}'
+                     AND lh.record_date < (date_trunc(
+                         'day', fixed.at AT TIME ZONE '{STATS_TIMEZONE}')
+                         + interval '1 day') AT TIME ZONE '{STATS_TIMEZONE}'
+               ) THEN 0 ELSE 1 END
+        FROM fixation
+        JOIN car ON car.id = fixation.car_number_id
+        CROSS JOIN fixed
+        ON CONFLICT (day) DO UPDATE
+        SET total_fixations = ds.total_fixations + EXCLUDED.total_fixations,
+            foreign_fixations = ds.foreign_fixations
+                                + EXCLUDED.foreign_fixations,
+            distinct_plates = ds.distinct_plates + EXCLUDED.distinct_plates
+        RETURNING ds.day
     )
-    repeatable_parking_cte = (
-        select(
-            ranked_records_cte.c.car_number_id,
-            func.COUNT().label('parking_count')
-        )
-        .group_by(ranked_records_cte.c.car_number_id)
-        .order_by(ranked_records_cte.c.car_number_id)
-        .cte('repeatable_parking')
+    SELECT car.is_own,
+           EXISTS (SELECT 1 FROM fixation) AS inserted,
+           (SELECT GREATEST(EXTRACT(epoch FROM fixed.at::timestamp
+                                                - max(lh.record_date)), 0)
+            FROM log_history lh
+            WHERE lh.car_number_id = car.id
+              AND lh.record_date > fixed.at::timestamp
+                                   - make_interval(hours => :t_range_h)
+           ) AS last_seconds
+    FROM car, fixed
+""")
+
+REBUILD_PARKING_STATS_SQL = """
+    WITH stats AS (
+        SELECT car_number_id,
+               sum(parking_count) AS parking_count,
+               min(first_seen) AS first_seen,
+               max(last_seen) AS last_seen
+        FROM (
+            SELECT car_number_id,
+                   count(*) AS parking_count,
+                   min(record_date) AS first_seen,
+                   max(record_date) AS last_seen
+            FROM log_history
+            GROUP BY car_number_id
+            UNION ALL
+            SELECT car_number_id, parking_count, first_seen, last_seen
+            FROM log_history_plate_summary
+        ) AS parts
+        GROUP BY car_number_id
     )
-    query = (
-        select(
-            car_numbers.c.id,
-            car_numbers.c.number,
-            car_numbers.c.is_own,
-            repeatable_parking_cte.c.parking_count
-        )
-        .select_from(
-            repeatable_parking_cte.outerjoin(
-                car_numbers,
-                car_numbers.c.id == repeatable_parking_cte.c.car_number_id
-            )
-        )
-        .where(and_(car_numbers.c.is_own.is_(is_own),
-                    car_numbers.c.is_archive.is_(is_archive)))
-    ).order_by(desc(repeatable_parking_cte.c.parking_count)) \
-        .order_by(desc(car_numbers.c.id))
-
-    result = await session.execute(query)
-    rows = result.fetchall()
-
-    cars = []
-    total_count = 0
-    for row in rows:
-        total_count += int(row.parking_count) if isinstance(row.parking_count,
-                                                            int) else 0
-        cars.append((row.number, row.parking_count))
-    return cars, total_count
+    UPDATE car_numbers cn
+    SET parking_count = COALESCE(stats.parking_count, 0),
+        first_seen = stats.first_seen,
+        last_seen = stats.last_seen
+    FROM car_numbers c
+    LEFT JOIN stats ON stats.car_number_id = c.id
+    WHERE cn.id = c.id
+      AND (cn.parking_count IS DISTINCT FROM COALESCE(stats.parking_count, 0)
+           OR cn.first_seen IS DISTINCT FROM stats.first_seen
+           OR cn.last_seen IS DISTINCT FROM stats.last_seen)
+"""
+
+# record_date is written in the server time zone, the rollup is keyed by
+# the Moscow-local day.
+LOCAL_DAY_SQL = "((record_date AT TIME ZONE current_setting('TimeZone')) " \
+                f"AT TIME ZONE '{STATS_TIMEZONE}')::date"
+
+# Days of compacted partitions are no longer in log_history, their rollup
+# rows are kept as they are. Foreign fixations are counted by
+# log_history.is_own like in REGISTER_FIXATION_SQL, so a plate that changes
+# owner later does not rewrite past days.
+REBUILD_DAILY_STATS_SQL = [
+    'LOCK TABLE daily_stats IN EXCLUSIVE MODE',
+    f'DELETE FROM daily_stats '
+    f'WHERE day >= (SELECT min({LOCAL_DAY_SQL}) FROM log_history)',
+    f"""
+    INSERT INTO daily_stats (day, total_fixations, foreign_fixations,
+                             distinct_plates)
+    SELECT {LOCAL_DAY_SQL.replace('record_date', 'lh.record_date')} AS day,
+           count(*),
+           count(*) FILTER (WHERE NOT lh.is_own),
+           count(DISTINCT lh.car_number_id)
+    FROM log_history lh
+    GROUP BY day
+    """,
+]
 
 
 @connection_and_session
-async def get_repeatable_parking_offset(connection: AsyncConnection,
-                                        session: AsyncSession,
-                                        is_own, is_archive, current, limit):
-    start = (current - 1) * limit
-    car_numbers = CarNumber.__table__
-    ranked_records_cte = (
-        select(
-            LogHistory.id,
-            LogHistory.car_number_id,
-            LogHistory.record_date
-        )
-        .cte('ranked_records')
-    )
-    repeatable_parking_cte = (
-        select(
-            ranked_records_cte.c.car_number_id,
-            func.COUNT().label('parking_count')
+async def register_fixation(connection: AsyncConnection,
+                            session: AsyncSession,
+                            tg_user_id, number):
+    """Register a plate fixation in a single round trip.
+
+    Upserts the plate, checks the T_RANGE_H window, takes the plate out of
+    the archive and writes log_history in one statement.
+
+    :param tg_user_id: Telegram id of the sender
+    :param number: Normalized plate number
+    :return: (is_own, inserted, seconds since the last fixation within
+        T_RANGE_H or None)
+    """
+    params = {'number': number, 'tg_user_id': tg_user_id,
+              't_range_h': T_RANGE_H, 'sent_at': None}
+    row = (await session.execute(REGISTER_FIXATION_SQL, params)).first()
+    if row is None:
+        # The plate was inserted by a concurrent transaction after our
+        # snapshot was taken, the second attempt sees it.
+        row = (await session.execute(REGISTER_FIXATION_SQL, params)).first()
+    await session.commit()
+    if row is None:
+        return False, False, None
+    last_seconds = None if row.last_seconds is None \
+        else float(row.last_seconds)
+    return bool(row.is_own), bool(row.inserted), last_seconds
+
+
+ENSURE_PLATES_SQL = text("""
+    INSERT INTO car_numbers (number, is_own, is_archive, count_out_archive,
+                             timestamp, parking_count)
+    SELECT DISTINCT unnest(:numbers), FALSE, FALSE, 0, now(), 0
+    ON CONFLICT ON CONSTRAINT unique_number DO NOTHING
+""").bindparams(bindparam('numbers', type_=ARRAY(String)))
+
+
+# Set-wise REGISTER_FIXATION_SQL for a write-behind batch, plates exist
+# already (ENSURE_PLATES_SQL). Within the batch the earliest fixation of a
+# plate inside the T_RANGE_H window wins; the Redis claim keeps such pairs
+# out of the queue anyway. Returns the positions (1-based) that were written.
+REGISTER_FIXATIONS_BATCH_SQL = text(f"""
+    WITH input AS (
+        SELECT i.ord, i.tg_user_id, i.number, to_timestamp(i.sent_at) AS at
+        FROM unnest(CAST(:tg_user_ids AS BIGINT[]),
+                    CAST(:numbers AS VARCHAR[]),
+                    CAST(:sent_ats AS DOUBLE PRECISION[]))
+             WITH ORDINALITY AS i(tg_user_id, number, sent_at, ord)
+    ), car AS (
+        SELECT input.ord, input.tg_user_id, input.at, cn.id AS car_number_id,
+               COALESCE(cn.is_own, FALSE) AS is_own
+        FROM input
+        JOIN car_numbers cn ON cn.number = input.number
+    ), candidate AS (
+        SELECT car.*
+        FROM car
+        WHERE NOT EXISTS (
+            SELECT 1 FROM log_history lh
+            WHERE lh.car_number_id = car.car_number_id
+              AND lh.record_date > car.at::timestamp
+                                   - make_interval(hours => :t_range_h)
+              AND lh.record_date < car.at::timestamp
+                                   + make_interval(hours => :t_range_h)
+        ) AND NOT EXISTS (
+            SELECT 1 FROM car earlier
+            WHERE earlier.car_number_id = car.car_number_id
+              AND earlier.at > car.at - make_interval(hours => :t_range_h)
+              AND (earlier.at, earlier.ord) < (car.at, car.ord)
         )
-        .group_by(ranked_records_cte.c.car_number_id)
-        .order_by(ranked_records_cte.c.car_number_id)
-        .cte('repeatable_parking')
+    ), fixation AS (
+        INSERT INTO log_history (tg_user_id, car_number_id, record_date,
+                                 is_own)
+        SELECT tg_user_id, car_number_id, at, is_own
+        FROM candidate
+        ON CONFLICT DO NOTHING
+        RETURNING car_number_id, record_date, is_own
+    ), per_car AS (
+        SELECT car_number_id, count(*) AS fixations,
+               min(record_date) AS first_at, max(record_date) AS last_at
+        FROM fixation
+        GROUP BY car_number_id
+    ), counted AS (
+        UPDATE car_numbers
+        SET parking_count = car_numbers.parking_count + per_car.fixations,
+            first_seen = LEAST(car_numbers.first_seen, per_car.first_at),
+            last_seen = GREATEST(car_numbers.last_seen, per_car.last_at),
+            is_archive = FALSE,
+            count_out_archive = car_numbers.count_out_archive
+                + CASE WHEN car_numbers.is_archive THEN 1 ELSE 0 END
+        FROM per_car
+        WHERE car_numbers.id = per_car.car_number_id
+        RETURNING car_numbers.id
+    ), fixation_day AS (
+        SELECT fixation.car_number_id, fixation.is_own,
+               {LOCAL_DAY_SQL.replace('record_date', 'fixation.record_date')}
+                   AS day
+        FROM fixation
+    ), daily AS (
+        INSERT INTO daily_stats AS ds (day, total_fixations,
+                                       foreign_fixations, distinct_plates)
+        SELECT fd.day, count(*), count(*) FILTER (WHERE NOT fd.is_own),
+               count(DISTINCT fd.car_number_id) FILTER (WHERE NOT EXISTS (
+                   SELECT 1 FROM log_history lh
+                   WHERE lh.car_number_id = fd.car_number_id
+                     AND lh.record_date >= fd.day::timestamp
+                                           AT TIME ZONE '{STATS_TIMEZONE}'
+                     AND lh.record_date < (fd.day + 1)::timestamp
+                                          AT TIME ZONE '{STATS_TIMEZONE}'))
+        FROM fixation_day fd
+        GROUP BY fd.day
+        ON CONFLICT (day) DO UPDATE
+        SET total_fixations = ds.total_fixations + EXCLUDED.total_fixations,
+            foreign_fixations = ds.foreign_fixations
+                                + EXCLUDED.foreign_fixations,
+            distinct_plates = ds.distinct_plates + EXCLUDED.distinct_plates
+        RETURNING ds.day
     )
-    query = (
-        select(
-            car_numbers.c.id,
-            car_numbers.c.number,
-            car_numbers.c.is_own,
-            car_numbers.c.count_out_archive,
-            repeatable_parking_cte.c.parking_count
-        )
-        .select_from(
-            repeatable_parking_cte.outerjoin(
-                car_numbers,
-                car_numbers.c.id == repeatable_parking_cte.c.car_number_id
-            )
-        )
-        .where(and_(car_numbers.c.is_own.is_(is_own),
-                    car_numbers.c.is_archive.is_(is_archive)))
-    ).order_by(desc(repeatable_parking_cte.c.parking_count)) \
-        .order_by(desc(car_numbers.c.id))
+    SELECT candidate.ord
+    FROM candidate
+    JOIN fixation ON fixation.car_number_id = candidate.car_number_id
+                 AND fixation.record_date = candidate.at::timestamp
+""").bindparams(bindparam('tg_user_ids', type_=ARRAY(BigInteger)),
+                bindparam('numbers', type_=ARRAY(String)),
+                bindparam('sent_ats', type_=ARRAY(Float)))
 
-    result = await session.execute(query.offset(start).limit(limit))
-    rows = result.fetchall()
 
-    cars = []
-    for row in rows:
-        cars.append((row.number, row.parking_count, row.count_out_archive))
-    return cars
+def is_disconnect(error):
+    """True if the error means the database is unreachable, not bad data."""
+    return isinstance(error, (OperationalError, InterfaceError)) or \
+        (isinstance(error, DBAPIError) and error.connection_invalidated)
 
 
 @connection_and_session
-async def get_stat_numbers(connection: AsyncConnection, session: AsyncSession,
-                           current=1, limit=LIMIT_STAT_NUMBERS):
-    start = (current - 1) * limit
-    date_format = func.to_char(LogHistory.record_date, 'YYYYMMDD').label(
-        'full_date')
+async def register_fixations_batch(connection: AsyncConnection,
+                                   session: AsyncSession, fixations):
+    """Register queued fixations in one transaction.
+
+    Plates are created up front and the batch is written by one set-wise
+    statement. Each fixation keeps the time it was queued, so a replayed
+    batch hits the unique (car_number_id, record_date) index and writes
+    nothing. If the batch fails on its data, the fixations are retried one
+    by one in savepoints, so one bad entry does not hold back the rest.
+    Connection errors are raised, the whole batch is retried later.
+
+    :param fixations: List of (tg_user_id, number, sent_at), sent_at in
+        epoch seconds
+    :return: (written, failed), positions in fixations
+    """
+    if not fixations:
+        return [], []
+    try:
+        await session.execute(
+            ENSURE_PLATES_SQL,
+            {'numbers': [number for _, number, _ in fixations]})
+        result = await session.execute(
+            REGISTER_FIXATIONS_BATCH_SQL,
+            {'tg_user_ids': [tg_user_id for tg_user_id, _, _ in fixations],
+             'numbers': [number for _, number, _ in fixations],
+             'sent_ats': [sent_at for _, _, sent_at in fixations],
+             't_range_h': T_RANGE_H})
+        written = sorted(ord - 1 for ord in result.scalars())
+        await session.commit()
+        return written, []
+    except SQLAlchemyError as e:
+        if is_disconnect(e):
+            raise
+        print(e)
+        await session.rollback()
+
+    written, failed = [], []
+    for position, (tg_user_id, number, sent_at) in enumerate(fixations):
+        try:
+            async with session.begin_nested():
+                row = (await session.execute(
+                    REGISTER_FIXATION_SQL,
+                    {'number': number, 'tg_user_id': tg_user_id,
+                     't_range_h': T_RANGE_H, 'sent_at': sent_at})).first()
+        except SQLAlchemyError as e:
+            if is_disconnect(e):
+                raise
+            print(e)
+            failed.append(position)
+            continue
+        if row is not None and row.inserted:
+            written.append(position)
+    await session.commit()
+    return written, failed
 
-    subquery = (
-        select(date_format, func.count().label('count_number'))
-        .group_by(date_format)
-        .order_by(desc(date_format))
-    )
 
-    result = await session.execute(subquery.offset(start).limit(limit))
+@connection_and_session
+async def rebuild_parking_stats(connection: AsyncConnection,
+                                session: AsyncSession):
+    """Recount parking_count/first_seen/last_seen from log_history.
+
+    :return: Number of corrected plates
+    """
+    result = await session.execute(text(REBUILD_PARKING_STATS_SQL))
+    await session.commit()
+    return result.rowcount
+
+
+async def fetch_keyset_page(session: AsyncSession, query, keys, limit,
+                            after=None, before=None, having=False):
+    """Fetch one page of a query sorted by keys in descending order.
+
+    The cursor is the sort key of the last (after) or the first (before)
+    row of the neighbouring page, so every page costs the same and rows
+    do not shift between pages under concurrent inserts.
+
+    :param keys: Sort columns, the last one must be unique
+    :param after: Key of the last row of the previous page
+    :param before: Key of the first row of the next page
+    :param having: Compare aggregated keys in HAVING instead of WHERE
+    :return: List of rows in descending order
+    """
+    key = tuple_(*keys)
+    condition = None
+    if before is not None:
+        condition = key > tuple_(*before)
+        order = [k.asc() for k in keys]
+    else:
+        if after is not None:
+            condition = key < tuple_(*after)
+        order = [k.desc() for k in keys]
+
+    if condition is not None:
+        query = query.having(condition) if having else query.where(condition)
+
+    result = await session.execute(query.order_by(*order).limit(limit))
     rows = result.fetchall()
+    if before is not None:
+        rows.reverse()
+    return rows
+
 
-    total_count = await session.scalar(func.count().select().
-                                       select_from(LogHistory))
+async def fetch_page_with_totals(session: AsyncSession, query, keys, limit,
+                                 totals, after=None, before=None,
+                                 having=False):
+    """Fetch a keyset page together with totals in one statement.
 
-    data = [(datetime.strptime(row.full_date, '%Y%m%d').strftime(
-        '%d.%m.%Y'), row.count_number) for row in rows]
-    return data, total_count
+    :param totals: Single-value selects added as scalar subqueries
+    :return: (rows, tuple of totals)
+    """
+    columns = [total.scalar_subquery() for total in totals]
+    rows = await fetch_keyset_page(session, query.add_columns(*columns),
+                                   keys, limit, after, before, having)
+    if rows:
+        return rows, tuple(rows[0][-len(columns):])
+    return rows, tuple((await session.execute(select(*columns))).first())
 
 
 @connection_and_session
-async def get_stat_numbers_dates_count(
-        connection: AsyncConnection,
-        session: AsyncSession):
-    date_format = func.to_char(LogHistory.record_date, 'YYYYMMDD').label(
-        'full_date')
+async def rebuild_daily_stats(connection: AsyncConnection,
+                              session: AsyncSession):
+    """Recount daily_stats from log_history.
+
+    :return: Number of days in the rollup
+    """
+    result = None
+    for statement in REBUILD_DAILY_STATS_SQL:
+        result = await session.execute(text(statement))
+    await session.commit()
+    return result.rowcount
 
-    query = (select(date_format)).group_by(date_format)
-    result = await session.execute(query)
-    count_record = result.fetchall()
 
-    print(count_record)
-    return len(count_record)
+def repeatable_parking_query(is_own, is_archive):
+    return (
+        select(CarNumber.id, CarNumber.number, CarNumber.parking_count,
+               CarNumber.count_out_archive)
+        .where(and_(CarNumber.is_own.is_(is_own),
+                    CarNumber.is_archive.is_(is_archive),
+                    CarNumber.parking_count > 0))
+    )
 
 
 @connection_and_session
-async def get_general_activity(connection: AsyncConnection,
-                               session: AsyncSession):
-    query = (
-        select(LogHistory.tg_user_id, func.count().label("count"))
-        .group_by(LogHistory.tg_user_id).order_by(desc("count"))
-    )
-    result = await session.execute(query)
+async def get_repeatable_parking(connection: AsyncConnection,
+                                 session: AsyncSession, is_own: bool,
+                                 is_archive: bool):
+    query = repeatable_parking_query(is_own, is_archive)
+    result = await session.execute(
+        query.order_by(desc(CarNumber.parking_count), desc(CarNumber.id)))
     rows = result.fetchall()
-    users = []
-    for row in rows:
-        users.append((row[0], row[1]))
 
-    return users
+    cars = []
+    total_count = 0
+    for row in rows:
+        total_count += row.parking_count
+        cars.append((row.number, row.parking_count))
+    return cars, total_count
 
 
 @connection_and_session
-async def get_general_activity_offset(connection: AsyncConnection,
+async def get_repeatable_parking_page(connection: AsyncConnection,
                                       session: AsyncSession,
-                                      current, limit):
-    start = (current - 1) * limit
+                                      is_own, is_archive, limit,
+                                      after=None, before=None):
+    """Page of the parking list plus its row count and parking sum.
+
+    :return: (cars, total_rows, total_count)
+    """
+    condition = and_(CarNumber.is_own.is_(is_own),
+                     CarNumber.is_archive.is_(is_archive),
+                     CarNumber.parking_count > 0)
+    rows, (total_rows, total_count) = await fetch_page_with_totals(
+        session, repeatable_parking_query(is_own, is_archive),
+        [CarNumber.parking_count, CarNumber.id], limit,
+        [select(func.count()).select_from(CarNumber).where(condition),
+         select(func.coalesce(func.sum(CarNumber.parking_count), 0))
+         .where(condition)],
+        after, before)
 
-    query = (
-        select(LogHistory.tg_user_id, func.count().label("count"))
-        .group_by(LogHistory.tg_user_id).order_by(desc("count"))
-    )
-    result = await session.execute(query.offset(start).limit(limit))
-    rows = result.fetchall()
-    users = []
+    cars = []
     for row in rows:
-        users.append((row[0], row[1]))
+        cars.append((row.number, row.parking_count, row.count_out_archive,
+                     row.id))
+    return cars, total_rows, total_count
+
+
+async def stream_partitions(query, yield_per=EXPORT_YIELD_PER):
+    """Yield lists of rows of query read through a server-side cursor.
+
+    Memory use is bounded by yield_per rows whatever the result size.
+    """
+    _, session_factory = init_engine()
+    async with session_factory() as session:
+        result = await session.stream(
+            query.execution_options(yield_per=yield_per))
+        async for partition in result.partitions():
+            yield partition
+
+
+def parking_export_query(is_own, is_archive):
+    return (
+        select(CarNumber.number, CarNumber.parking_count,
+               CarNumber.count_out_archive, CarNumber.first_seen,
+               CarNumber.last_seen)
+        .where(and_(CarNumber.is_own.is_(is_own),
+                    CarNumber.is_archive.is_(is_archive),
+                    CarNumber.parking_count > 0))
+        .order_by(desc(CarNumber.parking_count), desc(CarNumber.id))
+    )
 
-    return users
+
+def retention_start():
+    """Lower record_date bound of log_history scans.
+
+    Partitions older than LOG_HISTORY_RETENTION_MONTHS are compacted by the
+    daily job, the bound leaves it LOG_HISTORY_COMPACTION_LAG_MONTHS more so
+    a month that is not compacted yet is still shown. The planner prunes
+    the partitions before it.
+    """
+    month = datetime.now().replace(day=1, hour=0, minute=0, second=0,
+                                   microsecond=0)
+    for _ in range(LOG_HISTORY_RETENTION_MONTHS
+                   + LOG_HISTORY_COMPACTION_LAG_MONTHS):
+        month = (month - timedelta(days=1)).replace(day=1)
+    return month
+
+
+def number_history_query(number):
+    return (
+        select(LogHistory.record_date, LogHistory.tg_user_id)
+        .join(CarNumber, CarNumber.id == LogHistory.car_number_id)
+        .where(CarNumber.number == number,
+               LogHistory.record_date >= retention_start())
+        .order_by(desc(LogHistory.record_date))
+    )
+
+
+def fixations_export_query():
+    return (
+        select(LogHistory.record_date, CarNumber.number, CarNumber.is_own,
+               LogHistory.tg_user_id)
+        .join(CarNumber, CarNumber.id == LogHistory.car_number_id)
+        .where(LogHistory.record_date >= retention_start())
+        .order_by(LogHistory.record_date)
+    )
 
 
 @connection_and_session
-async def get_active_users(connection: AsyncConnection, session: AsyncSession):
-    query = (select(LogHistory.tg_user_id).group_by(LogHistory.tg_user_id))
-    result = await session.execute(query)
+async def get_stat_numbers(connection: AsyncConnection, session: AsyncSession,
+                           limit=LIMIT_STAT_NUMBERS, after=None,
+                           before=None):
+    query = select(DailyStats.day, DailyStats.total_fixations)
+    rows, (total_count, total_days) = await fetch_page_with_totals(
+        session, query, [DailyStats.day], limit,
+        [select(func.coalesce(func.sum(DailyStats.total_fixations), 0)),
+         select(func.count()).select_from(DailyStats)],
+        [datetime.strptime(after, '%Y%m%d').date()] if after else None,
+        [datetime.strptime(before, '%Y%m%d').date()] if before else None)
+
+    data = [(row.day.strftime('%d.%m.%Y'), row.total_fixations,
+             row.day.strftime('%Y%m%d')) for row in rows]
+    return data, total_count, total_days
+
+
+@connection_and_session
+async def get_stat_numbers_dates_count(
+        connection: AsyncConnection,
+        session: AsyncSession):
+    return await session.scalar(
+        select(func.count()).select_from(DailyStats))
+
+
+def user_activity_subquery():
+    """Fixations per user, including compacted log_history partitions."""
+    return union_all(
+        select(LogHistory.tg_user_id, func.count().label('count'))
+        .group_by(LogHistory.tg_user_id),
+        select(LogHistoryDaySummary.tg_user_id,
+               func.sum(LogHistoryDaySummary.fixations).label('count'))
+        .group_by(LogHistoryDaySummary.tg_user_id)
+    ).subquery('activity')
+
+
+def user_activity_query():
+    activity = user_activity_subquery()
+    total = func.sum(activity.c.count)
+    return (
+        select(activity.c.tg_user_id, total.label('count'))
+        .group_by(activity.c.tg_user_id)
+    )
+
+
+@connection_and_session
+async def get_general_activity(connection: AsyncConnection,
+                               session: AsyncSession):
+    query = user_activity_query()
+    result = await session.execute(query.order_by(desc("count")))
     rows = result.fetchall()
     users = []
     for row in rows:
-        users.append(row[0])
+        users.append((row[0], row[1]))
 
     return users
 
@@ -373,52 +944,24 @@ async def get_active_users(connection: AsyncConnection, session: AsyncSession):
 @connection_and_session
 async def get_end_day_stats(connection: AsyncConnection,
                             session: AsyncSession):
-    cte = text("""
-        WITH daily_counts AS (
-            SELECT
-                date_trunc('day', lh.record_date) AS my_day,
-                COUNT(*) AS record_count,
-                0 AS plate_numbers_count
-            FROM log_history lh
-            GROUP BY my_day
-
-            UNION ALL
-
-            SELECT
-                date_trunc('day', lh.record_date) AS my_day,
-                0 AS record_count,
-                COUNT(*) AS plate_numbers_count
-            FROM log_history lh
-            LEFT JOIN car_numbers cn ON cn.id = lh.car_number_id
-            WHERE cn.is_own IS FALSE
-            GROUP BY my_day
-        )
-        SELECT to_char(my_day, 'DD.MM.YYYY') my_day, SUM(record_count) AS total_plate_numbers, SUM(plate_numbers_count) AS other_plate_numbers
-        FROM daily_counts
-        GROUP BY my_day
-        HAVING my_day = (
-            SELECT my_day
-            FROM daily_counts
-            ORDER BY my_day DESC
-            LIMIT 1
-        )
-        UNION ALL
-        SELECT NULL AS my_day, COUNT(*) AS total_records_count, 0 AS total_plate_numbers_count
-        FROM log_history lh2;
+    stmt = text(f"""
+        SELECT to_char(today.day, 'DD.MM.YYYY') AS my_day,
+               ds.total_fixations, ds.foreign_fixations,
+               (SELECT sum(total_fixations) FROM daily_stats) AS total
+        FROM (SELECT (now() AT TIME ZONE '{STATS_TIMEZONE}')::date AS day)
+             AS today
+        LEFT JOIN daily_stats ds ON ds.day = today.day
     """)
 
-    result = await session.execute(cte)
-    rows = result.fetchall()
-    value = rows[0]
-    day, total_plate_numbers_day, other_plate_numbers = value
-    total_plate_numbers = rows[-1][1]
-
-    current_day = (datetime.now()).strftime('%d.%m.%Y')
+    row = (await session.execute(stmt)).first()
+    day, total_plate_numbers_day, other_plate_numbers, total_plate_numbers = \
+        row
 
-    if day and total_plate_numbers_day and (other_plate_numbers or other_plate_numbers == 0) and total_plate_numbers:
-        if current_day != day:
-            return current_day, '0', total_plate_numbers, '0'
-        return day, total_plate_numbers_day, total_plate_numbers, other_plate_numbers
+    if total_plate_numbers:
+        if not total_plate_numbers_day:
+            return day, '0', total_plate_numbers, '0'
+        return day, total_plate_numbers_day, total_plate_numbers, \
+            other_plate_numbers
 
     return '0', '0', '0', '0'
 
@@ -431,7 +974,8 @@ async def get_number_detail(connection: AsyncConnection, session: AsyncSession,
             "to_char(log_history.record_date, 'YYYYMMDD HH24:MI:SS') as fixed_date")
     ).select_from(LogHistory).outerjoin(CarNumber,
                                         CarNumber.id == LogHistory.car_number_id).filter(
-        CarNumber.number == search_number
+        CarNumber.number == search_number,
+        LogHistory.record_date >= retention_start()
     ).order_by(text('fixed_date DESC'))
 
     result = await session.execute(stmt)
@@ -465,24 +1009,71 @@ async def get_number_detail_info_change(connection: AsyncConnection,
 @connection_and_session
 async def get_log_numbers_upload(connection: AsyncConnection,
                                  session: AsyncSession,
-                                 cp=1,
-                                 limit=LIMIT_UPLOAD_EXCEL_LOG):
-    start = (cp - 1) * limit
+                                 limit=LIMIT_UPLOAD_EXCEL_LOG,
+                                 after=None, before=None,
+                                 preview=LIMIT_EXCEL_LOG_PREVIEW):
+    """Page of uploads with the first preview plates of every diff.
+
+    :return: (list of (tg_user_id, added, deleted, date, id, added_count,
+        deleted_count), total_upload), added and deleted are space-joined
+    """
     date_format = func.to_char(ExcelLog.timestamp,
                                'YYYYMMDD HH24:MI:SS').label(
         'full_date')
-    stmt = select(ExcelLog.tg_user_id, ExcelLog.added_numbers,
-                  ExcelLog.deleted_numbers,
-                  date_format
-                  ).select_from(ExcelLog).order_by(text('full_date DESC'))
-    result = await session.execute(stmt.offset(start).limit(limit))
-    excel_log = result.fetchall()
-    log_uploaded_numbers = [(row[0], row[1], row[2],
-                             datetime.strptime(row[3],
-                                               '%Y%m%d %H:%M:%S').strftime(
-                                 '%d.%m.%Y %H:%M:%S')) for row in excel_log]
+    stmt = select(ExcelLog.tg_user_id, ExcelLog.added_count,
+                  ExcelLog.deleted_count,
+                  date_format, ExcelLog.id
+                  ).select_from(ExcelLog)
+    excel_log, (total_upload,) = await fetch_page_with_totals(
+        session, stmt, [ExcelLog.id], limit,
+        [select(func.count()).select_from(ExcelLog)], after, before)
+
+    previews = {}
+    if excel_log:
+        position = func.row_number().over(
+            partition_by=(ExcelLogItem.excel_log_id, ExcelLogItem.action),
+            order_by=ExcelLogItem.number.desc()).label('position')
+        items = select(ExcelLogItem.excel_log_id, ExcelLogItem.action,
+                       ExcelLogItem.number, position).where(
+            ExcelLogItem.excel_log_id.in_([row[4] for row in excel_log])
+        ).subquery()
+        result = await session.execute(
+            select(items.c.excel_log_id, items.c.action, items.c.number)
+            .where(items.c.position <= preview)
+            .order_by(items.c.position))
+        for excel_log_id, action, number in result.fetchall():
+            previews.setdefault((excel_log_id, action), []).append(number)
+
+    log_uploaded_numbers = [
+        (row[0], ' '.join(previews.get((row[4], CarAction.ADD), [])),
+         ' '.join(previews.get((row[4], CarAction.DELETE), [])),
+         datetime.strptime(row[3], '%Y%m%d %H:%M:%S').strftime(
+             '%d.%m.%Y %H:%M:%S'), row[4], row[1], row[2])
+        for row in excel_log]
+
+    return log_uploaded_numbers, total_upload
 
-    return log_uploaded_numbers
+
+@connection_and_session
+async def get_excel_log_items(connection: AsyncConnection,
+                              session: AsyncSession, excel_log_id, action,
+                              limit=LIMIT_EXCEL_LOG_ITEMS, after=None,
+                              before=None):
+    """Page of plates added or deleted by one upload, sorted by number.
+
+    :param action: 'ADD' or 'DELETE'
+    :return: (numbers, total)
+    """
+    action = CarAction[action]
+    stmt = select(ExcelLogItem.number).where(
+        ExcelLogItem.excel_log_id == excel_log_id,
+        ExcelLogItem.action == action)
+    rows, (total,) = await fetch_page_with_totals(
+        session, stmt, [ExcelLogItem.number], limit,
+        [select(func.count()).select_from(ExcelLogItem).where(
+            ExcelLogItem.excel_log_id == excel_log_id,
+            ExcelLogItem.action == action)], after, before)
+    return [row[0] for row in rows], total
 
 
 @connection_and_session
@@ -502,6 +1093,69 @@ async def is_exists_number_info_change(connection: AsyncConnection,
     return audit_logs
 
 
+@connection_and_session
+async def get_recent_fixations(connection: AsyncConnection,
+                               session: AsyncSession, hours=T_RANGE_H):
+    """Plates fixed within the last hours with seconds since the last one.
+
+    :return: List of (number, seconds)
+    """
+    last_seen = func.max(LogHistory.record_date)
+    query = (
+        select(CarNumber.number,
+               func.EXTRACT('epoch', func.localtimestamp() - last_seen))
+        .select_from(LogHistory)
+        .join(CarNumber, CarNumber.id == LogHistory.car_number_id)
+        .where(LogHistory.record_date > func.localtimestamp()
+               - func.make_interval(0, 0, 0, 0, hours))
+        .group_by(CarNumber.number)
+    )
+    result = await session.execute(query)
+    return [(row[0], float(row[1])) for row in result.fetchall()]
+
+
+@connection_and_session
+async def find_similar_plates(connection: AsyncConnection,
+                              session: AsyncSession, number, limit=3,
+                              is_own=True):
+    """Plates similar to number by trigrams, most similar first.
+
+    Uses the GIN trigram index through the % operator, callers check
+    the edit distance of the candidates. number itself comes first if it
+    matches is_own or is archived, like the plate index such a number
+    needs no suggestion.
+
+    :return: List of numbers
+    """
+    query = (
+        select(CarNumber.number)
+        .where(CarNumber.number.op('%')(number),
+               or_(CarNumber.is_own.is_(is_own),
+                   and_(CarNumber.number == number,
+                        CarNumber.is_archive.is_(True))))
+        .order_by(func.similarity(CarNumber.number, number).desc())
+        .limit(limit)
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
+
+
+@connection_and_session
+async def get_plate_index_numbers(connection: AsyncConnection,
+                                  session: AsyncSession):
+    """Own and archived plates for the in-memory plate index.
+
+    :return: (own numbers, archived numbers)
+    """
+    result = await session.execute(
+        select(CarNumber.number, CarNumber.is_own)
+        .where(CarNumber.is_own.is_(True) | CarNumber.is_archive.is_(True)))
+    own, archive = [], []
+    for number, is_own in result.fetchall():
+        (own if is_own else archive).append(number)
+    return own, archive
+
+
 @connection_and_session
 async def is_in_archive_number(connection: AsyncConnection,
                                session: AsyncSession, search_number):
@@ -516,81 +1170,126 @@ async def is_in_archive_number(connection: AsyncConnection,
 @connection_and_session
 async def set_archive_db(connection: AsyncConnection,
                          session: AsyncSession, tg_user_id, plate_number):
-    existing_number = await session.execute(
-        select(CarNumber).filter_by(number=plate_number))
-    existing_number = existing_number.scalar_one_or_none()
-    if existing_number:
-        existing_number.is_own = False
-        existing_number.is_archive = True
-        new_audit_log = AuditLog(tg_user_id, CarAction.ARCHIVE, plate_number)
-        session.add(new_audit_log)
+    result = await session.execute(
+        update(CarNumber).where(CarNumber.number == plate_number)
+        .values(is_own=False, is_archive=True)
+        .returning(CarNumber.id))
+    if result.first() is not None:
+        await session.execute(insert(AuditLog).values(
+            actor_tg_id=tg_user_id, action=CarAction.ARCHIVE,
+            number=plate_number, timestamp=func.now()))
         await session.commit()
 
 
+DELETE_OWN_NUMBERS_SQL = text("""
+    UPDATE car_numbers
+    SET is_own = FALSE, is_archive = TRUE
+    WHERE is_own AND number <> ALL(:values)
+    RETURNING number
+""").bindparams(bindparam('values', type_=ARRAY(String)))
+
+ADD_OWN_NUMBERS_SQL = text("""
+    INSERT INTO car_numbers (number, is_own, is_archive, count_out_archive,
+                             timestamp)
+    SELECT DISTINCT unnest(:values), TRUE, FALSE, 0, now()
+    ON CONFLICT ON CONSTRAINT unique_number DO UPDATE
+    SET is_own = TRUE,
+        is_archive = FALSE,
+        count_out_archive = car_numbers.count_out_archive
+                            + CASE WHEN car_numbers.is_archive THEN 1 ELSE 0 END
+    WHERE car_numbers.is_own IS NOT TRUE
+    RETURNING number
+""").bindparams(bindparam('values', type_=ARRAY(String)))
+
+LOG_OWN_NUMBERS_SQL = text("""
+    WITH audit AS (
+        INSERT INTO audit_log (actor_tg_id, action, number, timestamp)
+        SELECT CAST(:tg_user_id AS BIGINT), 'DELETE'::caraction,
+               unnest(:deleted), now()
+        UNION ALL
+        SELECT CAST(:tg_user_id AS BIGINT), 'ADD'::caraction,
+               unnest(:added), now()
+    ), upload AS (
+        INSERT INTO excel_log (tg_user_id, added_count, deleted_count,
+                               timestamp)
+        VALUES (:tg_user_id, cardinality(:added), cardinality(:deleted),
+                now())
+        RETURNING id
+    )
+    INSERT INTO excel_log_item (excel_log_id, action, number)
+    SELECT upload.id, item.action, item.number
+    FROM upload, (
+        SELECT 'DELETE'::caraction AS action, unnest(:deleted) AS number
+        UNION ALL
+        SELECT 'ADD'::caraction, unnest(:added)
+    ) AS item
+""").bindparams(bindparam('added', type_=ARRAY(String)),
+                bindparam('deleted', type_=ARRAY(String)))
+
+
 @connection_and_session
 async def update_plate_numbers_list(connection: AsyncConnection,
                                     session: AsyncSession, tg_user_id,
                                     values):
-    numbers_to_update = await session.execute(
-        select(CarNumber).filter(~CarNumber.number.in_(values))
-    )
-
-    current_numbers = [row[0].number for row in
-                       await session.execute(select(CarNumber)
-                                             .filter(CarNumber.is_own))]
-
-    deleted_numbers = [number for number in current_numbers if
-                       number not in values]
-    added_numbers = [number for number in values if
-                     number not in current_numbers]
-
-    for del_number in deleted_numbers:
-        existing_number = await session.execute(
-            select(CarNumber).filter_by(number=del_number))
-        existing_number = existing_number.scalar_one_or_none()
-        if existing_number:
-            existing_number.is_own = False
-            existing_number.is_archive = True
-            new_audit_log = AuditLog(tg_user_id, CarAction.DELETE, del_number)
-            session.add(new_audit_log)
-            # await session.commit()
-
-    for add_number in added_numbers:
-        existing_number = await session.execute(
-            select(CarNumber).filter_by(number=add_number))
-        existing_number = existing_number.scalar_one_or_none()
-        if existing_number:
-            existing_number.is_own = True
-            if existing_number.is_archive:
-                existing_number.count_out_archive += 1
-
-            existing_number.is_archive = False
-        else:
-            new_car_number = CarNumber(add_number, is_own=True)
-            session.add(new_car_number)
-
-        new_audit_log = AuditLog(tg_user_id, CarAction.ADD, add_number)
-        session.add(new_audit_log)
-
-    del_numbers_formatted = ' '.join(deleted_numbers)
-    add_numbers_formatted = ' '.join(added_numbers)
-    new_log = ExcelLog(tg_user_id, add_numbers_formatted,
-                       del_numbers_formatted)
-    session.add(new_log)
-
+    """Replace the list of own plates with values set-wise.
+
+    Runs three statements whatever the list size: plates missing from
+    values go to the archive, new plates are upserted as own, then the
+    audit_log, excel_log and excel_log_item rows are written in bulk.
+
+    :return: (added_numbers, deleted_numbers, timings of the phases)
+    """
+    timings = {}
+
+    phase_start = perf_counter()
+    result = await session.execute(DELETE_OWN_NUMBERS_SQL,
+                                   {'values': values})
+    deleted_numbers = sorted(result.scalars().all())
+    timings['delete'] = perf_counter() - phase_start
+
+    phase_start = perf_counter()
+    result = await session.execute(ADD_OWN_NUMBERS_SQL, {'values': values})
+    added_numbers = sorted(result.scalars().all())
+    timings['add'] = perf_counter() - phase_start
+
+    phase_start = perf_counter()
+    await session.execute(LOG_OWN_NUMBERS_SQL,
+                          {'tg_user_id': tg_user_id,
+                           'added': added_numbers,
+                           'deleted': deleted_numbers})
     await session.commit()
+    timings['log'] = perf_counter() - phase_start
+
+    logging.info('update_plate_numbers_list: %s номеров, добавлено %s, '
+                 'удалено %s, время фаз %s', len(values), len(added_numbers),
+                 len(deleted_numbers),
+                 ', '.join(f'{name}={value:.3f}s'
+                           for name, value in timings.items()))
+    return added_numbers, deleted_numbers, timings
 
 
 async def main():
-    engine = create_async_engine(POSTGRES_CONF,
-                                 echo=True)
+    from .migrations import upgrade, stamp
+    from .partitions import ensure_partitions
+
+    engine, async_session = init_engine()
     async with engine.begin() as connection:
-        async_session = sessionmaker(bind=engine, class_=AsyncSession,
-                                     expire_on_commit=False, autoflush=False)
+        await connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        is_new = not await connection.run_sync(
+            lambda sync_connection: inspect(sync_connection).has_table(
+                'car_numbers'))
         async with async_session() as session:
             async with session.begin():
                 await connection.run_sync(Base.metadata.create_all)
             print("База данных и таблицы успешно созданы")
+
+    if is_new:
+        await stamp()
+    else:
+        applied = await upgrade()
+        print(f'Применено миграций: {len(applied)}')
+    await ensure_partitions()
+    await dispose_engine()
     # await get_repeatable_parking(8, True)
 
 
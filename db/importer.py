@@ -0,0 +1,227 @@
+import csv
+import sys
+import asyncio
+import logging
+import argparse
+from time import perf_counter
+from datetime import datetime, date
+
+import openpyxl
+from sqlalchemy import text
+
+from utils.excel_boost import check_correct, change_format
+from .db import init_engine, dispose_engine, rebuild_parking_stats, \
+    rebuild_daily_stats
+from consts import LOG_HISTORY_RETENTION_MONTHS
+from .partitions import create_month_partitions, add_months
+
+COPY_CHUNK = 50000
+DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+CREATE_STAGING_SQL = """
+    CREATE TEMPORARY TABLE import_fixation (
+        number VARCHAR(10) NOT NULL,
+        record_date TIMESTAMP NOT NULL,
+        tg_user_id BIGINT NOT NULL
+    ) ON COMMIT DROP
+"""
+
+MERGE_PLATES_SQL = """
+    INSERT INTO car_numbers (number, is_own, is_archive, count_out_archive,
+                             timestamp, parking_count)
+    SELECT DISTINCT number, FALSE, FALSE, 0, now(), 0
+    FROM import_fixation
+    ON CONFLICT ON CONSTRAINT unique_number DO NOTHING
+"""
+
+# Exact repeats of a fixation, in the file or already in the database,
+# are skipped so an import can be run again after a failure.
+MERGE_FIXATIONS_SQL = """
+    INSERT INTO log_history (tg_user_id, car_number_id, record_date, is_own)
+    SELECT DISTINCT ON (c.id, s.record_date) s.tg_user_id, c.id,
+           s.record_date, COALESCE(c.is_own, FALSE)
+    FROM import_fixation s
+    JOIN car_numbers c ON c.number = s.number
+    WHERE NOT EXISTS (
+        SELECT 1 FROM log_history lh
+        WHERE lh.car_number_id = c.id AND lh.record_date = s.record_date
+    )
+"""
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    value = str(value).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def read_rows(path):
+    """Yield (row_number, cells) from a CSV or XLSX file."""
+    if path.lower().endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            for row_number, cells in enumerate(
+                    workbook.active.iter_rows(values_only=True), 1):
+                yield row_number, cells
+        finally:
+            workbook.close()
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        dialect = csv.Sniffer().sniff(file.read(4096), delimiters=',;\t')
+        file.seek(0)
+        for row_number, cells in enumerate(csv.reader(file, dialect), 1):
+            yield row_number, cells
+
+
+def normalize_rows(rows, tg_user_id, rejected, min_date=None):
+    """Yield (number, record_date, tg_user_id) of valid rows.
+
+    Columns: plate, date and an optional sender id. Invalid rows and rows
+    before min_date are appended to rejected as (row_number, cells,
+    reason).
+    """
+    for row_number, cells in rows:
+        if not cells or all(cell in (None, '') for cell in cells):
+            continue
+        if len(cells) < 2:
+            rejected.append((row_number, cells, 'нет даты'))
+            continue
+        number = str(cells[0] or '').strip()
+        if not check_correct(number):
+            rejected.append((row_number, cells, 'неверный номер'))
+            continue
+        record_date = parse_date(cells[1])
+        if record_date is None:
+            rejected.append((row_number, cells, 'неверная дата'))
+            continue
+        if min_date is not None and record_date < min_date:
+            # the month is compacted or is about to be, see db/partitions.py
+            rejected.append((row_number, cells, 'старше срока хранения'))
+            continue
+        sender = tg_user_id
+        if len(cells) > 2 and cells[2] not in (None, ''):
+            try:
+                sender = int(cells[2])
+            except (TypeError, ValueError):
+                rejected.append((row_number, cells, 'неверный id'))
+                continue
+        yield change_format(number), record_date, sender
+
+
+def write_rejected(path, rejected):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(['строка', 'причина', 'значения'])
+        for row_number, cells, reason in rejected:
+            writer.writerow([row_number, reason,
+                             ' | '.join('' if cell is None else str(cell)
+                                        for cell in cells)])
+
+
+async def import_history(paths, tg_user_id=0):
+    """Bulk-load historical fixations from CSV/XLSX files.
+
+    Rows are normalized like Excel uploads, copied into a temporary
+    staging table and merged into car_numbers and log_history with two
+    set-wise statements in one transaction. The T_RANGE_H window is not
+    applied, historical logs are taken as they are. Rows older than
+    LOG_HISTORY_RETENTION_MONTHS are rejected: their months are compacted
+    into summaries and have no partition.
+
+    :return: dict with counters, the rejected rows and timings
+    """
+    engine, _ = init_engine()
+    rejected = []
+    report = {'staged': 0, 'plates': 0, 'fixations': 0}
+    start = perf_counter()
+    boundary = add_months(date.today().replace(day=1),
+                          -LOG_HISTORY_RETENTION_MONTHS)
+    min_date = datetime(boundary.year, boundary.month, 1)
+
+    async with engine.begin() as connection:
+        await connection.execute(text(CREATE_STAGING_SQL))
+        driver = (await connection.get_raw_connection()).driver_connection
+
+        first = last = None
+        for path in paths:
+            chunk = []
+            staged = report['staged']
+            for row in normalize_rows(read_rows(path), tg_user_id, rejected,
+                                      min_date):
+                chunk.append(row)
+                first = min(first or row[1], row[1])
+                last = max(last or row[1], row[1])
+                if len(chunk) >= COPY_CHUNK:
+                    await driver.copy_records_to_table(
+                        'import_fixation', records=chunk)
+                    report['staged'] += len(chunk)
+                    chunk = []
+            if chunk:
+                await driver.copy_records_to_table('import_fixation',
+                                                   records=chunk)
+                report['staged'] += len(chunk)
+            logging.info('%s: загружено в промежуточную таблицу %s строк',
+                         path, report['staged'] - staged)
+        report['copy_seconds'] = perf_counter() - start
+
+        if report['staged']:
+            await create_month_partitions(connection, first.date(),
+                                          last.date())
+            result = await connection.execute(text(MERGE_PLATES_SQL))
+            report['plates'] = result.rowcount
+            result = await connection.execute(text(MERGE_FIXATIONS_SQL))
+            report['fixations'] = result.rowcount
+        report['merge_seconds'] = perf_counter() - start \
+            - report['copy_seconds']
+
+    if report['fixations']:
+        await rebuild_parking_stats()
+        await rebuild_daily_stats()
+
+    report['seconds'] = perf_counter() - start
+    report['rejected'] = rejected
+    return report
+
+
+async def main(args):
+    report = await import_history(args.paths, args.user)
+    await dispose_engine()
+
+    rows = report['staged'] + len(report['rejected'])
+    print(f"Прочитано строк: {rows}, принято: {report['staged']}, "
+          f"отклонено: {len(report['rejected'])}")
+    print(f"Новых номеров: {report['plates']}, новых фиксаций: "
+          f"{report['fixations']}, повторов пропущено: "
+          f"{report['staged'] - report['fixations']}")
+    print(f"Время: загрузка {report['copy_seconds']:.1f} с, слияние "
+          f"{report['merge_seconds']:.1f} с, всего {report['seconds']:.1f} с "
+          f"({rows / report['seconds']:.0f} строк/с)")
+    if report['rejected']:
+        write_rejected(args.rejected, report['rejected'])
+        print(f'Отклонённые строки записаны в {args.rejected}')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Импорт истории фиксаций из CSV/XLSX '
+                    '(номер, дата, [id отправителя])')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--user', type=int, default=0,
+                        help='id отправителя для строк без третьей колонки')
+    parser.add_argument('--rejected', default='rejected_rows.csv')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parse_args(sys.argv[1:])))
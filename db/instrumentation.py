@@ -0,0 +1,165 @@
+import bisect
+import logging
+from time import perf_counter
+
+from sqlalchemy import event
+
+# upper bounds of the histogram buckets, milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+STATEMENT_KEY_LENGTH = 120
+PARAMETERS_LOG_LENGTH = 500
+
+slow_query_logger = logging.getLogger('db.slow_query')
+
+
+class LatencyHistogram:
+    """Bucketed latencies of one function or statement."""
+
+    __slots__ = ('buckets', 'count', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def observe(self, seconds, rows=0):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if rows > 0:
+            self.rows += rows
+
+    def percentile(self, share):
+        """Upper bound of the bucket holding the share-th latency, ms."""
+        if not self.count:
+            return 0.0
+        rank = share * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max * 1000
+
+    def summary(self):
+        return {'count': self.count, 'total_ms': self.total * 1000,
+                'avg_ms': self.total * 1000 / self.count if self.count else 0,
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'max_ms': self.max * 1000, 'rows': self.rows}
+
+
+class Instrumentation:
+    """Latency histograms of db functions and SQL statements.
+
+    Engine events are only attached while enabled, so a disabled
+    instance costs one attribute check per db function call.
+    """
+
+    def __init__(self, enabled=False, slow_query_ms=200):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.functions = {}
+        self.statements = {}
+        self.slow_queries = 0
+        self._engine = None
+
+    def attach(self, engine):
+        """Remember the engine and listen to it if enabled."""
+        self._engine = engine
+        if self.enabled:
+            self._listen()
+
+    def detach(self):
+        self._remove()
+        self._engine = None
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self._listen()
+
+    def disable(self):
+        if self.enabled:
+            self.enabled = False
+            self._remove()
+
+    def reset(self):
+        self.functions = {}
+        self.statements = {}
+        self.slow_queries = 0
+
+    def _listen(self):
+        if self._engine is None:
+            return
+        sync_engine = self._engine.sync_engine
+        if not event.contains(sync_engine, 'before_cursor_execute',
+                              self._before_cursor_execute):
+            event.listen(sync_engine, 'before_cursor_execute',
+                         self._before_cursor_execute)
+            event.listen(sync_engine, 'after_cursor_execute',
+                         self._after_cursor_execute)
+            event.listen(sync_engine, 'handle_error', self._handle_error)
+
+    def _remove(self):
+        if self._engine is None:
+            return
+        sync_engine = self._engine.sync_engine
+        if event.contains(sync_engine, 'before_cursor_execute',
+                          self._before_cursor_execute):
+            event.remove(sync_engine, 'before_cursor_execute',
+                         self._before_cursor_execute)
+            event.remove(sync_engine, 'after_cursor_execute',
+                         self._after_cursor_execute)
+            event.remove(sync_engine, 'handle_error', self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        starts = conn.info.get('query_start')
+        if not starts:
+            return
+        elapsed = perf_counter() - starts.pop()
+        key = ' '.join(statement.split())[:STATEMENT_KEY_LENGTH]
+        histogram = self.statements.get(key)
+        if histogram is None:
+            histogram = self.statements[key] = LatencyHistogram()
+        histogram.observe(elapsed, cursor.rowcount or 0)
+
+        if elapsed * 1000 >= self.slow_query_ms:
+            self.slow_queries += 1
+            slow_query_logger.warning(
+                'Медленный запрос %.1f мс: %s; параметры: %s',
+                elapsed * 1000, ' '.join(statement.split()),
+                repr(parameters)[:PARAMETERS_LOG_LENGTH])
+
+    def _handle_error(self, exception_context):
+        # a failed statement never reaches after_cursor_execute, its start
+        # would stay in conn.info, which outlives the checkout
+        conn = exception_context.connection
+        if conn is not None and exception_context.cursor is not None:
+            starts = conn.info.get('query_start')
+            if starts:
+                starts.pop()
+
+    def observe_function(self, name, seconds):
+        histogram = self.functions.get(name)
+        if histogram is None:
+            histogram = self.functions[name] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def top(self, histograms, limit=10):
+        """Entries with the largest total time.
+
+        :return: List of (name, summary dict)
+        """
+        ordered = sorted(histograms.items(),
+                         key=lambda item: item[1].total, reverse=True)
+        return [(name, histogram.summary())
+                for name, histogram in ordered[:limit]]
@@ -0,0 +1,409 @@
+import re
+import asyncio
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from consts.consts import STATS_TIMEZONE
+from .db import init_engine, dispose_engine
+
+
+class Migration:
+    """One versioned schema change.
+
+    Non-transactional migrations run in autocommit mode, which is required
+    for CREATE INDEX CONCURRENTLY on a live database.
+    """
+
+    def __init__(self, version, name, statements, transactional=True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        self.transactional = transactional
+
+
+# Key of the advisory lock held while migrations are applied
+MIGRATION_LOCK_ID = 731_020_001
+
+# A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+# IF NOT EXISTS would then accept as built
+CONCURRENT_INDEX = re.compile(
+    r'CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (\w+)')
+
+INVALID_INDEX_SQL = """
+    SELECT 1
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_namespace n ON n.oid = i.relnamespace
+    WHERE n.nspname = current_schema()
+      AND i.relname = :name
+      AND NOT x.indisvalid
+"""
+
+SCHEMA_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+"""
+
+# Frozen copy of the parking backfill as of migration 2: later versions of
+# REBUILD_PARKING_STATS_SQL read tables that do not exist at that point.
+PARKING_STATS_BACKFILL_SQL = """
+    WITH stats AS (
+        SELECT car_number_id,
+               count(*) AS parking_count,
+               min(record_date) AS first_seen,
+               max(record_date) AS last_seen
+        FROM log_history
+        GROUP BY car_number_id
+    )
+    UPDATE car_numbers cn
+    SET parking_count = COALESCE(stats.parking_count, 0),
+        first_seen = stats.first_seen,
+        last_seen = stats.last_seen
+    FROM car_numbers c
+    LEFT JOIN stats ON stats.car_number_id = c.id
+    WHERE cn.id = c.id
+"""
+
+# Frozen copy of the daily_stats backfill as of migration 4: later versions
+# of REBUILD_DAILY_STATS_SQL read log_history.is_own, added in migration 9.
+DAILY_STATS_BACKFILL_SQL = [
+    'LOCK TABLE daily_stats IN EXCLUSIVE MODE',
+    'DELETE FROM daily_stats',
+    f"""
+    INSERT INTO daily_stats (day, total_fixations, foreign_fixations,
+                             distinct_plates)
+    SELECT ((lh.record_date AT TIME ZONE current_setting('TimeZone'))
+            AT TIME ZONE '{STATS_TIMEZONE}')::date AS day,
+           count(*),
+           count(*) FILTER (WHERE cn.is_own IS FALSE),
+           count(DISTINCT lh.car_number_id)
+    FROM log_history lh
+    LEFT JOIN car_numbers cn ON cn.id = lh.car_number_id
+    GROUP BY day
+    """,
+]
+
+# Rebuilds log_history as a table partitioned by month. Existing rows are
+# copied into monthly partitions, the id sequence is kept.
+PARTITION_LOG_HISTORY_SQL = """
+DO $$
+DECLARE
+    month_start DATE;
+    last_month DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class
+        WHERE oid = 'log_history'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE log_history RENAME TO log_history_old;
+    ALTER TABLE log_history_old
+        RENAME CONSTRAINT log_history_pkey TO log_history_old_pkey;
+    DROP INDEX IF EXISTS ix_log_history_car_number_id_record_date,
+        ix_log_history_record_date, ix_log_history_tg_user_id;
+
+    CREATE TABLE log_history (
+        id INTEGER NOT NULL DEFAULT nextval('log_history_id_seq'),
+        tg_user_id BIGINT NOT NULL,
+        car_number_id INTEGER REFERENCES car_numbers (id),
+        record_date TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, record_date)
+    ) PARTITION BY RANGE (record_date);
+    CREATE INDEX ix_log_history_car_number_id_record_date
+        ON log_history (car_number_id, record_date DESC);
+    CREATE INDEX ix_log_history_record_date ON log_history (record_date);
+    CREATE INDEX ix_log_history_tg_user_id ON log_history (tg_user_id);
+
+    SELECT date_trunc('month', COALESCE(min(record_date), now()))::date
+    INTO month_start FROM log_history_old;
+    last_month := date_trunc('month', now())::date;
+    WHILE month_start <= last_month LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF log_history '
+                       'FOR VALUES FROM (%L) TO (%L)',
+                       'log_history_y' || to_char(month_start, 'YYYY"m"MM'),
+                       month_start,
+                       (month_start + interval '1 month')::date);
+        month_start := (month_start + interval '1 month')::date;
+    END LOOP;
+
+    INSERT INTO log_history (id, tg_user_id, car_number_id, record_date)
+    SELECT id, tg_user_id, car_number_id, COALESCE(record_date, now())
+    FROM log_history_old;
+
+    ALTER SEQUENCE log_history_id_seq OWNED BY log_history.id;
+    DROP TABLE log_history_old;
+END $$
+"""
+
+# Moves the space-joined plate lists of excel_log into excel_log_item.
+EXCEL_LOG_ITEMS_SQL = [
+    'CREATE TABLE IF NOT EXISTS excel_log_item ('
+    'excel_log_id INTEGER NOT NULL '
+    'REFERENCES excel_log (id) ON DELETE CASCADE, '
+    'action caraction NOT NULL, '
+    'number VARCHAR(10) NOT NULL, '
+    'PRIMARY KEY (excel_log_id, action, number))',
+    'ALTER TABLE excel_log '
+    'ADD COLUMN IF NOT EXISTS added_count INTEGER NOT NULL DEFAULT 0, '
+    'ADD COLUMN IF NOT EXISTS deleted_count INTEGER NOT NULL DEFAULT 0',
+    """
+    INSERT INTO excel_log_item (excel_log_id, action, number)
+    SELECT id, 'ADD'::caraction, item.number
+    FROM excel_log,
+         unnest(string_to_array(added_numbers, ' ')) AS item(number)
+    WHERE item.number <> ''
+    UNION
+    SELECT id, 'DELETE'::caraction, item.number
+    FROM excel_log,
+         unnest(string_to_array(deleted_numbers, ' ')) AS item(number)
+    WHERE item.number <> ''
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    UPDATE excel_log e
+    SET added_count = counts.added_count,
+        deleted_count = counts.deleted_count
+    FROM (
+        SELECT excel_log_id,
+               count(*) FILTER (WHERE action = 'ADD') AS added_count,
+               count(*) FILTER (WHERE action = 'DELETE') AS deleted_count
+        FROM excel_log_item
+        GROUP BY excel_log_id
+    ) AS counts
+    WHERE e.id = counts.excel_log_id
+    """,
+    'ALTER TABLE excel_log DROP COLUMN added_numbers, '
+    'DROP COLUMN deleted_numbers',
+]
+
+# Makes (car_number_id, record_date) unique so a replayed write-behind
+# fixation is skipped. Exact repeats could not be told apart anyway, the
+# later copies are dropped; python -m db.rebuild recounts the aggregates.
+UNIQUE_FIXATION_SQL = [
+    """
+    DELETE FROM log_history a
+    USING log_history b
+    WHERE a.car_number_id = b.car_number_id
+      AND a.record_date = b.record_date
+      AND a.id > b.id
+    """,
+    'DROP INDEX IF EXISTS ix_log_history_car_number_id_record_date',
+    'CREATE UNIQUE INDEX ix_log_history_car_number_id_record_date '
+    'ON log_history (car_number_id, record_date DESC)',
+]
+
+MIGRATIONS = [
+    Migration(1, 'hot_path_indexes', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+        'ix_log_history_car_number_id_record_date '
+        'ON log_history (car_number_id, record_date DESC)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_log_history_record_date '
+        'ON log_history (record_date)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_log_history_tg_user_id '
+        'ON log_history (tg_user_id)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_audit_log_number_timestamp '
+        'ON audit_log (number, timestamp)',
+    ], transactional=False),
+    Migration(2, 'car_numbers_parking_stats', [
+        'ALTER TABLE car_numbers '
+        'ADD COLUMN IF NOT EXISTS parking_count INTEGER NOT NULL DEFAULT 0, '
+        'ADD COLUMN IF NOT EXISTS first_seen TIMESTAMP, '
+        'ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP',
+        PARKING_STATS_BACKFILL_SQL,
+    ]),
+    Migration(3, 'car_numbers_parking_index', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_car_numbers_parking '
+        'ON car_numbers (is_own, is_archive, parking_count DESC, id DESC)',
+    ], transactional=False),
+    Migration(4, 'daily_stats', [
+        'CREATE TABLE IF NOT EXISTS daily_stats ('
+        'day DATE PRIMARY KEY, '
+        'total_fixations INTEGER NOT NULL DEFAULT 0, '
+        'foreign_fixations INTEGER NOT NULL DEFAULT 0, '
+        'distinct_plates INTEGER NOT NULL DEFAULT 0)',
+        *DAILY_STATS_BACKFILL_SQL,
+    ]),
+    Migration(5, 'partition_log_history', [
+        'CREATE TABLE IF NOT EXISTS log_history_plate_summary ('
+        'month DATE NOT NULL, '
+        'car_number_id INTEGER NOT NULL REFERENCES car_numbers (id), '
+        'parking_count INTEGER NOT NULL DEFAULT 0, '
+        'first_seen TIMESTAMP, last_seen TIMESTAMP, '
+        'PRIMARY KEY (month, car_number_id))',
+        'CREATE TABLE IF NOT EXISTS log_history_day_summary ('
+        'day DATE NOT NULL, tg_user_id BIGINT NOT NULL, '
+        'fixations INTEGER NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (day, tg_user_id))',
+        PARTITION_LOG_HISTORY_SQL,
+    ]),
+    Migration(6, 'excel_log_items', EXCEL_LOG_ITEMS_SQL),
+    Migration(7, 'car_numbers_trigram_index', [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_car_numbers_number_trgm '
+        'ON car_numbers USING gin (number gin_trgm_ops)',
+    ], transactional=False),
+    Migration(8, 'log_history_unique_fixation', UNIQUE_FIXATION_SQL),
+    # the owner at the time of older fixations is unknown, they take the
+    # current is_own of the plate, which is what daily_stats was rebuilt by
+    Migration(9, 'log_history_is_own', [
+        'ALTER TABLE log_history '
+        'ADD COLUMN IF NOT EXISTS is_own BOOLEAN NOT NULL DEFAULT FALSE',
+        'UPDATE log_history lh SET is_own = TRUE '
+        'FROM car_numbers cn '
+        'WHERE cn.id = lh.car_number_id AND cn.is_own',
+    ]),
+]
+
+REQUIRED_INDEXES = {
+    'log_history': ['ix_log_history_car_number_id_record_date',
+                    'ix_log_history_record_date',
+                    'ix_log_history_tg_user_id'],
+    'audit_log': ['ix_audit_log_number_timestamp'],
+    'car_numbers': ['ix_car_numbers_parking', 'ix_car_numbers_number_trgm'],
+}
+
+
+async def get_schema_version(connection: AsyncConnection) -> int:
+    await connection.execute(text(SCHEMA_VERSION_SQL))
+    version = await connection.scalar(
+        text('SELECT max(version) FROM schema_version'))
+    return version or 0
+
+
+async def drop_invalid_index(connection: AsyncConnection, statement):
+    """Drop the INVALID leftover of a concurrent index build, if any."""
+    match = CONCURRENT_INDEX.search(statement)
+    if match is None:
+        return
+    invalid = await connection.scalar(text(INVALID_INDEX_SQL),
+                                      {'name': match[1]})
+    if invalid:
+        logging.info('Пересоздание недостроенного индекса %s', match[1])
+        await connection.execute(text(f'DROP INDEX IF EXISTS {match[1]}'))
+
+
+async def apply_migration(engine, migration: Migration):
+    if migration.transactional:
+        async with engine.begin() as connection:
+            for statement in migration.statements:
+                await connection.execute(text(statement))
+            await connection.execute(
+                text('INSERT INTO schema_version (version, name) '
+                     'VALUES (:version, :name)'),
+                {'version': migration.version, 'name': migration.name})
+        return
+
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        for statement in migration.statements:
+            await drop_invalid_index(connection, statement)
+            await connection.execute(text(statement))
+        await connection.execute(
+            text('INSERT INTO schema_version (version, name) '
+                 'VALUES (:version, :name)'),
+            {'version': migration.version, 'name': migration.name})
+
+
+async def upgrade(target=None):
+    """Apply every pending migration up to target (latest by default).
+
+    :param target: Last version to apply
+    :return: List of applied versions
+    """
+    engine, _ = init_engine()
+    # a second upgrade started meanwhile waits here and then sees the new
+    # version; the lock connection stays outside a transaction, otherwise
+    # CREATE INDEX CONCURRENTLY would wait for it
+    async with engine.connect() as lock:
+        lock = await lock.execution_options(isolation_level='AUTOCOMMIT')
+        await lock.execute(text('SELECT pg_advisory_lock(:id)'),
+                           {'id': MIGRATION_LOCK_ID})
+        try:
+            async with engine.begin() as connection:
+                current = await get_schema_version(connection)
+
+            applied = []
+            for migration in MIGRATIONS:
+                if migration.version <= current:
+                    continue
+                if target is not None and migration.version > target:
+                    break
+                logging.info('Применение миграции %s_%s', migration.version,
+                             migration.name)
+                await apply_migration(engine, migration)
+                applied.append(migration.version)
+        finally:
+            await lock.execute(text('SELECT pg_advisory_unlock(:id)'),
+                               {'id': MIGRATION_LOCK_ID})
+    return applied
+
+
+async def stamp(version=None):
+    """Mark migrations up to version as applied without running them.
+
+    Used after Base.metadata.create_all on an empty database, which
+    already builds the latest schema.
+    """
+    engine, _ = init_engine()
+    version = version or MIGRATIONS[-1].version
+    async with engine.begin() as connection:
+        current = await get_schema_version(connection)
+        for migration in MIGRATIONS:
+            if current < migration.version <= version:
+                await connection.execute(
+                    text('INSERT INTO schema_version (version, name) '
+                         'VALUES (:version, :name)'),
+                    {'version': migration.version, 'name': migration.name})
+
+
+async def get_pending_migrations():
+    engine, _ = init_engine()
+    async with engine.begin() as connection:
+        current = await get_schema_version(connection)
+    return [migration for migration in MIGRATIONS
+            if migration.version > current]
+
+
+async def check_indexes():
+    """Return names of required indexes that are missing or INVALID.
+
+    An index left INVALID by a failed concurrent build is not used by the
+    planner, so it counts as missing.
+
+    :return: List of (table, index) tuples
+    """
+    engine, _ = init_engine()
+    async with engine.connect() as connection:
+        result = await connection.execute(text("""
+            SELECT t.relname, i.relname
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            JOIN pg_class t ON t.oid = x.indrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            WHERE n.nspname = current_schema()
+              AND x.indisvalid
+        """))
+        existing = {(row[0], row[1]) for row in result.fetchall()}
+
+    return [(table, index) for table, indexes in REQUIRED_INDEXES.items()
+            for index in indexes if (table, index) not in existing]
+
+
+async def main():
+    applied = await upgrade()
+    print(f'Применено миграций: {len(applied)}')
+    missing = await check_indexes()
+    for table, index in missing:
+        print(f'Отсутствует или не построен индекс {index} '
+              f'в таблице {table}')
+    await dispose_engine()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
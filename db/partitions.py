@@ -0,0 +1,163 @@
+import re
+import sys
+import asyncio
+import logging
+from datetime import date
+
+from sqlalchemy import text
+
+from consts.consts import LOG_HISTORY_RETENTION_MONTHS, \
+    LOG_HISTORY_PARTITIONS_AHEAD
+from .db import init_engine, dispose_engine, LOCAL_DAY_SQL
+
+PARTITION_NAME = re.compile(r'^log_history_y(\d{4})m(\d{2})$')
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'log_history_y{month.year:04d}m{month.month:02d}'
+
+
+async def list_partitions(connection):
+    """Return the months of attached log_history partitions, sorted."""
+    result = await connection.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'log_history'::regclass
+    """))
+    months = []
+    for (name,) in result.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(date(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+async def create_month_partitions(connection, first: date, last: date):
+    """Create missing partitions for every month from first to last.
+
+    Attached partitions are looked up in pg_inherits, compacted months
+    were detached under another name, see compact_partition.
+
+    :return: Names of created partitions
+    """
+    existing = set(await list_partitions(connection))
+    created = []
+    month = first.replace(day=1)
+    while month <= last:
+        if month not in existing:
+            await connection.execute(text(
+                f'CREATE TABLE {partition_name(month)} '
+                f'PARTITION OF log_history FOR VALUES '
+                f"FROM ('{month}') TO ('{add_months(month, 1)}')"))
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+async def ensure_partitions(ahead=LOG_HISTORY_PARTITIONS_AHEAD):
+    """Create monthly partitions from the current month up to ahead months.
+
+    :return: Names of created partitions
+    """
+    engine, _ = init_engine()
+    current = date.today().replace(day=1)
+    async with engine.begin() as connection:
+        return await create_month_partitions(connection, current,
+                                             add_months(current, ahead))
+
+
+async def detached_name(connection, name):
+    """Free name for a detached partition: name_compacted[_N]."""
+    candidate = f'{name}_compacted'
+    suffix = 1
+    while await connection.scalar(
+            text('SELECT to_regclass(:name)'), {'name': candidate}):
+        suffix += 1
+        candidate = f'{name}_compacted_{suffix}'
+    return candidate
+
+
+async def compact_partition(engine, month: date):
+    """Fold one partition into the summaries and detach it."""
+    name = partition_name(month)
+    async with engine.begin() as connection:
+        await connection.execute(text(f"""
+            INSERT INTO log_history_plate_summary
+                (month, car_number_id, parking_count, first_seen, last_seen)
+            SELECT DATE '{month}', car_number_id, count(*),
+                   min(record_date), max(record_date)
+            FROM {name}
+            GROUP BY car_number_id
+            ON CONFLICT (month, car_number_id) DO UPDATE
+            SET parking_count = log_history_plate_summary.parking_count
+                                + EXCLUDED.parking_count,
+                first_seen = LEAST(log_history_plate_summary.first_seen,
+                                   EXCLUDED.first_seen),
+                last_seen = GREATEST(log_history_plate_summary.last_seen,
+                                     EXCLUDED.last_seen)
+        """))
+        await connection.execute(text(f"""
+            INSERT INTO log_history_day_summary (day, tg_user_id, fixations)
+            SELECT {LOCAL_DAY_SQL} AS day, tg_user_id, count(*)
+            FROM {name}
+            GROUP BY day, tg_user_id
+            ON CONFLICT (day, tg_user_id) DO UPDATE
+            SET fixations = log_history_day_summary.fixations
+                            + EXCLUDED.fixations
+        """))
+        await connection.execute(
+            text(f'ALTER TABLE log_history DETACH PARTITION {name}'))
+        # renamed so the month can get a new partition under the usual name
+        await connection.execute(text(
+            f'ALTER TABLE {name} RENAME TO '
+            f'{await detached_name(connection, name)}'))
+
+
+async def compact_log_history(retention_months=LOG_HISTORY_RETENTION_MONTHS):
+    """Compact and detach partitions older than retention_months.
+
+    Detached tables are renamed to log_history_yYYYYmMM_compacted and keep
+    their rows until an administrator drops them.
+
+    :return: Names of detached partitions
+    """
+    engine, _ = init_engine()
+    boundary = add_months(date.today().replace(day=1), -retention_months)
+    async with engine.connect() as connection:
+        months = await list_partitions(connection)
+
+    detached = []
+    for month in months:
+        if month >= boundary:
+            break
+        logging.info('Сжатие партиции %s', partition_name(month))
+        await compact_partition(engine, month)
+        detached.append(partition_name(month))
+    return detached
+
+
+async def maintain_log_history():
+    """Daily job: create future partitions and apply the retention policy."""
+    created = await ensure_partitions()
+    detached = await compact_log_history()
+    return created, detached
+
+
+async def main(args):
+    if args and args[0] == 'compact':
+        retention = int(args[1]) if len(args) > 1 \
+            else LOG_HISTORY_RETENTION_MONTHS
+        print(f'Отсоединены партиции: {await compact_log_history(retention)}')
+    else:
+        print(f'Созданы партиции: {await ensure_partitions()}')
+    await dispose_engine()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
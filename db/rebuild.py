@@ -0,0 +1,26 @@
+import sys
+import asyncio
+
+from .db import dispose_engine, rebuild_parking_stats, rebuild_daily_stats
+
+
+REBUILD_JOBS = {
+    'parking': rebuild_parking_stats,
+    'daily': rebuild_daily_stats,
+}
+
+
+async def main(names):
+    for name in names or REBUILD_JOBS:
+        job = REBUILD_JOBS.get(name)
+        if job is None:
+            print(f'Неизвестная задача {name}, доступны: '
+                  f'{", ".join(REBUILD_JOBS)}')
+            continue
+        result = await job()
+        print(f'{name}: исправлено записей {result}')
+    await dispose_engine()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
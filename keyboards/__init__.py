@@ -5,7 +5,10 @@ from .get_keyboard_add_archive import get_keyboard_add_archive
 from .get_keyboard_yes_or_no_archive import get_keyboard_yes_or_no_archive
 from .get_keyboard_stat_numbers import get_keyboard_stat_numbers
 from .get_keyboard_upload_excel import get_keyboard_upload_excel
+from .get_keyboard_excel_log_items import get_keyboard_excel_log_items
+from .get_keyboard_plate_candidates import get_keyboard_plate_candidates
 __all__ = ['get_add_plate_keyboard', 'refresh_keyboard',
            'get_active_user_keyboard', 'get_keyboard_add_archive',
            'get_keyboard_yes_or_no_archive', 'get_keyboard_stat_numbers',
-           'get_keyboard_upload_excel', 'refresh_keyboard_and_text']
+           'get_keyboard_upload_excel', 'refresh_keyboard_and_text',
+           'get_keyboard_excel_log_items', 'get_keyboard_plate_candidates']
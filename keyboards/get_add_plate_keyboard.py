@@ -2,18 +2,24 @@ from aiogram import types
 from aiogram.utils.keyboard import KeyboardBuilder
 import math
 
-from utils import compare_count
-from db import get_repeatable_parking_offset, get_repeatable_parking
+from consts.consts import LIMIT_PLATE_NUMBERS
+from utils import compare_count, encode_cursor
+from db import get_repeatable_parking_page
 
 
-async def get_add_plate_keyboard(is_own, is_archive, current_page=1):
+async def get_add_plate_keyboard(is_own, is_archive, current_page=1,
+                                 after=None, before=None, page=None):
     builder = KeyboardBuilder(button_type=types.InlineKeyboardButton)
 
-    limit = 10
-    total_accounts = len((await get_repeatable_parking(is_own, is_archive))[0])
-    total_pages = math.ceil(total_accounts / 10)
+    if page is None:
+        page = await get_repeatable_parking_page(is_own, is_archive,
+                                                 LIMIT_PLATE_NUMBERS,
+                                                 after, before)
+    numbers, total_accounts, _ = page
+    total_pages = math.ceil(total_accounts / LIMIT_PLATE_NUMBERS)
 
-    numbers = await get_repeatable_parking_offset(is_own, is_archive, current_page, limit)
+    first = (numbers[0][1], numbers[0][3]) if numbers else ()
+    last = (numbers[-1][1], numbers[-1][3]) if numbers else ()
 
     for number in numbers:
         builder.row(
@@ -26,9 +32,11 @@ async def get_add_plate_keyboard(is_own, is_archive, current_page=1):
         )
 
     left_button = types.InlineKeyboardButton(text='⬅',
-                                             callback_data="numbers_left")
+                                             callback_data=encode_cursor(
+                                                 'numbers_left', *first))
     right_button = types.InlineKeyboardButton(text='➡',
-                                              callback_data="numbers_right")
+                                              callback_data=encode_cursor(
+                                                  'numbers_right', *last))
 
     if current_page == 1 and total_pages > 1:
         builder.row(types.InlineKeyboardButton(
@@ -0,0 +1,47 @@
+from aiogram import types
+from aiogram.utils.keyboard import KeyboardBuilder
+import math
+
+from consts.consts import LIMIT_EXCEL_LOG_ITEMS
+from utils import encode_cursor
+
+
+async def get_keyboard_excel_log_items(excel_log_id, action, current_page=1,
+                                       first_key=None, last_key=None,
+                                       total_items=0):
+    builder = KeyboardBuilder(button_type=types.InlineKeyboardButton)
+
+    total_pages = math.ceil(total_items / LIMIT_EXCEL_LOG_ITEMS)
+
+    left_button = types.InlineKeyboardButton(
+        text='⬅',
+        callback_data=encode_cursor('excel_items_left', excel_log_id,
+                                    action, first_key))
+    right_button = types.InlineKeyboardButton(
+        text='➡',
+        callback_data=encode_cursor('excel_items_right', excel_log_id,
+                                    action, last_key))
+
+    if current_page == 1 and total_pages > 1:
+        builder.row(types.InlineKeyboardButton(
+            text=f"Страница {current_page}/{total_pages}",
+            callback_data="refresh_accounts"), right_button,
+            width=2)
+    elif current_page > 1 and current_page == total_pages:
+        builder.row(types.InlineKeyboardButton(
+            text=f"Страница {current_page}/{total_pages}",
+            callback_data="refresh_accounts"), left_button,
+            width=2)
+    elif 1 < current_page < total_pages:
+        builder.row(
+            left_button,
+            right_button, width=2
+        )
+
+        builder.row(
+            types.InlineKeyboardButton(
+                text=f"Страница {current_page}/{total_pages}",
+                callback_data="refresh_accounts")
+        )
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=builder.export())
+    return keyboard
@@ -0,0 +1,15 @@
+from aiogram import types
+from aiogram.utils.keyboard import KeyboardBuilder
+
+
+async def get_keyboard_plate_candidates(plate_number, candidates):
+    builder = KeyboardBuilder(button_type=types.InlineKeyboardButton)
+    for candidate in candidates:
+        builder.row(types.InlineKeyboardButton(
+            text=candidate, callback_data=f"confirm_plate:{candidate}"))
+    builder.row(types.InlineKeyboardButton(
+        text=f'Нет, записать {plate_number}',
+        callback_data=f"confirm_plate:{plate_number}"))
+
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=builder.export())
+    return keyboard
@@ -3,23 +3,25 @@ from aiogram.utils.keyboard import KeyboardBuilder
 import math
 
 from consts.consts import LIMIT_STAT_NUMBERS
+from utils import encode_cursor
 from db import get_stat_numbers_dates_count
 
 
-async def get_keyboard_stat_numbers(current_page=1):
+async def get_keyboard_stat_numbers(current_page=1, first_key=None,
+                                    last_key=None, total_dates=None):
     builder = KeyboardBuilder(button_type=types.InlineKeyboardButton)
 
-    total_dates = await get_stat_numbers_dates_count()
-    print(total_dates, 'total_dates')
+    if total_dates is None:
+        total_dates = await get_stat_numbers_dates_count()
 
     total_pages = math.ceil(total_dates / LIMIT_STAT_NUMBERS)
 
     left_button = types.InlineKeyboardButton(
         text='⬅',
-        callback_data="stat_numbers_left")
+        callback_data=encode_cursor('stat_numbers_left', first_key))
     right_button = types.InlineKeyboardButton(
         text='➡',
-        callback_data="stat_numbers_right")
+        callback_data=encode_cursor('stat_numbers_right', last_key))
 
     if current_page == 1 and total_pages > 1:
         builder.row(types.InlineKeyboardButton(
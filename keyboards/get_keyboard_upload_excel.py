@@ -3,22 +3,36 @@ from aiogram.utils.keyboard import KeyboardBuilder
 import math
 
 from consts.consts import LIMIT_UPLOAD_EXCEL_LOG
+from utils import encode_cursor
 from db import get_numbers_upload_count
 
 
-async def get_keyboard_upload_excel(current_page=1):
+async def get_keyboard_upload_excel(current_page=1, first_key=None,
+                                    last_key=None, total_upload=None,
+                                    diffs=()):
+    """Pages of the upload log plus a button for every cut diff.
+
+    :param diffs: (excel_log_id, action name, button text) of diffs that
+        did not fit into the preview
+    """
     builder = KeyboardBuilder(button_type=types.InlineKeyboardButton)
 
-    total_upload = await get_numbers_upload_count()
+    for excel_log_id, action, button_text in diffs:
+        builder.row(types.InlineKeyboardButton(
+            text=button_text,
+            callback_data=f'excel_log_items:{excel_log_id}:{action}'))
+
+    if total_upload is None:
+        total_upload = await get_numbers_upload_count()
 
     total_pages = math.ceil(total_upload / LIMIT_UPLOAD_EXCEL_LOG)
 
     left_button = types.InlineKeyboardButton(
         text='⬅',
-        callback_data="upload_excel_left")
+        callback_data=encode_cursor('upload_excel_left', first_key))
     right_button = types.InlineKeyboardButton(
         text='➡',
-        callback_data="upload_excel_right")
+        callback_data=encode_cursor('upload_excel_right', last_key))
 
     if current_page == 1 and total_pages > 1:
         builder.row(types.InlineKeyboardButton(
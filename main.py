@@ -2,12 +2,16 @@ import pytesseract
 import cv2
 import os
 import numpy as np
-from PIL import Image
-import io
 
 
 project_path = os.path.dirname(os.path.abspath(__file__))
 
+CASCADE_PATH = os.path.join(project_path, 'haar_cascades',
+                            'haarcascade_russian_plate_number.xml')
+
+# loaded once per process, see load_cascade
+carplate_haar_cascade = None
+
 
 def detect_text(content):
     """Detects text in the file."""
@@ -38,10 +42,8 @@ def detect_text(content):
 
 
 def open_img(img):
-    carplate_img = Image.open(io.BytesIO(img))
-    carplate_img = cv2.cvtColor(np.array(carplate_img), cv2.COLOR_BGR2RGB)
-
-    return carplate_img
+    # decodes straight from the download buffer, BGR like the PIL path gave
+    return cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
 
 
 def carplate_extract(image, carplate_haar_cascade):
@@ -65,17 +67,27 @@ def enlarge_img(image, scale_percent):
     return resized_image
 
 
-def get_number_auto(image_bytes):
-    carplate_img_rgb = open_img(image_bytes)
+def load_cascade():
+    global carplate_haar_cascade
+    if carplate_haar_cascade is None:
+        carplate_haar_cascade = cv2.CascadeClassifier(CASCADE_PATH)
+    return carplate_haar_cascade
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
 
-    cascade_path = os.path.join(script_dir, 'haar_cascades', 'haarcascade_russian_plate_number.xml')
+def init_worker():
+    """Load the cascade and find Tesseract once per OCR worker process."""
+    load_cascade()
+    pytesseract.get_tesseract_version()
 
-    carplate_haar_cascade = cv2.CascadeClassifier(cascade_path)
+
+def get_number_auto(image_bytes, timeout=0):
+    """
+    :param timeout: Seconds for Tesseract, 0 means no limit
+    """
+    carplate_img_rgb = open_img(image_bytes)
 
     carplate_extract_image = carplate_extract(carplate_img_rgb,
-                                              carplate_haar_cascade)
+                                              load_cascade())
     carplate_extract_image = enlarge_img(carplate_extract_image, 150)
 
     carplate_extract_image_gray = cv2.cvtColor(carplate_extract_image,
@@ -88,8 +100,13 @@ def get_number_auto(image_bytes):
     # print(detect_text(carplate_extract_image_gray))
 
     return "Номер автомобиля:" + "".join((pytesseract.image_to_string(
-        carplate_extract_image_gray, lang='eng', config=r'--oem 1 --psm 10 -c tessedit_char_whitelist=0123456789ABCETYOPHXM'))
-                                         .split()), carplate_extract_image_gray
+        carplate_extract_image_gray, lang='eng', config=r'--oem 1 --psm 10 -c tessedit_char_whitelist=0123456789ABCETYOPHXM',
+        timeout=timeout)).split()), carplate_extract_image_gray
+
+
+def recognize_plate(image_bytes, timeout=0):
+    """OCR job of a worker process, only the text is sent back."""
+    return get_number_auto(image_bytes, timeout)[0]
 
 
 if __name__ == "__main__":
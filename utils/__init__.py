@@ -1,4 +1,11 @@
 from .compare_count import compare_count
 from .excel_boost import read_excel
+from .cursor import encode_cursor, decode_cursor
+from .plate_distance import levenshtein, DeletionIndex
+from .export import export_rows, EXPORT_EXTENSIONS
+from .photo_download import PhotoDownloader
+from .ocr_pool import OcrPool, PoolBusy
 
-__all__ = ['compare_count', 'read_excel']
+__all__ = ['compare_count', 'read_excel', 'encode_cursor', 'decode_cursor',
+           'levenshtein', 'DeletionIndex', 'export_rows', 'EXPORT_EXTENSIONS',
+           'PhotoDownloader', 'OcrPool', 'PoolBusy']
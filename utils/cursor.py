@@ -0,0 +1,19 @@
+def encode_cursor(action, *values):
+    """Build callback data carrying a keyset cursor, e.g. numbers_right:5:42.
+
+    Telegram limits callback data to 64 bytes, cursors are short sort keys.
+    """
+    if not values or None in values:
+        return action
+    return ':'.join([action, *(str(value) for value in values)])
+
+
+def decode_cursor(callback_data, cast=int):
+    """Split callback data into the action and the cursor values.
+
+    :return: (action, list of values or None)
+    """
+    action, *values = callback_data.split(':')
+    if not values:
+        return action, None
+    return action, [cast(value) for value in values]
@@ -0,0 +1,73 @@
+import csv
+import gzip
+import asyncio
+
+import openpyxl
+
+# rows per sheet, one row is kept for the header
+XLSX_MAX_ROWS = 1048576 - 1
+
+
+class XlsxWriter:
+    """Write-only workbook that starts a new sheet when one is full."""
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_rows = XLSX_MAX_ROWS
+
+    def write(self, rows):
+        for row in rows:
+            if self.sheet_rows >= XLSX_MAX_ROWS:
+                self.sheet = self.workbook.create_sheet(
+                    f'Лист{len(self.workbook.worksheets) + 1}')
+                self.sheet.append(self.header)
+                self.sheet_rows = 0
+            self.sheet.append(tuple(row))
+            self.sheet_rows += 1
+
+    def close(self):
+        if self.sheet is None:
+            self.workbook.create_sheet('Лист1').append(self.header)
+        self.workbook.save(self.path)
+
+
+class CsvWriter:
+    """Gzip-compressed CSV, opens in Excel after unpacking."""
+
+    def __init__(self, path, header):
+        self.path = path
+        self.file = gzip.open(path, 'wt', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file, delimiter=';')
+        self.writer.writerow(header)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+EXPORT_WRITERS = {'xlsx': XlsxWriter, 'csv': CsvWriter}
+EXPORT_EXTENSIONS = {'xlsx': '.xlsx', 'csv': '.csv.gz'}
+
+
+async def export_rows(path, header, partitions, file_format='xlsx'):
+    """Write rows from an async iterator of row lists into a file.
+
+    Partitions are written in a worker thread, so a large export does not
+    block the event loop, and only one partition is held in memory.
+
+    :return: Number of written rows
+    """
+    writer = EXPORT_WRITERS[file_format](path, header)
+    count = 0
+    try:
+        async for rows in partitions:
+            await asyncio.to_thread(writer.write, rows)
+            count += len(rows)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return count
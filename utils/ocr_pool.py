@@ -0,0 +1,104 @@
+import asyncio
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from db.instrumentation import LatencyHistogram
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class OcrPool:
+    """Process pool for OCR jobs with a bounded queue.
+
+    At most workers + queue_size jobs are accepted, further jobs raise
+    PoolBusy at once instead of waiting. A job that timed out while
+    running keeps its slot until the worker is free, so the bound holds.
+    """
+
+    def __init__(self, job, initializer=None, workers=2, queue_size=8,
+                 timeout=20):
+        """
+        :param job: Picklable function image_bytes, timeout -> result
+        :param initializer: Called once in every worker process
+        """
+        self.job = job
+        self.initializer = initializer
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.executor = None
+        self.pending = 0
+        self.latency = LatencyHistogram()
+        self.stats = {'max_pending': 0, 'rejected': 0, 'timeouts': 0,
+                      'failures': 0, 'restarts': 0}
+
+    def start(self):
+        # spawn: forking the bot with its event loop and open sockets is
+        # unsafe, and it is the only start method on Windows anyway
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=self.initializer)
+        # start the workers now so the first photo does not wait for them
+        for _ in range(self.workers):
+            self.executor.submit(int)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _release(self):
+        self.pending -= 1
+
+    async def run(self, image_bytes):
+        """Run the job in a worker.
+
+        :return: Result of the job
+        :raises PoolBusy: If the queue is full
+        :raises asyncio.TimeoutError: If the job took longer than timeout
+        """
+        if self.pending >= self.workers + self.queue_size:
+            self.stats['rejected'] += 1
+            raise PoolBusy()
+        if self.executor is None:
+            self.start()
+        try:
+            future = self.executor.submit(self.job, image_bytes,
+                                          self.timeout)
+        except BrokenProcessPool:
+            self.stats['restarts'] += 1
+            self.shutdown()
+            self.start()
+            future = self.executor.submit(self.job, image_bytes,
+                                          self.timeout)
+        self.pending += 1
+        self.stats['max_pending'] = max(self.stats['max_pending'],
+                                        self.pending)
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release))
+
+        start = perf_counter()
+        try:
+            # a queued job is cancelled on timeout, a running one is
+            # stopped by the Tesseract timeout given to the worker
+            result = await asyncio.wait_for(asyncio.wrap_future(future),
+                                            self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+        except Exception:
+            self.stats['failures'] += 1
+            raise
+        self.latency.observe(perf_counter() - start)
+        return result
+
+    def get_stats(self):
+        return {**self.latency.summary(), **self.stats,
+                'pending': self.pending,
+                'queued': max(self.pending - self.workers, 0)}
@@ -0,0 +1,70 @@
+import asyncio
+from time import perf_counter
+
+from db.instrumentation import LatencyHistogram
+from consts.consts import PHOTO_MAX_BYTES, PHOTO_DOWNLOAD_TIMEOUT
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class PhotoDownloader:
+    """Telegram file downloads into memory through the bot's session.
+
+    The bot session keeps a pooled aiohttp connector for its whole life,
+    so a download does not pay for a new TCP and TLS handshake.
+    """
+
+    def __init__(self, max_bytes=PHOTO_MAX_BYTES,
+                 timeout=PHOTO_DOWNLOAD_TIMEOUT, chunk_size=65536):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.latency = LatencyHistogram()
+        self.stats = {'too_large': 0, 'failures': 0}
+
+    async def _read(self, bot, file):
+        telegram_file = await bot.get_file(file.file_id)
+        size = telegram_file.file_size or file.file_size or 0
+        if size > self.max_bytes:
+            raise FileTooLarge(size)
+        buffer = bytearray(size)
+        received = 0
+        async for chunk in bot.session.stream_content(
+                bot.session.api.file_url(bot.token, telegram_file.file_path),
+                timeout=self.timeout, chunk_size=self.chunk_size,
+                raise_for_status=True):
+            end = received + len(chunk)
+            if end > self.max_bytes:
+                raise FileTooLarge(end)
+            buffer[received:end] = chunk
+            received = end
+        del buffer[received:]
+        return buffer
+
+    async def download(self, bot, file):
+        """Download a photo or document into a buffer of its file_size.
+
+        :param file: Object with file_id and file_size, e.g. PhotoSize
+        :return: bytearray with the file or None if it failed
+        """
+        if file.file_size and file.file_size > self.max_bytes:
+            self.stats['too_large'] += 1
+            return None
+        start = perf_counter()
+        try:
+            buffer = await asyncio.wait_for(self._read(bot, file),
+                                            self.timeout)
+        except FileTooLarge:
+            self.stats['too_large'] += 1
+            return None
+        except Exception as e:
+            print(e)
+            self.stats['failures'] += 1
+            return None
+        self.latency.observe(perf_counter() - start, len(buffer))
+        return buffer
+
+    def get_stats(self):
+        return {**self.latency.summary(), **self.stats}
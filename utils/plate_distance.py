@@ -0,0 +1,40 @@
+def levenshtein(first, second):
+    """Edit distance between two strings."""
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+def deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+class DeletionIndex:
+    """Nearest plates within one edit via single-character deletions.
+
+    Two plates are one substitution, insertion or deletion apart only if
+    they share a deletion variant or one is a deletion of the other, so
+    a lookup is a handful of dict hits instead of a scan.
+    """
+
+    def __init__(self, words=()):
+        self.variants = {}
+        for word in words:
+            for variant in deletions(word) | {word}:
+                self.variants.setdefault(variant, set()).add(word)
+
+    def search(self, word, limit=3):
+        """Return up to limit plates at edit distance 1, sorted."""
+        candidates = set()
+        for variant in deletions(word) | {word}:
+            candidates |= self.variants.get(variant, set())
+        candidates.discard(word)
+        return sorted(candidate for candidate in candidates
+                      if levenshtein(word, candidate) == 1)[:limit]